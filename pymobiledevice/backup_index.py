@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# $Id$
+#
+# Copyright (c) 2012-2023 "dark[-at-]gotohack.org"
+#
+# This file is part of pymobiledevice
+#
+# pymobiledevice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+import os
+import re
+import sqlite3
+import fnmatch
+import hashlib
+import logging
+import plistlib
+
+from collections import namedtuple
+from optparse import OptionParser
+from struct import unpack_from
+
+from pymobiledevice.util import save_pickle, load_pickle, sizeof_fmt
+
+INDEX_VERSION = 1
+BUFSIZE = 1024*1024
+
+BackupFile = namedtuple("BackupFile", "file_id domain path size mtime mode flags")
+
+# Manifest.db flags
+FLAG_FILE = 1
+FLAG_DIRECTORY = 2
+FLAG_SYMLINK = 4
+
+
+class BackupIndexError(Exception):
+    pass
+
+
+def decode_file_blob(blob):
+    """
+    Return size, mtime and mode from the NSKeyedArchiver MBFile of a
+    Manifest.db row.
+    """
+    archive = plistlib.loads(blob)
+    objects = archive["$objects"]
+    top = archive["$top"]["root"]
+    f = objects[top.data if hasattr(top, "data") else top]
+    return f.get("Size", 0), f.get("LastModified", 0), f.get("Mode", 0)
+
+
+def read_mbdb_string(data, pos):
+    n, = unpack_from(">H", data, pos)
+    pos += 2
+    if n == 0xffff:
+        return None, pos
+    return data[pos:pos + n], pos + n
+
+
+class BackupIndex(object):
+    """
+    Index of the files of a MobileBackup2 backup directory (<path>/<udid>).
+
+    Maps (domain, relative path) to BackupFile records read from
+    Manifest.db (iOS 10 and later) or Manifest.mbdb. The parsed index is
+    saved next to the backup directory and reused as long as the manifest
+    keeps the same size and modification time.
+    """
+
+    def __init__(self, path, cache=True, cache_path=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = os.path.normpath(path)
+        self.cache_path = cache_path or self.path + ".index"
+        self.files = {}
+        self.flat = False
+        for name in ("Manifest.db", "Manifest.mbdb"):
+            self.manifest = os.path.join(self.path, name)
+            if os.path.exists(self.manifest):
+                break
+        else:
+            raise BackupIndexError("No Manifest.db or Manifest.mbdb in %s" % self.path)
+        self.load(cache)
+
+    def cache_key(self):
+        st = os.stat(self.manifest)
+        return (INDEX_VERSION, os.path.basename(self.manifest), st.st_size, st.st_mtime)
+
+    def load(self, cache=True):
+        key = self.cache_key()
+        if cache and os.path.exists(self.cache_path):
+            try:
+                cached_key, self.flat, files = load_pickle(self.cache_path)
+                if cached_key == key:
+                    files = [BackupFile(*f) for f in files]
+                    self.files = dict(((f.domain, f.path), f) for f in files)
+                    self.logger.debug("Loaded %d files from %s", len(self.files), self.cache_path)
+                    return
+            except Exception as e:
+                self.logger.warning("Ignoring index cache %s: %s", self.cache_path, e)
+        if self.manifest.endswith(".db"):
+            self.read_manifest_db()
+        else:
+            self.read_mbdb()
+        if cache:
+            # plain tuples keep the pickle independent of this module
+            save_pickle(self.cache_path, (key, self.flat, [tuple(f) for f in self.files.values()]))
+
+    def read_manifest_db(self):
+        self.flat = False
+        try:
+            db = sqlite3.connect("file:%s?mode=ro" % self.manifest, uri=True)
+            rows = db.execute("SELECT fileID, domain, relativePath, flags, file FROM Files")
+        except sqlite3.DatabaseError as e:
+            raise BackupIndexError("Cannot read %s (encrypted backup?): %s" % (self.manifest, e))
+        files = {}
+        for file_id, domain, path, flags, blob in rows:
+            size, mtime, mode = decode_file_blob(blob) if blob else (0, 0, 0)
+            files[(domain, path)] = BackupFile(file_id, domain, path, size, mtime, mode, flags)
+        db.close()
+        self.files = files
+
+    def read_mbdb(self):
+        self.flat = True
+        with open(self.manifest, "rb") as f:
+            data = f.read()
+        if data[:4] != b"mbdb":
+            raise BackupIndexError("Bad magic in %s" % self.manifest)
+        files = {}
+        pos = 6
+        while pos < len(data):
+            domain, pos = read_mbdb_string(data, pos)
+            path, pos = read_mbdb_string(data, pos)
+            for _ in range(3):
+                # link target, data hash, encryption key
+                _, pos = read_mbdb_string(data, pos)
+            # mode, inode, uid, gid, mtime, atime, ctime, size, protection class, properties
+            mode, mtime, size, nprops = unpack_from(">H16xL8xQxB", data, pos)
+            pos += 40
+            for _ in range(2 * nprops):
+                _, pos = read_mbdb_string(data, pos)
+            domain = domain.decode("utf-8")
+            path = path.decode("utf-8") if path else ""
+            file_id = hashlib.sha1((domain + "-" + path).encode("utf-8")).hexdigest()
+            kind = mode & 0o170000
+            flags = FLAG_DIRECTORY if kind == 0o040000 else FLAG_SYMLINK if kind == 0o120000 else FLAG_FILE
+            files[(domain, path)] = BackupFile(file_id, domain, path, size, mtime, mode, flags)
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files.values())
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def domains(self):
+        return sorted(set(domain for domain, path in self.files))
+
+    def lookup(self, domain, path):
+        return self.files.get((domain, path))
+
+    def glob(self, pattern="*", domain="*", files_only=True):
+        """
+        Return the entries whose path and domain match the shell patterns,
+        sorted by domain and path.
+        """
+        match_path = re.compile(fnmatch.translate(pattern)).match
+        match_domain = re.compile(fnmatch.translate(domain)).match
+        res = [f for f in self.files.values()
+               if match_domain(f.domain) and match_path(f.path) and (not files_only or f.flags == FLAG_FILE)]
+        res.sort(key=lambda f: (f.domain, f.path))
+        return res
+
+    def filename(self, entry):
+        if self.flat:
+            return os.path.join(self.path, entry.file_id)
+        return os.path.join(self.path, entry.file_id[:2], entry.file_id)
+
+    def open(self, entry):
+        return open(self.filename(entry), "rb")
+
+    def extract(self, entries, outpath, bufsize=BUFSIZE):
+        """
+        Copy entries to outpath/<domain>/<path>, yielding each entry and its
+        output filename. Files are copied chunk by chunk.
+        """
+        for entry in entries:
+            if entry.flags != FLAG_FILE:
+                continue
+            out = os.path.join(outpath, entry.domain, entry.path.lstrip("/"))
+            if ".." in out.split(os.sep):
+                raise BackupIndexError("Bad path in backup: %s %s" % (entry.domain, entry.path))
+            d = os.path.dirname(out)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            try:
+                src = self.open(entry)
+            except IOError:
+                self.logger.warning("Missing file %s for %s-%s", entry.file_id, entry.domain, entry.path)
+                continue
+            with src, open(out, "wb") as dst:
+                while True:
+                    data = src.read(bufsize)
+                    if not data:
+                        break
+                    dst.write(data)
+            if entry.mtime:
+                os.utime(out, (entry.mtime, entry.mtime))
+            yield entry, out
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] <backup directory>")
+    parser.add_option("-d", "--domain", dest="domain", default="*",
+                      help="domain pattern (default *)")
+    parser.add_option("-g", "--glob", dest="pattern", default="*",
+                      help="path pattern (default *)")
+    parser.add_option("-x", "--extract", dest="outpath", default=None,
+                      help="extract the matching files to OUTPATH")
+    parser.add_option("-D", "--domains", dest="domains", action="store_true", default=False,
+                      help="list the domains")
+    parser.add_option("-n", "--no-cache", dest="cache", action="store_false", default=True,
+                      help="do not read or write the index cache")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Incorrect number of arguments")
+
+    logging.basicConfig(level=logging.INFO)
+    index = BackupIndex(args[0], cache=options.cache)
+    if options.domains:
+        for domain in index.domains():
+            print(domain)
+        return
+    entries = index.glob(options.pattern, options.domain)
+    if options.outpath:
+        for entry, out in index.extract(entries, options.outpath):
+            print(out)
+    else:
+        for entry in entries:
+            print("%s %8s %s-%s" % (entry.file_id, sizeof_fmt(entry.size), entry.domain, entry.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,6 @@
 #
 import os
 import zlib
-import gzip
 import logging
 
 from pymobiledevice.lockdown import LockdownClient
@@ -33,7 +32,6 @@ from pymobiledevice.util import MultipleOption
 from pprint import pprint
 from tempfile import mkstemp
 from optparse import OptionParser
-from io import BytesIO
 
 SRCFILES = """Baseband
 CrashReporter
@@ -58,6 +56,55 @@ WirelessAutomation"""
 class DeviceVersionNotSupported(Exception):
     pass
 
+class GzipStreamReader(object):
+    """
+    Read-only file object decompressing a gzip stream on the fly from an
+    iterator of compressed chunks, e.g. FileRelay.iter_sources(). At most
+    bufsize decompressed bytes are kept in memory. Every compressed chunk
+    is also written to tee when given.
+    """
+
+    def __init__(self, chunks, tee=None, bufsize=1024*1024):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.bufsize = bufsize
+        self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        while not self.eof:
+            if self.z.unconsumed_tail:
+                data = self.z.unconsumed_tail
+            else:
+                data = next(self.chunks, None)
+                if data is None:
+                    self.buf, self.pos = self.z.flush(), 0
+                    self.eof = True
+                    break
+                if self.tee:
+                    self.tee.write(data)
+            self.buf = self.z.decompress(data, self.bufsize)
+            self.pos = 0
+            if self.buf:
+                return
+
+    def read(self, size=-1):
+        res = []
+        while size != 0:
+            if self.pos >= len(self.buf):
+                self.buf, self.pos = b"", 0
+                self.fill()
+                if self.pos >= len(self.buf):
+                    break
+            end = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+            res.append(self.buf[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b"".join(res)
+
 class FileRelay(object):
     def __init__(self, lockdown=None, serviceName="com.apple.mobile.file_relay",
                        udid=None, logger=None):
@@ -75,24 +122,52 @@ class FileRelay(object):
         self.logger.info("Disconecting...")
         self.service.close()
 
-    def request_sources(self, sources=["UserDatabases"]):
+    def iter_sources(self, sources=["UserDatabases"], bufsize=65536):
+        """
+        Yield the gzip compressed cpio archive as it is received.
+        """
         self.service.sendPlist({"Sources": sources})
         while 1:
             res = self.service.recvPlist()
             if res:
                 s = res.get("Status")
                 if s == "Acknowledged":
-                    z = ""
                     while True:
-                        x = self.service.recv()
+                        x = self.service.recv(bufsize)
                         if not x:
                             break
-                        z += x
-                    return z
+                        yield x
                 else:
                     print(res.get("Error"))
-                    break
-        return None
+                break
+
+    def request_sources(self, sources=["UserDatabases"]):
+        z = b"".join(self.iter_sources(sources))
+        return z if z else None
+
+    def dump_sources(self, sources, outputfile):
+        """
+        Write the compressed archive to outputfile, returns its size.
+        """
+        size = 0
+        with open(outputfile, "wb") as f:
+            for x in self.iter_sources(sources):
+                f.write(x)
+                size += len(x)
+        return size
+
+    def extract_sources(self, sources, outpath, outputfile=None):
+        """
+        Extract the archive to outpath while it is downloaded, optionally
+        keeping a copy of the compressed archive in outputfile.
+        """
+        tee = open(outputfile, "wb") if outputfile else None
+        try:
+            cpio = CpioArchive(fileobj=GzipStreamReader(self.iter_sources(sources), tee=tee))
+            cpio.extract_files(files=None, outpath=outpath)
+        finally:
+            if tee:
+                tee.close()
 
 def main():
     parser = OptionParser(option_class=MultipleOption,usage="%prog")
@@ -122,22 +197,18 @@ def main():
         print("Device with product vertion >= 8.0 does not allow access to fileRelay service")
         exit()
 
-    data = fc.request_sources(sources)
-
-    if data:
+    if options.extractpath:
+        fc.extract_sources(sources, options.extractpath, options.outputfile)
+        if options.outputfile:
+            print("Data saved to: %s" % options.outputfile)
+    else:
         if options.outputfile:
             path = options.outputfile
         else:
-            _,path = mkstemp(prefix="fileRelay_dump_",suffix=".gz",dir=".")
-
-        open(path,'wb').write(data)
-        self.logger.info("Data saved to:  %s ", path)
-
-    if options.extractpath:
-        with open(path, 'r') as f:
-            gz = gzip.GzipFile(mode='rb', fileobj=f)
-            cpio = CpioArchive(fileobj=BytesIO(gz.read()))
-            cpio.extract_files(files=None,outpath=options.extractpath)
+            fd, path = mkstemp(prefix="fileRelay_dump_",suffix=".gz",dir=".")
+            os.close(fd)
+        if fc.dump_sources(sources, path):
+            print("Data saved to: %s" % path)
 
 if __name__ == "__main__":
     main()
@@ -86,7 +86,7 @@ class LockdownClient(object):
         self.logger = logger or logging.getLogger(__name__)
         self.paired = False
         self.SessionID = None
-        self.c = PlistService(62078, udid)
+        self.c = PlistService(62078, udid, binary=False)
         self.hostID = self.generate_hostID()
         self.SystemBUID = self.generate_hostID()
         self.paired = False
@@ -108,7 +108,7 @@ class LockdownClient(object):
 
         if not self.validate_pairing():
             self.pair()
-            self.c = PlistService(62078, udid)
+            self.c = PlistService(62078, udid, binary=False)
             if not self.validate_pairing():
                 raise FatalPairingError
         self.paired = True
@@ -29,12 +29,14 @@ import os
 import datetime
 import logging
 import codecs
+from time import time as timestamp
 
 from six import PY3
 
 from pymobiledevice.lockdown import LockdownClient
 from pymobiledevice.afc import AFCClient
 from pymobiledevice.util import makedirs
+from pymobiledevice.util.diskwriter import DiskWriterPool
 from pymobiledevice.installation_proxy import installation_proxy
 
 #
@@ -59,20 +61,40 @@ DEVICE_LINK_FILE_STATUS_NONE = 0
 DEVICE_LINK_FILE_STATUS_HUNK = 1
 DEVICE_LINK_FILE_STATUS_LAST_HUNK = 2
 
+# files up to this size are buffered and written in batches
+SMALL_FILE_SIZE = 256*1024
+# pending data flushed by one batch write
+BATCH_SIZE = 4*1024*1024
+BATCH_FILES = 256
+
 class DeviceVersionNotSupported(Exception):
     def __str__(self):
         return "Device version not supported, please use mobilebackup2"
 
 
 class MobileBackup(object):
-    def __init__(self, lockdown=None, udid=None, logger=None):
+    writer = None
+    progress = None
+    def __init__(self, lockdown=None, udid=None, logger=None, writer_threads=2, backupPath=None):
         self.logger = logger or logging.getLogger(__name__)
+        self.backupPath = backupPath if backupPath else "backups"
+        if writer_threads:
+            # hunks are written and .mdinfo files generated while the device keeps sending
+            self.writer = DiskWriterPool(writer_threads, logger=self.logger)
         self.lockdown = lockdown if lockdown else LockdownClient(udid=udid)
         ProductVersion = self.lockdown.getValue("", "ProductVersion")
         if ProductVersion[0] >= "5":
             raise DeviceVersionNotSupported
         self.start()
 
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
     def start(self):
         self.service = self.lockdown.startService("com.apple.mobilebackup")
         self.udid = self.lockdown.udid
@@ -84,7 +106,6 @@ class MobileBackup(object):
             self.logger.info("Got DLMessageDeviceReady")
 
     def check_filename(self, name):
-        print(type(name), name)
         if PY3 and not isinstance(name, str):
            name = codecs.decode(name)
         if "../" in name:
@@ -172,6 +193,7 @@ class MobileBackup(object):
         "BackupMessageTypeKey": "BackupMessageBackupRequest",
         "BackupProtocolVersion": "1.6"
         }
+        makedirs(os.path.join(self.backupPath, self.udid))
         self.create_info_plist()
         self.device_link_service_send_process_message(req)
         res = self.device_link_service_receive_process_message()
@@ -182,31 +204,97 @@ class MobileBackup(object):
             return
         self.device_link_service_send_process_message(res)
 
-        filedata = ""
-        f = None
+        self.batch = []
+        self.batch_size = 0
+        hunks = []
+        size = 0
         outpath = None
+        spilled = False
         while True:
             res = self.service.recvPlist()
             if not res or res[0] != "DLSendFile":
-                if res[0] == "DLMessageProcessMessage":
+                if res and res[0] == "DLMessageProcessMessage":
                     if res[1].get("BackupMessageTypeKey") == "BackupMessageBackupFinished":
                         self.logger.info("Backup finished OK !")
                         #TODO BackupFilesToDeleteKey
-                        plistlib.writePlist(res[1]["BackupManifestKey"], self.check_filename("Manifest.plist"))
+                        self.flush_batch()
+                        self.flush_writes()
+                        self.write_file("Manifest.plist", plistlib.writePlistToString(res[1]["BackupManifestKey"]))
                 break
-            data = res[1].data
+            data = getattr(res[1], "data", res[1])
             info = res[2]
-            if not f:
+            if not outpath:
                 outpath = self.check_filename(info.get("DLFileDest"))
                 self.logger.debug("%s %s", info["DLFileAttributesKey"]["Filename"], info.get("DLFileDest"))
-                f = open(outpath + ".mddata", "wb")
-            f.write(data)
-            if info.get("DLFileStatusKey") == DEVICE_LINK_FILE_STATUS_LAST_HUNK:
+            hunks.append(data)
+            size += len(data)
+            last = info.get("DLFileStatusKey") == DEVICE_LINK_FILE_STATUS_LAST_HUNK
+            if size > SMALL_FILE_SIZE or (spilled and last):
+                # big file: its hunks go to the writer as they arrive
+                self.disk_op(outpath, self.write_hunks, outpath + ".mddata", hunks, spilled)
+                spilled = True
+                hunks = []
+                size = 0
+            if last:
+                # acknowledge right away, the device sends the next file while we write this one
                 self.send_file_received()
-                f.close()
-                if not info.get("BackupManifestKey", False):
-                    plistlib.writePlist(info.get("BackupFileInfo"), outpath + ".mdinfo")
-                f = None
+                mdinfo = None if info.get("BackupManifestKey", False) else info.get("BackupFileInfo")
+                if spilled:
+                    if mdinfo is not None:
+                        self.disk_op(outpath, self.write_mdinfo, outpath, mdinfo)
+                else:
+                    self.batch.append((outpath, hunks, mdinfo))
+                    self.batch_size += size
+                    if self.batch_size >= BATCH_SIZE or len(self.batch) >= BATCH_FILES:
+                        self.flush_batch()
+                hunks = []
+                size = 0
+                outpath = None
+                spilled = False
+        self.flush_batch()
+        self.flush_writes()
+
+    def disk_op(self, key, func, *args):
+        start = timestamp() if self.progress else None
+        if self.writer:
+            # time spent here is time the writer threads made us wait
+            self.writer.submit(key, func, *args)
+        else:
+            func(*args)
+        if start is not None:
+            self.progress.add_disk(timestamp() - start)
+
+    def flush_writes(self):
+        """
+        Wait for the writer threads, raising the first failed operation.
+        """
+        if self.writer:
+            start = timestamp()
+            errors = self.writer.barrier()
+            if self.progress:
+                self.progress.add_disk(timestamp() - start)
+            if errors:
+                raise errors[0][1]
+
+    def flush_batch(self):
+        if self.batch:
+            self.disk_op(self.batch[0][0], self.write_batch, self.batch)
+        self.batch = []
+        self.batch_size = 0
+
+    def write_hunks(self, filename, hunks, append=False):
+        with open(filename, "ab" if append else "wb") as f:
+            f.writelines(hunks)
+
+    def write_mdinfo(self, outpath, mdinfo):
+        with open(outpath + ".mdinfo", "wb") as f:
+            f.write(plistlib.writePlistToString(mdinfo))
+
+    def write_batch(self, batch):
+        for outpath, hunks, mdinfo in batch:
+            self.write_hunks(outpath + ".mddata", hunks)
+            if mdinfo is not None:
+                self.write_mdinfo(outpath, mdinfo)
 
 def main():
     logging.basicConfig(level=logging.INFO)
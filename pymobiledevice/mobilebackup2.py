@@ -24,17 +24,27 @@
 
 
 import os
+import sys
+import hashlib
+import shutil
 import datetime
 import plistlib
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
 from optparse import OptionParser
 from pprint import pprint
-from time import mktime, gmtime
-from pymobiledevice.util import write_file, hexdump
-from biplist import writePlist, readPlist, Data
+from pymobiledevice.util import hexdump, getHomePath, save_pickle, load_pickle
+from pymobiledevice.util.diskwriter import DiskWriterPool
+from pymobiledevice.util.blobstore import BlobStore
+from pymobiledevice.util.progress import BackupProgress
+from pymobiledevice.util.journal import BackupJournal
+from pymobiledevice.util.bplist import BPListWriter
+from biplist import readPlist, Data
 from struct import unpack, pack
-from time import mktime, gmtime, sleep, time
+from time import mktime, gmtime, sleep
+from time import time as timestamp
 from uuid import uuid4
 from stat import *
 
@@ -42,7 +52,7 @@ from pymobiledevice.afc import AFCClient
 from pymobiledevice.installation_proxy import installation_proxy
 from pymobiledevice.notification_proxy import *
 from pymobiledevice.sbservices import SBServiceClient
-from pymobiledevice.lockdown import LockdownClient
+from pymobiledevice.lockdown import LockdownClient, HOMEFOLDER
 from pymobiledevice.mobilebackup import MobileBackup
 
 from six import PY3
@@ -60,8 +70,25 @@ CODE_FILE_DATA = 0x0c
 ERROR_ENOENT = -6
 ERROR_EEXIST = -7
 
+# files being received are written next to their final location with this suffix
+PARTIAL_SUFFIX = ".partial"
+# journal of the files received by an interrupted backup, next to the udid directory
+JOURNAL_SUFFIX = ".journal"
+# size of the CODE_FILE_DATA frames sent to the device during restore
+SEND_CHUNK_SIZE = 32768
+
 LOCK_ATTEMPTS = 10
 
+ITUNES_FILES = ["ApertureAlbumPrefs", "IC-Info.sidb", "IC-Info.sidv", "PhotosFolderAlbums",
+                "PhotosFolderName", "PhotosFolderPrefs", "VoiceMemos.plist", "iPhotoAlbumPrefs",
+                "iTunesApplicationIDs", "iTunesPrefs", "iTunesPrefs.plist"]
+IBOOKS_DATA = "/Books/iBooksData2.plist"
+
+# files handled per job by the move/remove/copy thread pool
+IO_BATCH_SIZE = 256
+# minimum delay between two progress log lines of a batch operation
+LOG_INTERVAL = 2.0
+
 class DeviceVersionNotSupported(Exception):
     def __str__(self):
         return "Device version not supported, please use mobilebackup"
@@ -69,10 +96,32 @@ class DeviceVersionNotSupported(Exception):
 
 class MobileBackup2(MobileBackup):
     service = None
-    def __init__(self, lockdown = None,backupPath = None, password="", udid=None, logger=None):
+    writer = None
+    store = None
+    io_pool = None
+    progress = None
+    journal = None
+    resume = False
+    def __init__(self, lockdown = None,backupPath = None, password="", udid=None, logger=None,
+                 writer_threads=0, store=None, io_threads=4, progress=None, info_threads=4):
         self.logger = logger or logging.getLogger(__name__)
         self.backupPath = backupPath if backupPath else "backups"
         self.password = password
+        self.partials = {}
+        self.partial_hashes = {}
+        self.dir_cache = {}
+        self.session_complete = False
+        self.io_threads = io_threads
+        self.info_threads = info_threads
+        if writer_threads:
+            # received files are written by a pool of threads while the main thread reads the device
+            self.writer = DiskWriterPool(writer_threads, logger=self.logger)
+        if store:
+            # backup files are deduplicated in a content addressed store shared by several devices
+            self.store = store if isinstance(store, BlobStore) else BlobStore(store, logger=self.logger)
+        if progress:
+            # a BackupProgress, or a callback receiving its progress events
+            self.progress = progress if isinstance(progress, BackupProgress) else BackupProgress(progress)
         self.lockdown = lockdown if lockdown else LockdownClient(udid=udid)
         if not self.lockdown:
             raise Exception("Unable to start lockdown")
@@ -112,6 +161,13 @@ class MobileBackup2(MobileBackup):
     def __del__(self):
         if self.service:
             self.service.sendPlist(["DLMessageDisconnect", "___EmptyParameterString___"])
+        self.close()
+
+    def close(self):
+        super(MobileBackup2, self).close()
+        if self.io_pool:
+            self.io_pool.shutdown()
+            self.io_pool = None
 
     def internal_mobilebackup2_send_message(self, name, data):
         data["MessageName"] = name
@@ -149,6 +205,8 @@ class MobileBackup2(MobileBackup):
     def mb2_handle_free_disk_space(self,msg):
         s = os.statvfs(self.backupPath)
         freeSpace = s.f_bsize * s.f_bavail
+        if self.progress:
+            self.progress.set_free_space(freeSpace)
         res = ["DLMessageStatusResponse", 0, "___EmptyParameterString___", freeSpace]
         self.service.sendPlist(res)
 
@@ -158,26 +216,89 @@ class MobileBackup2(MobileBackup):
     def mb2_handle_copy_item(self, msg):
         src = self.check_filename(msg[1])
         dst = self.check_filename(msg[2])
-        if os.path.isfile(src):
-            data = self.read_file(src)
-            self.write_file(dst, data)
+        self.logger.debug("Copying %s to %s", src, dst)
+        if os.path.isdir(src):
+            self.copy_tree(src, dst)
+            self.dir_cache.clear()
+        elif os.path.isfile(src):
+            self.copy_file(src, dst)
+            self.invalidate_dir_cache(dst)
         else:
             os.makedirs(dst)
+            self.dir_cache.clear()
         self.mobilebackup2_send_status_response(0)
 
+    def copy_tree(self, src, dst):
+        """
+        Copy the directory src into dst, merging with what dst already holds.
+        """
+        for root, dirs, files in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in files:
+                self.copy_file(os.path.join(root, name), os.path.join(target, name))
+
+    def copy_file(self, src, dst):
+        if self.store:
+            # same content, same blob: link it instead of copying the data
+            self.store.link(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+        return dst
+
+    def run_batched(self, func, items):
+        """
+        Call func on every item, in batches of IO_BATCH_SIZE dispatched to a
+        pool of io_threads threads. Returns the exceptions raised, in order.
+        """
+        def run(batch):
+            errors = []
+            for item in batch:
+                try:
+                    func(item)
+                except Exception as e:
+                    errors.append(e)
+            return errors
+
+        batches = [items[i:i + IO_BATCH_SIZE] for i in range(0, len(items), IO_BATCH_SIZE)]
+        if self.io_threads < 2 or len(batches) < 2:
+            results = [run(batch) for batch in batches]
+        else:
+            if not self.io_pool:
+                self.io_pool = ThreadPoolExecutor(max_workers=self.io_threads)
+            results = list(self.io_pool.map(run, batches))
+        done = 0
+        errors = []
+        for batch, batch_errors in zip(batches, results):
+            done += len(batch)
+            errors.extend(batch_errors)
+            self.log_progress("%s: %d/%d files", func.__name__, done, len(items))
+        return errors
+
+    def log_progress(self, fmt, *args):
+        now = timestamp()
+        if now - getattr(self, "last_progress_log", 0) >= LOG_INTERVAL:
+            self.last_progress_log = now
+            self.logger.info(fmt, *args)
+
     def mb2_handle_send_file(self, filename, errplist):
         self.service.send_raw(filename)
         if not filename.startswith(self.udid):
             filename = self.udid + "/" + filename
 
-        data = self.read_file(self.check_filename(filename))
-        if data != None:
+        path = self.check_filename(filename)
+        if os.path.isfile(path):
             self.logger.info("Sending %s to device", filename)
-            if PY3: # FIXME
-                msg = b"".join([(CODE_FILE_DATA).to_bytes(1,'little'), data])
-            else:
-                msg = chr(CODE_FILE_DATA) + data
-            self.service.send_raw(msg)
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    length = min(size - offset, SEND_CHUNK_SIZE)
+                    self.service.send(pack(">LB", length + 1, CODE_FILE_DATA))
+                    if self.service.sendfile(f, offset, length) != length:
+                        raise Exception("Sending %s to device failed" % filename)
+                    offset += length
             self.service.send_raw(chr(CODE_SUCCESS))
         else:
             self.logger.warn("File %s requested from device not found", filename)
@@ -201,91 +322,233 @@ class MobileBackup2(MobileBackup):
     def mb2_handle_list_directory(self, msg):
         path = msg[1]
         self.logger.info("List directory: %s" % path)
-        dirlist = {}
         if path.find("../") != -1:
-            raise Exception("HAX, sneaky dots in path %s" % name)
-        for root, dirs, files in os.walk(os.path.join(self.backupPath, path)):
-            for fname in files:
-                fpath = os.path.join(root, fname)
-                finfo = {}
-                st = os.stat(fpath)
+            raise Exception("HAX, sneaky dots in path %s" % path)
+        dirpath = os.path.normpath(os.path.join(self.backupPath, path))
+        dirlist = self.dir_cache.get(dirpath)
+        if dirlist is None:
+            dirlist = self.list_directory(dirpath)
+            self.dir_cache[dirpath] = dirlist
+        self.mobilebackup2_send_status_response(0, status2=dirlist);
+
+    def list_directory(self, dirpath):
+        """
+        List one directory level, using the stat information cached by scandir.
+        """
+        dirlist = {}
+        if not os.path.isdir(dirpath):
+            return dirlist
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.name.endswith(PARTIAL_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # dangling symbolic link, or removed since it was listed
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
                 ftype = "DLFileTypeUnknown"
                 if S_ISDIR(st.st_mode):
                     ftype = "DLFileTypeDirectory"
                 elif S_ISREG(st.st_mode):
                     ftype = "DLFileTypeRegular"
-                finfo["DLFileType"]  = ftype
-                finfo["DLFileSize"]  = st.st_size
-                finfo["DLFileModificationDate"] = st.st_mtime
-                dirlist[fname] = finfo
-        self.mobilebackup2_send_status_response(0, status2=dirlist);
+                dirlist[entry.name] = {"DLFileType": ftype,
+                                       "DLFileSize": st.st_size,
+                                       "DLFileModificationDate": st.st_mtime}
+        return dirlist
+
+    def invalidate_dir_cache(self, *paths):
+        for path in paths:
+            self.dir_cache.pop(os.path.normpath(os.path.dirname(path)), None)
 
     def mb2_handle_make_directory(self, msg):
         dirname = self.check_filename(msg[1])
         self.logger.info("Creating directory %s", dirname)
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
+            self.dir_cache.clear()
         self.mobilebackup2_send_status_response(0, "")
 
     def mb2_handle_receive_files(self, msg):
-        done = 0
-        while not done:
-            device_filename = self.service.recv_raw()
-            if device_filename == "":
+        while True:
+            device_filename = self.mb2_recv_raw()
+            if not device_filename:
                 break
-            backup_filename = self.service.recv_raw()
+            backup_filename = self.mb2_recv_raw()
             self.logger.debug("Downloading: %s to %s", device_filename, backup_filename)
-            filedata = ""
-            if PY3:
-                filedata = bytearray(b"")
-            last_code = 0x00
+            if not self.mb2_receive_file(device_filename, backup_filename):
+                break
+        self.flush_writes()
+        self.mobilebackup2_send_status_response(0)
+
+    def mb2_receive_file(self, device_filename, backup_filename):
+        """
+        Stream the CODE_FILE_DATA chunks of one file to a temporary file that
+        is renamed over the backup file on CODE_SUCCESS.
+        Returns False if the connection was lost.
+        """
+        filename = self.check_filename(backup_filename)
+        partial = filename + PARTIAL_SUFFIX
+        self.disk_op(filename, self.partial_open, partial)
+        try:
             while True:
-                stuff = self.service.recv_raw()
+                stuff = self.mb2_recv_raw()
+                if not stuff:
+                    self.disk_op(filename, self.partial_discard, partial)
+                    return False
                 if PY3:
                     code = stuff[0]
                 else:
                     code = ord(stuff[0])
                 if code == CODE_FILE_DATA:
-                    filedata = stuff[1:]
-                elif code == CODE_SUCCESS:
-                    self.write_file(self.check_filename(backup_filename), filedata)
-                    break
-                elif code == CODE_ERROR_REMOTE:
-                      if last_code != CODE_FILE_DATA:
-                        self.logger.warn("Received an error message from device: %s for:\n\t%s\n\t[%s]",
-                                ord(code), device_filename, backup_filename)
+                    self.disk_op(filename, self.partial_write, partial, memoryview(stuff)[1:])
+                    continue
+                if code == CODE_SUCCESS:
+                    self.disk_op(filename, self.partial_commit, partial, filename)
+                    if self.progress:
+                        self.progress.file_received()
+                    return True
+                if code == CODE_ERROR_REMOTE:
+                    self.logger.warn("Received an error message from device: %s for:\n\t%s\n\t[%s]",
+                                     stuff[1:], device_filename, backup_filename)
                 else:
                     self.logger.warn("Unknown code: %s for:\n\t%s\n\t[%s]",
-                                        code, device_filename, backup_filename)
-                    self.logger.warn(msg)
-                    #break
-            last_code = code
-        self.mobilebackup2_send_status_response(0)
+                                     code, device_filename, backup_filename)
+                self.disk_op(filename, self.partial_discard, partial)
+                return True
+        except:
+            self.disk_op(filename, self.partial_discard, partial)
+            raise
+
+    def mb2_recv_raw(self):
+        if not self.progress:
+            return self.service.recv_raw()
+        start = timestamp()
+        data = self.service.recv_raw()
+        self.progress.add_network(timestamp() - start, len(data) if data else 0)
+        return data
+
+    def partial_open(self, partial):
+        self.partials[partial] = self.store.open(partial) if self.store else open(partial, "wb")
+        if self.journal is not None:
+            self.partial_hashes[partial] = [hashlib.new(self.journal.algorithm), 0]
+
+    def partial_write(self, partial, data):
+        self.partials[partial].write(data)
+        h = self.partial_hashes.get(partial)
+        if h:
+            h[0].update(data)
+            h[1] += len(data)
+
+    def partial_commit(self, partial, filename):
+        h = self.partial_hashes.pop(partial, None)
+        if h:
+            path = os.path.relpath(filename, self.backupPath)
+            size, digest = h[1], h[0].hexdigest()
+            if self.resume and self.journal.get(path) == (size, digest) \
+                    and os.path.isfile(filename) and os.path.getsize(filename) == size:
+                # already received before the interruption, keep that copy
+                self.logger.debug("Skipping unchanged %s", filename)
+                self.partial_discard(partial)
+                return
+            self.journal.add(path, size, digest)
+        f = self.partials.pop(partial)
+        if self.store:
+            f.commit(filename)
+        else:
+            f.close()
+            os.replace(partial, filename)
+        self.invalidate_dir_cache(filename)
+
+    def partial_discard(self, partial):
+        self.partial_hashes.pop(partial, None)
+        f = self.partials.pop(partial, None)
+        if f:
+            f.close()
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+    def write_file(self, filename, data):
+        if self.store:
+            self.store.write(self.check_filename(filename), data)
+        else:
+            super(MobileBackup2, self).write_file(filename, data)
+        self.invalidate_dir_cache(self.check_filename(filename))
 
     def mb2_handle_move_files(self, msg):
         self.logger.info("Moving %d files", len(msg[1]) )
-        for k,v in msg[1].items():
-            self.logger.info("Renaming:\n\t%s \n\tto %s", self.check_filename(k), self.check_filename(v))
-            os.rename(self.check_filename(k),self.check_filename(v))
+        moves = [(self.check_filename(k), self.check_filename(v)) for k, v in msg[1].items()]
+        sources = set(k for k, v in moves)
+        destinations = set(v for k, v in moves)
+        if sources & destinations or len(destinations) != len(moves) or \
+                self.has_nested_paths(sources | destinations):
+            # chained, conflicting or nested moves must run in the order given by the device
+            errors = []
+            for move in moves:
+                self.move_file(move)
+        else:
+            errors = self.run_batched(self.move_file, moves)
+        for k, v in moves:
+            self.invalidate_dir_cache(k, v)
+        if errors:
+            raise errors[0]
         self.mobilebackup2_send_status_response(0)
 
+    def has_nested_paths(self, paths):
+        """
+        Return True if one of paths is inside another one, e.g. the move of a
+        directory and the move of a file it contains.
+        """
+        paths = set(os.path.normpath(p) for p in paths)
+        for p in paths:
+            parent = os.path.dirname(p)
+            while parent and parent != p:
+                if parent in paths:
+                    return True
+                p, parent = parent, os.path.dirname(parent)
+        return False
+
+    def move_file(self, move):
+        self.logger.debug("Renaming:\n\t%s \n\tto %s", move[0], move[1])
+        os.replace(move[0], move[1])
+
     def mb2_handle_remove_files(self, msg):
         self.logger.info("Removing %d files", len(msg[1]) )
-        for filename in msg[1]:
-            self.logger.info("Removing %s", self.check_filename(filename))
-            try:
-                filename = self.check_filename(filename)
-                if os.path.isfile(filename):
-                    os.unlink(filename)
-            except Exception as e:
-                self.logger.error(e)
+        filenames = [self.check_filename(filename) for filename in msg[1]]
+        for e in self.run_batched(self.remove_file, filenames):
+            self.logger.error(e)
+        # removed directories may have cached listings of their own
+        self.dir_cache.clear()
         self.mobilebackup2_send_status_response(0)
 
+    def remove_file(self, filename):
+        self.logger.debug("Removing %s", filename)
+        if os.path.isdir(filename) and not os.path.islink(filename):
+            shutil.rmtree(filename)
+        elif os.path.lexists(filename):
+            os.unlink(filename)
+
     def work_loop(self):
+        self.session_complete = False
+        if self.progress:
+            self.progress.start()
+        try:
+            self.mb2_work_loop()
+        finally:
+            if self.progress:
+                self.progress.finish()
+
+    def mb2_work_loop(self):
+        self.dir_cache = {}
         while True:
             msg = self.mobilebackup2_receive_message()
             if not msg:
                 break
+            if self.progress:
+                self.progress.device_message(msg)
 
             assert(msg[0] in ["DLMessageDownloadFiles",
                     "DLContentsOfDirectory",
@@ -315,6 +578,7 @@ class MobileBackup2(MobileBackup):
             elif msg[0] == "DLMessageProcessMessage":
                 errcode = msg[1].get("ErrorCode")
                 if errcode == 0:
+                    self.session_complete = True
                     m =  msg[1].get("MessageName")
                     if m != "Response":
                         self.logger.warn(m)
@@ -350,7 +614,7 @@ class MobileBackup2(MobileBackup):
                    'Date': datetime.datetime.fromtimestamp(mktime(gmtime())),
                    'SnapshotState': 'finished'
                  }
-        writePlist(statusDict,self.check_filename("Status.plist"))
+        self.write_file("Status.plist", BPListWriter(statusDict).binary())
 
 #    def set_sync_lock(self):
 #        #do_post_notification(device, NP_SYNC_WILL_START);
@@ -387,7 +651,7 @@ class MobileBackup2(MobileBackup):
         # Get a list of installed user applications
         instpxy = installation_proxy(self.lockdown)
         apps = instpxy.browse({"ApplicationType":"User"},
-                              ["CFBundleIdentifier", "ApplicationSINF", "iTunesMetadata"])
+                              ["CFBundleIdentifier", "CFBundleVersion", "ApplicationSINF", "iTunesMetadata"])
         # Create new info.plits
         info = {"BuildVersion": device_info.get("BuildVersion") or "",
                 "DeviceName":  device_info.get("DeviceName") or "",
@@ -409,16 +673,17 @@ class MobileBackup2(MobileBackup):
         info["IMEI"] = device_info.get("InternationalMobileEquipmentIdentity") or ""
         info["Last Backup Date"] = datetime.datetime.now()
 
-        # Starting SpringBoard service to retrieve icons position
-        self.sbs = SBServiceClient(self.lockdown)
+        # Fetch the icons and the iTunes files on several service connections
         installed_apps = []
         apps_data = {}
+        icons = self.get_icons([(app_entry.get("CFBundleIdentifier"), app_entry.get("CFBundleVersion"))
+                                for app_entry in apps if app_entry.get("CFBundleIdentifier")])
         for app_entry in apps:
             tmp = {}
             bid = app_entry.get("CFBundleIdentifier")
             if bid:
                 installed_apps.append(bid)
-                pngdata = self.sbs.get_icon_pngdata(bid)
+                pngdata = icons.get(bid)
                 if pngdata:
                     tmp["PlaceholderIcon"] = pngdata
                 tmp["iTunesMetadata"] = app_entry.get("iTunesMetadata")
@@ -428,19 +693,17 @@ class MobileBackup2(MobileBackup):
         info["Applications"] = apps_data
         info["Installed Applications"] = installed_apps
         # Handling itunes files
-        iTunesFiles = [ "ApertureAlbumPrefs", "IC-Info.sidb", "IC-Info.sidv", "PhotosFolderAlbums",
-		                "PhotosFolderName", "PhotosFolderPrefs", "VoiceMemos.plist", "iPhotoAlbumPrefs",
-		                "iTunesApplicationIDs", "iTunesPrefs", "iTunesPrefs.plist" ]
+        files = self.get_files(["/iTunes_Control/iTunes/" + i for i in ITUNES_FILES] + [IBOOKS_DATA])
         iTunesFilesDict = {}
-        for i in iTunesFiles:
-            data = self.afc.get_file_contents("/iTunes_Control/iTunes/"  + i)
+        for i in ITUNES_FILES:
+            data = files.get("/iTunes_Control/iTunes/" + i)
             if data:
-                iTunesFilesDict[i] = plistlib.Data(data)
+                iTunesFilesDict[i] = data if PY3 else plistlib.Data(data)
 
         info["iTunesFiles"] = iTunesFilesDict
-        iBooksData2 = self.afc.get_file_contents("/Books/iBooksData2.plist")
+        iBooksData2 = files.get(IBOOKS_DATA)
         if iBooksData2:
-            info["iBooks Data 2"] = plistlib.Data(iBooksData2)
+            info["iBooks Data 2"] = iBooksData2 if PY3 else plistlib.Data(iBooksData2)
 
         info["iTunes Settings"] = self.lockdown.getValue("com.apple.iTunes")
         self.logger.info("Creating %s", os.path.join(self.udid,"Info.plist"))
@@ -448,16 +711,136 @@ class MobileBackup2(MobileBackup):
         self.write_file(os.path.join(self.udid,"Info.plist"), plist_data)
 
 
-    def backup(self,fullBackup=True):
+    def run_on_clients(self, clients, func, items):
+        """
+        Call func(client, item) for every item, each client handling its
+        share of the items on its own thread. Returns a dict item -> result.
+        """
+        shares = [items[i::len(clients)] for i in range(len(clients))]
+
+        def run(client, share):
+            return [(item, func(client, item)) for item in share]
+
+        if len(clients) == 1:
+            return dict(run(clients[0], shares[0]))
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            for res in pool.map(run, clients, shares):
+                results.update(res)
+        return results
+
+    def get_icons(self, apps):
+        """
+        Return the icons of the (bundle id, version) in apps, reusing the ones
+        cached by the previous backups of the device.
+        """
+        cache_path = getHomePath(HOMEFOLDER, "%s_icons.pickle" % self.udid)
+        try:
+            cache = load_pickle(cache_path)
+        except Exception:
+            cache = {}
+        # failed fetches are never cached, caches written before may hold None
+        missing = [app for app in apps if not cache.get(app)]
+        if missing:
+            self.logger.info("Fetching %d icons (%d cached)", len(missing), len(apps) - len(missing))
+            # the services are started from this thread, lockdown is not thread safe
+            clients = [SBServiceClient(self.lockdown)
+                       for _ in range(max(1, min(self.info_threads, len(missing))))]
+            fetched = self.run_on_clients(clients, lambda sbs, app: sbs.get_icon_pngdata(app[0]), missing)
+            cache.update((app, pngdata) for app, pngdata in fetched.items() if pngdata)
+            for sbs in clients:
+                sbs.service.close()
+        # forget the icons of uninstalled or updated applications
+        icons = dict((app, cache[app]) for app in apps if app in cache)
+        if missing or len(icons) != len(cache):
+            save_pickle(cache_path, icons)
+        return dict((app[0], pngdata) for app, pngdata in icons.items())
+
+    def get_files(self, filenames):
+        """
+        Return the content of the device files, None for missing ones.
+        """
+        # self.afc is kept for the sync lock, the other connections are closed afterwards
+        clients = [self.afc] + [AFCClient(self.lockdown)
+                                for _ in range(max(0, min(self.info_threads, len(filenames)) - 1))]
+        try:
+            return self.run_on_clients(clients, lambda afc, filename: afc.get_file_contents(filename), filenames)
+        finally:
+            for afc in clients[1:]:
+                afc.service.close()
+
+    def backup(self,fullBackup=True, resume=False, journal=False):
+        """
+        Back up the device. With journal, the path, size and digest of every
+        received file is recorded until the backup ends, which costs a hash
+        of every byte. With resume, the journal of a backup interrupted
+        before its end is loaded and the device is asked for an incremental
+        backup of the existing tree. The device still sends every file it
+        decides to send: resume restores the checkpoint state, it does not
+        avoid transfers.
+        """
         #TODO set_sync_lock
         self.logger.info("Starting %s backup...", ("Encrypted " if self.willEncrypt else ""))
         if not os.path.isdir(os.path.join(self.backupPath,self.udid)):
             os.makedirs(os.path.join(self.backupPath,self.udid))
+        self.journal = None
+        self.resume = False
+        if journal or resume:
+            fullBackup = self.open_journal(fullBackup, resume)
         self.logger.info("Backup mode: %s", "Full backup" if fullBackup else "Incremental backup")
-        self.create_info_plist()
-        options = {"ForceFullBackup": fullBackup}
-        self.mobilebackup2_send_request("Backup", self.udid, options)
-        self.work_loop()
+        try:
+            self.create_info_plist()
+            options = {"ForceFullBackup": fullBackup}
+            self.mobilebackup2_send_request("Backup", self.udid, options)
+            self.work_loop()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+        if self.journal is None:
+            return
+        if self.session_complete:
+            self.journal.remove()
+        else:
+            self.logger.warning("Backup interrupted after %d files, it can be resumed", len(self.journal))
+
+    def open_journal(self, fullBackup, resume):
+        """
+        Start the journal of received files, loading the one of the
+        interrupted session to resume. Returns the backup mode to request.
+        """
+        self.journal = BackupJournal(os.path.join(self.backupPath, self.udid + JOURNAL_SUFFIX),
+                                     logger=self.logger)
+        self.resume = False
+        if os.path.exists(self.journal.path):
+            # the previous journaled backup was interrupted
+            self.remove_partials()
+        status_path = os.path.join(self.backupPath, self.udid, "Status.plist")
+        if resume and self.journal.load():
+            if os.path.exists(status_path):
+                with open(status_path, "rb") as f:
+                    status = plistlib.readPlist(f)
+                self.logger.info("Resuming backup (%s, %s): %d files already received",
+                                 status.get("BackupState"), status.get("SnapshotState"), len(self.journal))
+                self.resume = True
+                fullBackup = False
+            else:
+                self.logger.warning("No Status.plist, cannot resume the previous backup")
+        if not self.resume:
+            self.journal.remove()
+        self.journal.start(full=fullBackup)
+        return fullBackup
+
+    def remove_partials(self):
+        """
+        Remove the temporary files left by an interrupted transfer. This walks
+        the whole backup, it is only done when the journal shows the previous
+        backup was interrupted. Otherwise the leftovers are hidden from the
+        device and overwritten when the file is sent again.
+        """
+        for root, dirs, files in os.walk(os.path.join(self.backupPath, self.udid)):
+            for name in files:
+                if name.endswith(PARTIAL_SUFFIX):
+                    os.unlink(os.path.join(root, name))
 
 
     def restore(self, options = {"RestoreSystemFiles": True,
@@ -534,14 +917,31 @@ def main():
                   help="Show backup info")
     parser.add_option("-p", "--path", dest="path", action="store", default=False,
                   help="path to backup/restore to")
+    parser.add_option("-w", "--writer-threads", dest="writer_threads", action="store", type="int", default=0,
+                  help="write received files with WRITER_THREADS threads")
+    parser.add_option("-s", "--store", dest="store", action="store", default=None,
+                  help="deduplicate backup files in the STORE directory (must be on the backup filesystem)")
+    parser.add_option("-j", "--io-threads", dest="io_threads", action="store", type="int", default=4,
+                  help="move, remove and copy files with IO_THREADS threads")
+    parser.add_option("-P", "--progress", dest="progress", action="store", default=None,
+                  help="write progress events as JSON lines to PROGRESS ('-' for stdout)")
+    parser.add_option("--journal", dest="journal", action="store_true", default=False,
+                  help="journal received files (hashing them) so that an interrupted backup can be resumed")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                  help="resume the state of an interrupted journaled backup (files are still transferred)")
     (options, args) = parser.parse_args()
 
 
     logging.basicConfig(level=logging.INFO)
+    progress = None
+    if options.progress:
+        stream = sys.stdout if options.progress == "-" else open(options.progress, "a")
+        progress = BackupProgress(stream=stream)
     lockdown = LockdownClient(options.device_udid)
-    mb = MobileBackup2(lockdown, options.path)
+    mb = MobileBackup2(lockdown, options.path, writer_threads=options.writer_threads, store=options.store,
+                       io_threads=options.io_threads, progress=progress)
     if options.backup:
-        mb.backup(fullBackup=False)
+        mb.backup(fullBackup=False, resume=options.resume, journal=options.journal)
     elif options.restore:
         mb.restore()
     elif options.info:
@@ -23,7 +23,12 @@
 #
 from __future__ import print_function
 from six import PY3
+import os
+import re
+import shutil
+import signal
 import struct
+import threading
 import time
 import sys
 import logging
@@ -54,11 +59,28 @@ typedef struct pcaprec_hdr_s {
 LINKTYPE_ETHERNET = 1
 LINKTYPE_RAW      = 101
 
+"""
+struct pcapd_hdr {
+        uint32  hdrsize;              /* header size, including interface name */
+        uint8   version;
+        uint32  packet_size;          /* size of the packet following the header */
+        uint32  flags1;
+        uint32  flags2;
+        uint32  offset_to_ip_data;    /* 0 for pdp packets without link header */
+        uint32  zero;
+        char    interface[];          /* NUL padded */
+} (big endian)
+"""
+PCAPD_HEADER = struct.Struct(">LBLLLLL")
+FAKE_ETHERNET_HEADER = b"\xBE\xEF" * 6 + b"\x08\x00"
+
+PCAP_HEADER = struct.pack("<LHHLLLL", 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET)
+
 class PcapOut(object):
 
     def __init__(self, pipename=r'test.pcap'):
         self.pipe = open(pipename,'wb')
-        self.pipe.write(struct.pack("<LHHLLLL", 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        self.pipe.write(PCAP_HEADER)
 
     def __del__(self):
         self.pipe.close()
@@ -82,7 +104,7 @@ class Win32Pipe(object):
                                            None)
         print("Connect wireshark to %s" % pipename)
         win32pipe.ConnectNamedPipe(self.pipe, None)
-        win32file.WriteFile(self.pipe, struct.pack("<LHHLLLL", 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        win32file.WriteFile(self.pipe, PCAP_HEADER)
 
     def writePacket(self, packet):
         t = time.time()
@@ -90,6 +112,219 @@ class Win32Pipe(object):
         errCode, nBytesWritten = win32file.WriteFile(self.pipe, pkthdr + packet)
         return errCode == 0
 
+class PcapRingBuffer(object):
+    """
+    Continuous capture into a ring of `count` pcap files of at most `size`
+    bytes each, the oldest file being overwritten once the ring is full.
+    freeze() snapshots the ring (oldest file first) into a new directory so
+    that the packets preceding an event survive later rotations.
+    """
+
+    def __init__(self, path=r'ring.pcap', count=8, size=16*1024*1024, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.base, self.ext = os.path.splitext(path)
+        self.ext = self.ext or ".pcap"
+        self.count = max(count, 1)
+        self.size = max(size, len(PCAP_HEADER) + 16 + 65535)
+        self.lock = threading.Lock()
+        self.pipe = None
+        self.seq = -1
+        self.freezes = 0
+        self.rotate()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.pipe:
+                self.pipe.close()
+                self.pipe = None
+
+    def slot_path(self, seq):
+        return "%s.%d%s" % (self.base, seq % self.count, self.ext)
+
+    def rotate(self):
+        if self.pipe:
+            self.pipe.close()
+        self.seq += 1
+        path = self.slot_path(self.seq)
+        # a new file rather than a truncated one, frozen snapshots may link the old one
+        if os.path.exists(path):
+            os.unlink(path)
+        self.pipe = open(path, 'wb')
+        self.pipe.write(PCAP_HEADER)
+        self.written = len(PCAP_HEADER)
+
+    def writePacket(self, packet):
+        t = time.time()
+        pkthdr = struct.pack('<LLLL', int(t), int(t*1000000 % 1000000), len(packet), len(packet))
+        with self.lock:
+            if self.pipe is None:
+                return False
+            if self.written + len(pkthdr) + len(packet) > self.size:
+                self.rotate()
+            self.pipe.write(pkthdr)
+            self.pipe.write(packet)
+            self.written += len(pkthdr) + len(packet)
+        return True
+
+    def freeze(self, reason=None):
+        """
+        Snapshot the current ring content to <path>.frozen-<timestamp>-<n>/
+        and return the snapshot directory. Slots are hard linked, then the
+        current file is closed by a rotation: rotations create new files and
+        never rewrite the linked ones.
+        """
+        copies = []
+        with self.lock:
+            self.freezes += 1
+            outdir = "%s.frozen-%s-%d" % (self.base, time.strftime("%Y%m%d%H%M%S"), self.freezes)
+            os.makedirs(outdir)
+            if self.pipe:
+                self.pipe.flush()
+            first = max(self.seq - self.count + 1, 0)
+            for i, seq in enumerate(range(first, self.seq + 1)):
+                src = self.slot_path(seq)
+                dst = os.path.join(outdir, "%03d%s" % (i, self.ext))
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    # keep the file open, the copy is done without the lock
+                    copies.append((open(src, "rb"), dst))
+            if self.pipe:
+                self.rotate()
+        for f, dst in copies:
+            with f, open(dst, "wb") as out:
+                shutil.copyfileobj(f, out)
+        self.logger.info("Ring buffer frozen to %s%s", outdir, (" (%s)" % reason) if reason else "")
+        return outdir
+
+class SyslogTrigger(threading.Thread):
+    """
+    Watch the device syslog and call `callback(line)` for every line matching
+    `regex`, e.g. to freeze a PcapRingBuffer when an error is logged.
+    """
+
+    def __init__(self, lockdown, regex, callback, logger=None):
+        super(SyslogTrigger, self).__init__()
+        self.daemon = True
+        self.logger = logger or logging.getLogger(__name__)
+        self.regex = re.compile(regex)
+        self.callback = callback
+        self.service = lockdown.startService("com.apple.syslog_relay")
+        self.service.send(b"watch" if PY3 else "watch")
+
+    def run(self):
+        pending = b""
+        while True:
+            d = self.service.recv(4096)
+            if not d:
+                break
+            lines = (pending + d).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.replace(b"\x00", b"").decode("utf-8", "replace")
+                if self.regex.search(line):
+                    self.callback(line)
+
+class Packet(object):
+    """
+    A packet received from com.apple.pcapd. `payload` is a memoryview on the
+    received buffer, use frame() to get a link layer frame suitable for a
+    LINKTYPE_ETHERNET pcap.
+    """
+    __slots__ = ("version", "flags1", "flags2", "offset_to_ip_data",
+                 "interface", "timestamp", "payload")
+
+    def __init__(self, version, flags1, flags2, offset_to_ip_data, interface, timestamp, payload):
+        self.version = version
+        self.flags1 = flags1
+        self.flags2 = flags2
+        self.offset_to_ip_data = offset_to_ip_data
+        self.interface = interface
+        self.timestamp = timestamp
+        self.payload = payload
+
+    def __len__(self):
+        return len(self.payload)
+
+    def __repr__(self):
+        return "<Packet %s %d bytes>" % (self.interface, len(self.payload))
+
+    def frame(self):
+        if self.offset_to_ip_data == 0:
+            #add fake ethernet header for pdp packets
+            return b"".join((FAKE_ETHERNET_HEADER, self.payload))
+        return self.payload
+
+def parse_packet(data, timestamp=None):
+    """
+    Parse one pcapd record without copying the packet data.
+    """
+    view = memoryview(data)
+    hdrsize, version, packet_size, flags1, flags2, offset_to_ip_data, _ = PCAPD_HEADER.unpack_from(view)
+    if hdrsize < PCAPD_HEADER.size or hdrsize > len(view):
+        raise ValueError("Invalid pcapd header size %d" % hdrsize)
+    payload = view[hdrsize:]
+    if packet_size != len(payload):
+        raise ValueError("Invalid pcapd packet size %d (%d bytes received)" % (packet_size, len(payload)))
+    interface = view[PCAPD_HEADER.size:hdrsize].tobytes().strip(b"\x00").decode("ascii", "replace")
+    return Packet(version, flags1, flags2, offset_to_ip_data, interface,
+                  timestamp if timestamp is not None else time.time(), payload)
+
+class HexdumpOut(object):
+
+    def writePacket(self, packet):
+        print(len(packet), time.time())
+        hexdump(bytes(packet))
+        return True
+
+class PcapdClient(object):
+    """
+    Iterate over the packets captured by com.apple.pcapd:
+
+        for packet in PcapdClient(lockdown):
+            ...
+
+    or forward them to sinks implementing writePacket(frame) such as
+    PcapOut, Win32Pipe or PcapRingBuffer with capture().
+    """
+
+    def __init__(self, lockdown=None, serviceName="com.apple.pcapd", service=None, udid=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.lockdown = lockdown if lockdown else LockdownClient(udid=udid)
+        self.service = service if service else self.lockdown.startService(serviceName)
+
+    def close(self):
+        self.service.close()
+
+    def __iter__(self):
+        while True:
+            d = self.service.recvPlist()
+            if not d:
+                break
+            if not PY3:
+                d = d.data
+            yield parse_packet(d)
+
+    def capture(self, sinks, count=None):
+        """
+        Write packet frames to every sink until one of them fails, the
+        service is closed or `count` packets have been captured.
+        Returns the number of captured packets.
+        """
+        n = 0
+        for packet in self:
+            frame = packet.frame()
+            for sink in sinks:
+                if not sink.writePacket(frame):
+                    return n
+            n += 1
+            if count and n >= count:
+                break
+        return n
+
 def main():
     if sys.platform == "darwin":
             print("Why not use rvictl ?")
@@ -100,54 +335,43 @@ def main():
                   help="Device udid")
     parser.add_option("-o", "--output", dest="output", default=False,
                   help="Output location", type="string")
+    parser.add_option("-r", "--ring", dest="ring", default=0,
+                  help="Capture into a ring buffer of RING files", type="int")
+    parser.add_option("-s", "--ring-size", dest="ring_size", default=16,
+                  help="Size of each ring buffer file in MB (default 16)", type="int")
+    parser.add_option("-t", "--trigger", dest="trigger", default=False,
+                  help="Freeze the ring buffer when a syslog line matches TRIGGER", type="string")
 
     (options, args) = parser.parse_args()
-    if sys.platform == "win32":
+    if options.trigger and not options.ring:
+        parser.error("--trigger requires --ring")
+    if options.ring and not options.output:
+        parser.error("Ring buffer capture requires an output location")
+
+    if sys.platform == "win32" and not options.ring:
         import win32pipe, win32file
         output = Win32Pipe()
 
     else:
         if options.output:
             path = options.output
-            output = PcapOut(path)
+            if options.ring:
+                output = PcapRingBuffer(path, options.ring, options.ring_size * 1024 * 1024)
+                print("Recording data to ring buffer: %s (%d x %d MB)" % (path, options.ring, options.ring_size))
+                if hasattr(signal, "SIGUSR1"):
+                    # the handler runs on the capture thread which may hold the ring lock
+                    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+                        target=output.freeze, args=("SIGUSR1",)).start())
+            else:
+                output = PcapOut(path)
             print("Recording data to: %s" % path)
 
     logging.basicConfig(level=logging.INFO)
     lockdown = LockdownClient(options.device_udid)
-    pcap = lockdown.startService("com.apple.pcapd")
-
-    while True:
-        d = pcap.recvPlist()
-        if not d:
-            break
-        if not PY3:
-            d = d.data
-        hdrsize, xxx, packet_size = struct.unpack(">LBL", d[:9])
-        flags1, flags2, offset_to_ip_data, zero = struct.unpack(">LLLL", d[9:0x19])
-
-        assert hdrsize >= 0x19
-        if PY3:
-            interfacetype= d[0x19:hdrsize].strip(b"\x00")
-        else:
-            interfacetype= d[0x19:hdrsize].strip("\x00")
-            interfacetype = "b'"+"\\x".join("{:02x}".format(ord(c)) for c in interfacetype)+"'"
-        t = time.time()
-        packet = d[hdrsize:]
-        assert packet_size == len(packet)
-
-        if offset_to_ip_data == 0:
-            #add fake ethernet header for pdp packets
-            if PY3:
-                packet = b"\xBE\xEF" * 6 + b"\x08\x00" + packet
-            else:
-                packet = "\xBE\xEF" * 6 + "\x08\x00" + packet
-        
-        if options.output:
-            if not output.writePacket(packet):
-                break
-        else:
-            print(packet_size, t)
-            hexdump(packet)
+    if options.ring and options.trigger:
+        SyslogTrigger(lockdown, options.trigger, output.freeze).start()
+    pcap = PcapdClient(lockdown)
+    pcap.capture([output if options.output else HexdumpOut()])
 
 
 if __name__ == "__main__":
@@ -27,21 +27,51 @@ import ssl
 import struct
 import logging
 import codecs
-from re import sub
+import re
 from six import PY3
 
 from pymobiledevice.usbmux import usbmux
+from pymobiledevice.util.bplist import BPlistReader, BPListWriter
 
 if PY3:
     plistlib.readPlistFromString = plistlib.loads
     plistlib.writePlistToString = plistlib.dumps
 
+BPLIST_HEADER = b"bplist00"
+XML_HEADER = b"<?xml"
+#HAX lockdown HardwarePlatform with null bytes
+XML_CONTROL_CHARS = re.compile(b"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def encode_plist(d, binary=True):
+    """
+    Serialize d as a binary plist, or as XML if binary is False.
+    """
+    if binary:
+        return BPListWriter(d).binary()
+    return plistlib.writePlistToString(d)
+
+
+def decode_plist(payload):
+    if payload.startswith(BPLIST_HEADER):
+        return BPlistReader(payload).parse()
+    elif payload.startswith(XML_HEADER):
+        try:
+            return plistlib.readPlistFromString(payload)
+        except Exception:
+            # only scrub the payload when the parser chokes on it
+            return plistlib.readPlistFromString(XML_CONTROL_CHARS.sub(b"", payload))
+    else:
+        raise Exception("recvPlist invalid data : %s" % codecs.encode(payload[:100], "hex"))
+
 
 class PlistService(object):
 
-    def __init__(self, port, udid=None, logger=None):
+    def __init__(self, port, udid=None, logger=None, binary=True):
         self.logger = logger or logging.getLogger(__name__)
         self.port = port
+        # send binary plists unless the service only accepts XML
+        self.binary = binary
         self.connect(udid)
 
     def connect(self, udid=None):
@@ -78,6 +108,29 @@ class PlistService(object):
             return -1
         return 0
 
+    def sendfile(self, f, offset=0, count=None, bufsize=65536):
+        """
+        Send count bytes of file f starting at offset, using sendfile(2)
+        when the socket allows it. Returns the number of bytes sent.
+        """
+        try:
+            if hasattr(self.s, "sendfile"):
+                return self.s.sendfile(f, offset, count)
+            f.seek(offset)
+            buf = bytearray(bufsize)
+            view = memoryview(buf)
+            sent = 0
+            while count is None or sent < count:
+                n = f.readinto(buf if count is None or count - sent >= bufsize else view[:count - sent])
+                if not n:
+                    break
+                self.s.sendall(view[:n])
+                sent += n
+            return sent
+        except:
+            self.logger.error("Sending file to device failled")
+            return -1
+
     def sendRequest(self, data):
         res = None
         if self.sendPlist(data) >= 0:
@@ -115,26 +168,10 @@ class PlistService(object):
         payload = self.recv_raw()
         if not payload:
             return
-        bplist_header = "bplist00"
-        xml_header = "<?xml"
-        if PY3:
-            bplist_header = b"bplist00"
-            xml_header = b"<?xml"
-        if payload.startswith(bplist_header):
-            if PY3:
-                return plistlib.readPlistFromString(payload)
-            else:
-                from pymobiledevice.util.bplist import BPlistReader
-                return BPlistReader(payload).parse()
-        elif payload.startswith(xml_header):
-            #HAX lockdown HardwarePlatform with null bytes
-            payload = sub('[^\w<>\/ \-_0-9\"\'\\=\.\?\!\+]+','', payload.decode('utf-8')).encode('utf-8')
-            return plistlib.readPlistFromString(payload)
-        else:
-            raise Exception("recvPlist invalid data : %s" % payload[:100].encode("hex"))
+        return decode_plist(payload)
 
     def sendPlist(self, d):
-        payload = plistlib.writePlistToString(d)
+        payload = encode_plist(d, self.binary)
         l = struct.pack(">L", len(payload))
         return self.send(l + payload)
 
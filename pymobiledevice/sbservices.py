@@ -49,9 +49,8 @@ class SBServiceClient(object):
 
         self.service.sendPlist(cmd)
         res = self.service.recvPlist()
-        pngdata = res.get("pngData")
         if res:
-            return pngdata
+            return res.get("pngData")
         return None
 
     def get_interface_orientation(self):
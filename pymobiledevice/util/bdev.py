@@ -1,11 +1,87 @@
 import os
 import sys
+import mmap
+from collections import OrderedDict
 from util import sizeof_fmt, hexdump
 from progressbar import ProgressBar
 from crypto.aes import AESdecryptCBC, AESencryptCBC
 
-class FileBlockDevice(object):
-    def __init__(self, filename, offset=0, write=False):
+BLOCK_CACHE_SIZE = 1024 #blocks
+READAHEAD_BLOCKS = 16
+
+class BlockDevice(object):
+    """
+    Block cache shared by the block devices: the last cacheSize blocks read
+    are kept in LRU order, and a read following the previous block also
+    fetches the next readahead blocks in one go. Subclasses implement
+    _readBlocks(first, count) returning a list of at most count blocks.
+    """
+    def initCache(self, cacheSize=BLOCK_CACHE_SIZE, readahead=READAHEAD_BLOCKS):
+        self.cacheSize = cacheSize
+        self.readahead = readahead
+        self.clearCache()
+
+    def clearCache(self):
+        self.cache = OrderedDict()
+        self.lastBlock = None
+
+    def invalidateBlocks(self, first, count=1):
+        for blockNum in range(first, first + count):
+            self.cache.pop(blockNum, None)
+
+    def readBlock(self, blockNum):
+        data = self.cache.pop(blockNum, None)
+        if data is None:
+            count = 1
+            if self.cacheSize and self.lastBlock is not None and blockNum == self.lastBlock + 1:
+                count = max(1, self.readahead)
+            blocks = self._readBlocks(blockNum, count)
+            data = blocks[0]
+            #the block following this one ends up the most recent of the readahead
+            for i in range(len(blocks) - 1, 0, -1):
+                self.cacheBlock(blockNum + i, blocks[i])
+        self.cacheBlock(blockNum, data)
+        self.lastBlock = blockNum
+        return data
+
+    def cacheBlock(self, blockNum, data):
+        if not self.cacheSize:
+            return
+        self.cache.pop(blockNum, None)
+        self.cache[blockNum] = data
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+    def openMmap(self, useMmap):
+        self.mmap = None
+        if useMmap and self.size:
+            access = mmap.ACCESS_WRITE if self.writeFlag else mmap.ACCESS_READ
+            self.mmap = mmap.mmap(self.fd, 0, access=access)
+
+    def readAt(self, offset, size):
+        if self.mmap is not None:
+            return self.mmap[offset:offset+size]
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.read(self.fd, size)
+
+    def writeAt(self, offset, data):
+        if self.mmap is not None and offset + len(data) <= len(self.mmap):
+            self.mmap[offset:offset+len(data)] = data
+            return len(data)
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self.fd, data, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.write(self.fd, data)
+
+    def splitBlocks(self, data, count):
+        bs = self.blockSize
+        return [data[i*bs:(i+1)*bs] for i in range(min(count, (len(data) + bs - 1) // bs))]
+
+class FileBlockDevice(BlockDevice):
+    def __init__(self, filename, offset=0, write=False, useMmap=False,
+                 cacheSize=BLOCK_CACHE_SIZE, readahead=READAHEAD_BLOCKS):
         flag = os.O_RDONLY if not write else os.O_RDWR
         if sys.platform == 'win32':
             flag = flag | os.O_BINARY
@@ -14,55 +90,71 @@ class FileBlockDevice(object):
         self.offset = offset
         self.writeFlag = write
         self.size = os.path.getsize(filename)
+        self.openMmap(useMmap)
+        self.initCache(cacheSize, readahead)
         self.setBlockSize(8192)
         
     def setBlockSize(self, bs):
         self.blockSize = bs
-        self.nBlocks = self.size / bs
-        
-    def readBlock(self, blockNum):
-        os.lseek(self.fd, self.offset + self.blockSize * blockNum, os.SEEK_SET)
-        return os.read(self.fd, self.blockSize)
+        self.nBlocks = self.size // bs
+        self.clearCache()
+
+    def _readBlocks(self, first, count):
+        data = self.readAt(self.offset + self.blockSize * first, self.blockSize * count)
+        return self.splitBlocks(data, count) or [data]
 
     def write(self, offset, data):
         if self.writeFlag: #fail silently for testing 
-            os.lseek(self.fd, self.offset + offset, os.SEEK_SET)
-            return os.write(self.fd, data)
+            first = offset // self.blockSize
+            self.invalidateBlocks(first, (offset + len(data) - 1) // self.blockSize - first + 1)
+            return self.writeAt(self.offset + offset, data)
 
     def writeBlock(self, lba, block):
         return self.write(lba*self.blockSize, block)
 
-class FTLBlockDevice(object):
-    def __init__(self, nand, first_lba, last_lba, defaultKey=None):
+class FTLBlockDevice(BlockDevice):
+    def __init__(self, nand, first_lba, last_lba, defaultKey=None,
+                 cacheSize=BLOCK_CACHE_SIZE, readahead=READAHEAD_BLOCKS):
         self.nand = nand
         self.pageSize = nand.pageSize
         self.blockSize = 0 #not used
         self.key = defaultKey
         self.lbaoffset = first_lba
         self.last_lba = last_lba
+        self.initCache(cacheSize, readahead)
         self.setBlockSize(self.pageSize)
         
     def setBlockSize(self, bs):
         self.blockSize = bs
-        self.lbasPerPage = self.pageSize / bs
+        self.lbasPerPage = self.pageSize // bs
         self.lbaToLpnFactor = bs / (self.pageSize+0.0)
-        self.pagesPerLBA = bs / self.pageSize
+        self.pagesPerLBA = bs // self.pageSize
         if bs > self.pageSize:
             pass#raise Exception("FTLBlockDevice lba-size > pageSize not handled")
-        
-    def readBlock(self, blockNum):
+        self.clearCache()
+
+    def _readBlocks(self, first, count):
         #if (self.lbaoffset + blockNum / self.lbasPerPage) > self.last_lba:
         #    print "readBlock past last lba", blockNum
         #    print "readBlock past last lba", blockNum
         #    return "\x00" * self.blockSize
-        lpn = int(self.lbaoffset + blockNum * self.lbaToLpnFactor)
-        d = self.nand.readLPN(lpn, self.key)
-        for i in range(1, self.pagesPerLBA):
-            d += self.nand.readLPN(lpn + i, self.key)
-        if self.lbasPerPage:
-            zz = blockNum % self.lbasPerPage
-            return d[zz*self.blockSize:(zz+1)*self.blockSize]
-        return d
+        #blocks sharing a page are cut from a single readLPN
+        pages = {}
+        blocks = []
+        for blockNum in range(first, first + count):
+            lpn = int(self.lbaoffset + blockNum * self.lbaToLpnFactor)
+            if blockNum != first and lpn >= self.last_lba:
+                break
+            if lpn not in pages:
+                pages[lpn] = self.nand.readLPN(lpn, self.key)
+            d = pages[lpn]
+            for i in range(1, self.pagesPerLBA):
+                d += self.nand.readLPN(lpn + i, self.key)
+            if self.lbasPerPage:
+                zz = blockNum % self.lbasPerPage
+                d = d[zz*self.blockSize:(zz+1)*self.blockSize]
+            blocks.append(d)
+        return blocks
 
     def write(self, offset, data):
         raise Exception("FTLBlockDevice write method not implemented")
@@ -89,8 +181,9 @@ class FTLBlockDevice(object):
         pbar.finish()
         os.close(fd)
 
-class IMG3BlockDevice(object):
-    def __init__(self, filename, key, iv, write=False):
+class IMG3BlockDevice(BlockDevice):
+    def __init__(self, filename, key, iv, write=False, useMmap=False,
+                 cacheSize=BLOCK_CACHE_SIZE, readahead=READAHEAD_BLOCKS):
         flag = os.O_RDONLY if not write else os.O_RDWR
         if sys.platform == 'win32':
             flag = flag | os.O_BINARY
@@ -98,41 +191,49 @@ class IMG3BlockDevice(object):
         self.fd = os.open(filename, flag)
         self.writeFlag = write
         d = os.read(self.fd, 8192)
-        if d[:4] != "3gmI":
+        if d[:4] != b"3gmI":
             raise Exception("IMG3BlockDevice bad magic %s" % d[:4])
-        if d[0x34:0x38] != "ATAD":
+        if d[0x34:0x38] != b"ATAD":
             raise Exception("Fu")
         self.encrypted = True
         self.key = key
         self.iv0 = iv
         self.offset = 0x40
         self.size = os.path.getsize(filename)
+        self.openMmap(useMmap)
+        self.initCache(cacheSize, readahead)
         self.setBlockSize(8192)
         
     def setBlockSize(self, bs):
         self.blockSize = bs
-        self.nBlocks = self.size / bs
-        self.ivs = {0: self.iv0}
+        self.nBlocks = self.size // bs
+        self.clearCache()
     
     def getIVforBlock(self, blockNum):
         #read last 16 bytes of previous block to get IV
-        if blockNum not in self.ivs:
-            os.lseek(self.fd, self.offset + self.blockSize *
-                     blockNum - 16, os.SEEK_SET)
-            self.ivs[blockNum] = os.read(self.fd, 16)
-        return self.ivs[blockNum]
+        if blockNum == 0:
+            return self.iv0
+        return self.readAt(self.offset + self.blockSize * blockNum - 16, 16)
 
-    def readBlock(self, blockNum):
-        os.lseek(self.fd, self.offset + self.blockSize * blockNum, os.SEEK_SET)
-        data = os.read(self.fd, self.blockSize)
-        if self.encrypted:
-            data = AESdecryptCBC(data, self.key, self.getIVforBlock(blockNum))
-        return data
+    def _readBlocks(self, first, count):
+        #the IV is read along with the blocks, and as CBC chains across
+        #blocks the whole run is decrypted at once
+        start = self.offset + self.blockSize * first
+        if first == 0 or not self.encrypted:
+            iv, data = self.iv0, self.readAt(start, self.blockSize * count)
+        else:
+            data = self.readAt(start - 16, self.blockSize * count + 16)
+            iv, data = data[:16], data[16:]
+        if self.encrypted and data:
+            data = AESdecryptCBC(data, self.key, iv)
+        return self.splitBlocks(data, count) or [data]
 
     def _write(self, offset, data):
         if self.writeFlag: #fail silently for testing 
-            os.lseek(self.fd, self.offset + offset, os.SEEK_SET)
-            return os.write(self.fd, data)
+            first = offset // self.blockSize
+            #the next block IV changes with the last bytes written
+            self.invalidateBlocks(first, (offset + len(data) - 1) // self.blockSize - first + 2)
+            return self.writeAt(self.offset + offset, data)
 
     def writeBlock(self, lba, data):
         if self.encrypted:
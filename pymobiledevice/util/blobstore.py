@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# $Id$
+#
+# Copyright (c) 2012-2023 "dark[-at-]gotohack.org"
+#
+# This file is part of pymobiledevice
+#
+# pymobiledevice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from io import BytesIO
+
+
+class BlobStore(object):
+    """
+    Content addressed file store shared by several backup trees.
+
+    Every file committed to the store is kept once under
+    <root>/<digest[:2]>/<digest> and hard linked at its location in the
+    backup tree, so the trees keep the layout the device expects while
+    identical files only use disk space once. Blobs are read-only: files
+    in a tree must be replaced (BlobStore.write/commit or os.replace),
+    never rewritten in place.
+    """
+
+    def __init__(self, root, algorithm="sha1", inline_size=256*1024, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.root = root
+        self.algorithm = algorithm
+        self.inline_size = inline_size
+        self.linkable = True
+        if not os.path.isdir(root):
+            os.makedirs(root, 0o0755)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def open(self, partial):
+        """
+        Return a BlobWriter for a file that will be committed to the tree.
+        Small files are buffered in memory and never written to disk if the
+        store already contains them, bigger ones are spilled to `partial`.
+        """
+        return BlobWriter(self, partial)
+
+    def write(self, filename, data):
+        w = self.open(filename + ".blob")
+        w.write(data)
+        w.commit(filename)
+
+    def add(self, digest, filename, source=None, data=None):
+        """
+        Store the content of source (a file which is moved into the store)
+        or data under digest if needed, then link it to filename.
+        """
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            self.logger.debug("Deduplicated %s (%s)", filename, digest)
+            if source:
+                os.unlink(source)
+        else:
+            d = os.path.dirname(blob)
+            os.makedirs(d, 0o0755, exist_ok=True)
+            # writer threads may commit the same content at the same time
+            fd, tmp = tempfile.mkstemp(prefix=digest, suffix=".tmp", dir=d)
+            try:
+                if source:
+                    os.close(fd)
+                    try:
+                        os.replace(source, tmp)
+                    except OSError as e:
+                        if e.errno != errno.EXDEV:
+                            raise
+                        shutil.move(source, tmp)
+                else:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                os.chmod(tmp, 0o0444)
+                self.publish(tmp, blob)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        self.link(blob, filename)
+
+    def publish(self, tmp, blob):
+        """
+        Move tmp to blob unless another writer published it first, in which
+        case tmp is left for the caller to remove.
+        """
+        try:
+            os.link(tmp, blob)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                self.logger.debug("Blob %s already published", blob)
+                return
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+                raise
+            os.replace(tmp, blob)
+
+    def link(self, blob, filename):
+        tmp = filename + ".link"
+        if self.linkable:
+            try:
+                os.link(blob, tmp)
+                os.replace(tmp, filename)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                if e.errno != errno.EMLINK:
+                    self.logger.warning("Cannot link %s to the blob store (%s), copying files", filename, e)
+                    self.linkable = False
+        shutil.copyfile(blob, tmp)
+        os.replace(tmp, filename)
+
+    def gc(self):
+        """
+        Remove the blobs which are no longer linked from any backup tree,
+        returns the number of removed blobs.
+        """
+        removed = 0
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+
+class BlobWriter(object):
+
+    def __init__(self, store, partial):
+        self.store = store
+        self.partial = partial
+        self.hash = hashlib.new(store.algorithm)
+        self.buf = BytesIO()
+        self.f = None
+
+    def write(self, data):
+        self.hash.update(data)
+        if self.f:
+            self.f.write(data)
+            return
+        self.buf.write(data)
+        if self.buf.tell() > self.store.inline_size:
+            self.f = open(self.partial, "wb")
+            self.f.write(self.buf.getvalue())
+            self.buf = None
+
+    def commit(self, filename):
+        digest = self.hash.hexdigest()
+        if self.f:
+            self.f.close()
+            self.store.add(digest, filename, source=self.partial)
+        else:
+            self.store.add(digest, filename, data=self.buf.getvalue())
+        return digest
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            if os.path.exists(self.partial):
+                os.unlink(self.partial)
@@ -1,57 +1,139 @@
-from bsdiff import Patch
 import os, sys
 import bz2
-from array import array
+import mmap
 import struct
-from six import StringIO
 
-def patch(old_file_name, new_file_name, patch_file_name):
+BSDIFF_MAGIC = b"BSDIFF40"
+HEADER_SIZE = 32
+CHUNK_SIZE = 1 << 20
 
-    patch_file = open(patch_file_name, "rb")
-    patch_file.read(8) #magic number
 
-    compressed_control_len = offtin(patch_file.read(8))
-    compressed_diff_len = offtin(patch_file.read(8))
-    new_file_len = offtin(patch_file.read(8))
+class BZ2BlockReader(object):
+    """
+    Reads the bz2 compressed block at offset in f, decompressing it as it
+    is consumed so that at most a read and an input chunk are in memory.
+    """
 
-    compressed_control_block = patch_file.read(compressed_control_len)
-    compressed_diff_block    = patch_file.read(compressed_diff_len)
-    compressed_extra_block   = patch_file.read()
+    def __init__(self, f, offset, length, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.decompressor = bz2.BZ2Decompressor()
 
-    control_stream = StringIO(bz2.decompress(compressed_control_block))
-    diff_string    = bz2.decompress(compressed_diff_block)
-    extra_string   = bz2.decompress(compressed_extra_block)
+    def _input(self):
+        if self.remaining is not None and self.remaining <= 0:
+            return b""
+        size = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+        self.f.seek(self.offset)
+        data = self.f.read(size)
+        self.offset += len(data)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
 
-    control_tuples_list = []
-    while True:
-        r = control_stream.read(8)
-        if not r:
-            break
-        x = offtin(r)
-        y = offtin(control_stream.read(8))
-        z = offtin(control_stream.read(8))
-        control_tuples_list.append((x,y,z))
+    def read(self, n):
+        out = []
+        while n > 0 and not self.decompressor.eof:
+            data = b""
+            if self.decompressor.needs_input:
+                data = self._input()
+                if not data:
+                    break
+            chunk = self.decompressor.decompress(data, n)
+            out.append(chunk)
+            n -= len(chunk)
+        return b"".join(out)
 
-    old_data = open(old_file_name, "rb").read()
-    new_data = Patch(old_data, new_file_len, control_tuples_list, diff_string, extra_string)
+    def read_exact(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise ValueError("bpatch: corrupt patch, truncated block")
+        return data
 
-    new_file = open(new_file_name, "wb")
-    new_file.write(new_data)
 
-def offtin(buf):
-    s = ord(buf[7])
-    y = (s & 0x7F) << 56
-    y += ord(buf[6]) << 48
-    y += ord(buf[5]) << 40
-    y += ord(buf[4]) << 32
-    y += ord(buf[3]) << 24
-    y += ord(buf[2]) << 16
-    y += ord(buf[1]) << 8
-    y += ord(buf[0])
-
-    if (s & 0x80):
-        y = -y
+def add_bytes(a, b):
+    """Bytewise addition modulo 256 of two equal length byte strings,
+       computed on big integers 8 bits lanes at a time (SWAR)"""
+    n = len(a)
+    if not n:
+        return b""
+    low = int.from_bytes(b"\x7f" * n, "little")
+    high = int.from_bytes(b"\x80" * n, "little")
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    # add the low 7 bits of each lane without carry into the next lane,
+    # then fold the high bits back in with a xor
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, "little")
+
+
+def open_old(old_file):
+    """Maps the old file in memory, empty files can not be mapped"""
+    if os.fstat(old_file.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def patch(old_file_name, new_file_name, patch_file_name, chunk_size=CHUNK_SIZE):
+
+    with open(patch_file_name, "rb") as patch_file, open(old_file_name, "rb") as old_file:
+        header = patch_file.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE or header[:8] != BSDIFF_MAGIC:
+            raise ValueError("bpatch: %s is not a bsdiff patch" % patch_file_name)
+
+        compressed_control_len = offtin(header[8:16])
+        compressed_diff_len = offtin(header[16:24])
+        new_file_len = offtin(header[24:32])
+        if compressed_control_len < 0 or compressed_diff_len < 0 or new_file_len < 0:
+            raise ValueError("bpatch: corrupt patch header")
 
+        # the three blocks are read through their own decompressors
+        control_stream = BZ2BlockReader(patch_file, HEADER_SIZE, compressed_control_len)
+        diff_stream = BZ2BlockReader(patch_file, HEADER_SIZE + compressed_control_len,
+                                     compressed_diff_len, chunk_size)
+        extra_stream = BZ2BlockReader(patch_file, HEADER_SIZE + compressed_control_len + compressed_diff_len,
+                                      None, chunk_size)
+
+        old_data = open_old(old_file)
+        old_len = len(old_data)
+        try:
+            with open(new_file_name, "wb") as new_file:
+                old_pos, new_pos = 0, 0
+                while new_pos < new_file_len:
+                    control = control_stream.read_exact(24)
+                    x, y, z = offtin(control[0:8]), offtin(control[8:16]), offtin(control[16:24])
+                    if x < 0 or y < 0 or new_pos + x + y > new_file_len:
+                        raise ValueError("bpatch: corrupt patch, control block out of range")
+
+                    # add x bytes of the old file to the diff block
+                    while x > 0:
+                        n = min(x, chunk_size)
+                        diff = diff_stream.read_exact(n)
+                        # old bytes outside of the old file count as zeroes
+                        start, end = max(old_pos, 0), min(old_pos + n, old_len)
+                        if start < end:
+                            diff = diff[:start - old_pos] + add_bytes(old_data[start:end], diff[start - old_pos:end - old_pos]) + diff[end - old_pos:]
+                        new_file.write(diff)
+                        old_pos += n
+                        new_pos += n
+                        x -= n
+
+                    # then copy y bytes of the extra block
+                    while y > 0:
+                        n = min(y, chunk_size)
+                        new_file.write(extra_stream.read_exact(n))
+                        new_pos += n
+                        y -= n
+
+                    old_pos += z
+        finally:
+            if isinstance(old_data, mmap.mmap):
+                old_data.close()
+
+def offtin(buf):
+    y = struct.unpack("<Q", buf)[0]
+    if y & (1 << 63):
+        y = -(y & ~(1 << 63))
     return y
 
 
@@ -63,4 +145,3 @@ if __name__ == '__main__':
 		new_file_name   = sys.argv[2]
 		patch_file_name = sys.argv[3]
 		patch(old_file_name, new_file_name, patch_file_name)
-
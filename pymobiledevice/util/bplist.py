@@ -1,82 +1,259 @@
 """
 http://github.com/farcaller/bplist-python/blob/master/bplist.py
 """
+import mmap
 import struct
 import plistlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
-class BPListWriter(object):
-    def __init__(self, objects):
-        self.bplist = ""
-        self.objects = objects
+from six import PY3, integer_types, text_type
 
-    def binary(self):
-        '''binary -> string
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 
-        Generates bplist
-        '''
-        self.data = 'bplist00'
+APPLE_EPOCH = datetime(year=2001,month=1,day=1)
+UINT_FORMATS = {1: "B", 2: "H", 4: "L", 8: "Q"}
+
+if PY3:
+    def Data(data):
+        return data
+    UID = plistlib.UID
+else:
+    Data = plistlib.Data
+    UID = plistlib.Data
 
-        # TODO: flatten objects and count max length size
+def _uint_size(n):
+    '''_uint_size(n) -> int
 
-        # TODO: write objects and save offsets
+    Smallest of 1, 2, 4 or 8 bytes holding the unsigned integer n
+    '''
+    if n < 1 << 8:
+        return 1
+    if n < 1 << 16:
+        return 2
+    if n < 1 << 32:
+        return 4
+    return 8
 
-        # TODO: write offsets
 
-        # TODO: write metadata
+class BPListWriter(object):
+    """
+    Binary plist serializer.
+
+    Strings, numbers, dates and data are uniqued by value and containers by
+    identity, references and offsets use the smallest integer size that
+    fits, and the object graph is flattened with an explicit stack so deep
+    structures do not hit the recursion limit.
+    """
+    def __init__(self, objects, sort_keys=True):
+        self.bplist = b""
+        self.objects = objects
+        self.sort_keys = sort_keys
+
+    def __flatten(self):
+        '''__flatten() -> list
+
+        Numbers the objects reachable from the root, in depth-first order,
+        and returns them with their children references
+        '''
+        table = []      # (kind, value, children) indexed by object number
+        scalars = {}    # (type, value) -> object number
+        containers = {} # id(container) -> object number
+
+        def ref(v):
+            # subclasses such as OrderedDict are containers too
+            if isinstance(v, dict):
+                t = dict
+            elif isinstance(v, (list, tuple)):
+                t = list
+            elif isinstance(v, (set, frozenset)):
+                t = set
+            else:
+                t = None
+            if t is not None:
+                idx = containers.get(id(v))
+                if idx is None:
+                    idx = containers[id(v)] = len(table)
+                    table.append([t, v, None])
+                    stack.append(idx)
+                return idx
+            t = type(v)
+            if not PY3 and t is plistlib.Data:
+                key = (t, v.data)
+            elif t is bytearray:
+                key = (t, bytes(v))
+            else:
+                key = (t, v)
+            try:
+                idx = scalars.get(key)
+            except TypeError:
+                # unhashable values are not uniqued
+                key, idx = None, None
+            if idx is None:
+                idx = len(table)
+                if key is not None:
+                    scalars[key] = idx
+                table.append([t, v, None])
+            return idx
+
+        stack = []
+        ref(self.objects)
+        while stack:
+            entry = table[stack.pop()]
+            t, v = entry[0], entry[1]
+            if t is dict:
+                keys = sorted(v) if self.sort_keys else list(v)
+                entry[2] = [ref(k) for k in keys] + [ref(v[k]) for k in keys]
+            else:
+                entry[2] = [ref(i) for i in v]
+        return table
+
+    def __encodeCount(self, marker, count):
+        if count < 15:
+            return struct.pack(">B", marker | count)
+        return struct.pack(">B", marker | 0x0F) + self.__encodeInt(count)
+
+    def __encodeInt(self, v):
+        if v < 0:
+            return struct.pack(">Bq", 0x13, v)
+        if v < 1 << 8:
+            return struct.pack(">BB", 0x10, v)
+        if v < 1 << 16:
+            return struct.pack(">BH", 0x11, v)
+        if v < 1 << 32:
+            return struct.pack(">BL", 0x12, v)
+        if v < 1 << 63:
+            return struct.pack(">Bq", 0x13, v)
+        if v < 1 << 64:
+            return struct.pack(">BqQ", 0x14, 0, v)
+        raise OverflowError(v)
+
+    def __encodeObject(self, t, v, children, ref_fmt):
+        '''__encodeObject(type, value, children, ref_format) -> bytes
+
+        Encodes one object, containers as references to their children
+        '''
+        if t is dict:
+            return self.__encodeCount(0xD0, len(children) // 2) + \
+                struct.pack(ref_fmt % len(children), *children)
+        if t is list:
+            return self.__encodeCount(0xA0, len(children)) + struct.pack(ref_fmt % len(children), *children)
+        if t is set:
+            return self.__encodeCount(0xC0, len(children)) + struct.pack(ref_fmt % len(children), *children)
+        if v is None:
+            return b"\x00"
+        if t is bool:
+            return b"\x09" if v else b"\x08"
+        if isinstance(v, integer_types):
+            return self.__encodeInt(v)
+        if t is float:
+            return struct.pack(">Bd", 0x23, v)
+        if isinstance(v, datetime):
+            return struct.pack(">Bd", 0x33, (v - APPLE_EPOCH).total_seconds())
+        if PY3 and isinstance(v, (bytes, bytearray)):
+            return self.__encodeCount(0x40, len(v)) + bytes(v)
+        if not PY3 and isinstance(v, plistlib.Data):
+            return self.__encodeCount(0x40, len(v.data)) + v.data
+        if isinstance(v, text_type) or isinstance(v, str):
+            if not PY3 and isinstance(v, str):
+                v = v.decode("utf-8")
+            try:
+                s = v.encode("ascii")
+                return self.__encodeCount(0x50, len(s)) + s
+            except UnicodeEncodeError:
+                s = v.encode("utf-16be")
+                return self.__encodeCount(0x60, len(s) // 2) + s
+        if PY3 and isinstance(v, UID):
+            size = _uint_size(v.data)
+            return struct.pack(">B", 0x80 | (size - 1)) + struct.pack(">" + UINT_FORMATS[size], v.data)
+        raise TypeError("unsupported type: %s" % t)
 
-        return self.data
+    def binary(self):
+        '''binary -> bytes
 
-    def write(self, filename):
+        Generates bplist
+        '''
+        table = self.__flatten()
+        ref_size = _uint_size(len(table))
+        ref_fmt = ">%d" + UINT_FORMATS[ref_size]
+
+        chunks = [b"bplist00"]
+        offsets = []
+        offset = 8
+        for t, v, children in table:
+            data = self.__encodeObject(t, v, children, ref_fmt)
+            offsets.append(offset)
+            offset += len(data)
+            chunks.append(data)
+
+        offset_size = _uint_size(offset)
+        chunks.append(struct.pack(">%d%s" % (len(offsets), UINT_FORMATS[offset_size]), *offsets))
+        chunks.append(struct.pack(">6xBBQQQ", offset_size, ref_size, len(table), 0, offset))
+        self.bplist = b"".join(chunks)
+        return self.bplist
+
+    def write(self, f):
         '''
 
-        Writes bplist to file
+        Writes bplist to a file name or a file object
         '''
-        if self.bplist != "":
-            pass
-            # TODO: save self.bplist to file
+        data = self.bplist or self.binary()
+        if hasattr(f, "write"):
+            f.write(data)
         else:
-            raise Exception('BPlist not yet generated')
+            with open(f, "wb") as fd:
+                fd.write(data)
 
 class BPlistReader(object):
+    """
+    Binary plist parser.
+
+    Only the objects reachable from the top object are decoded, each one
+    once, with struct.unpack_from on the original buffer. data objects
+    are returned as bytes (plistlib.Data on Python 2).
+    """
     def __init__(self, s):
         self.data = s
+        # indexing gives ints on both Python versions
+        self.header_bytes = s if PY3 else bytearray(s)
         self.objects = []
         self.resolved = {}
 
-    def __unpackIntStruct(self, sz, s):
-        '''__unpackIntStruct(size, string) -> int
+    def _unpackUInts(self, sz, offset, count):
+        '''_unpackUInts(size, offset, count) -> tuple
 
-        Unpacks the integer of given size (1, 2 or 4 bytes) from string
+        Unpacks count big-endian unsigned integers of given size from offset
         '''
-        if   sz == 1:
-            ot = '!B'
-        elif sz == 2:
-            ot = '!H'
-        elif sz == 4:
-            ot = '!I'
-        elif sz == 8:
-            ot = '!Q'
-        else:
-            raise Exception('int unpack size '+str(sz)+' unsupported')
-        return struct.unpack(ot, s)[0]
-
-    def __unpackInt(self, offset):
-        '''__unpackInt(offset) -> int
-
-        Unpacks int field from plist at given offset
-        '''
-        return self.__unpackIntMeta(offset)[1]
+        fmt = UINT_FORMATS.get(sz)
+        if fmt:
+            if count == 1:
+                return struct.unpack_from(">" + fmt, self.data, offset)
+            return struct.unpack_from(">%d%s" % (count, fmt), self.data, offset)
+        data = self.data
+        res = []
+        for i in range(offset, offset + sz*count, sz):
+            v = 0
+            for c in bytearray(data[i:i+sz]):
+                v = v << 8 | c
+            res.append(v)
+        return tuple(res)
 
     def __unpackIntMeta(self, offset):
         '''__unpackIntMeta(offset) -> (size, int)
 
         Unpacks int field from plist at given offset and returns its size and value
         '''
-        obj_header = struct.unpack('!B', self.data[offset])[0]
-        obj_type, obj_info = (obj_header & 0xF0), (obj_header & 0x0F)
-        int_sz = 2**obj_info
-        return int_sz, self.__unpackIntStruct(int_sz, self.data[offset+1:offset+1+int_sz])
+        obj_info = self.header_bytes[offset] & 0x0F
+        int_sz = 1 << obj_info
+        if int_sz == 8:
+            return int_sz, struct.unpack_from('>q', self.data, offset+1)[0]
+        if int_sz == 16:
+            hi, lo = struct.unpack_from('>qQ', self.data, offset+1)
+            return int_sz, (hi << 64) | lo
+        return int_sz, self._unpackUInts(int_sz, offset+1, 1)[0]
 
     def __resolveIntSize(self, obj_info, offset):
         '''__resolveIntSize(obj_info, offset) -> (count, offset)
@@ -91,41 +268,31 @@ class BPlistReader(object):
             objref = offset+1
         return obj_count, objref
 
-    def __unpackFloatStruct(self, sz, s):
-        '''__unpackFloatStruct(size, string) -> float
-
-        Unpacks the float of given size (4 or 8 bytes) from string
-        '''
-        if   sz == 4:
-            ot = '!f'
-        elif sz == 8:
-            ot = '!d'
-        else:
-            raise Exception('float unpack size '+str(sz)+' unsupported')
-        return struct.unpack(ot, s)[0]
-
-    def __unpackFloat(self, offset):
-        '''__unpackFloat(offset) -> float
-
-        Unpacks float field from plist at given offset
-        '''
-        obj_header = struct.unpack('!B', self.data[offset])[0]
-        obj_type, obj_info = (obj_header & 0xF0), (obj_header & 0x0F)
-        int_sz = 2**obj_info
-        return int_sz, self.__unpackFloatStruct(int_sz, self.data[offset+1:offset+1+int_sz])
-
-    def __unpackDate(self, offset):
-        td = int(struct.unpack(">d", self.data[offset+1:offset+9])[0])
-        return datetime(year=2001,month=1,day=1) + timedelta(seconds=td)
-
-    def __unpackItem(self, offset):
-        '''__unpackItem(offset)
+    def _unpackItem(self, offset):
+        '''_unpackItem(offset)
 
-        Unpacks and returns an item from plist
+        Unpacks and returns an item from plist, containers hold object references
         '''
-        obj_header = struct.unpack('!B', self.data[offset])[0]
+        obj_header = self.header_bytes[offset]
         obj_type, obj_info = (obj_header & 0xF0), (obj_header & 0x0F)
-        if   obj_type == 0x00:
+        # most frequent types first
+        if obj_type == 0x50: #    string  0101 nnnn   [int]   ... // ASCII string, nnnn is # of chars, else 1111 then int count, then bytes
+            if obj_info == 0x0F:
+                obj_count, objref = self.__resolveIntSize(obj_info, offset)
+            else:
+                obj_count, objref = obj_info, offset+1
+            s = self.data[objref:objref+obj_count]
+            return s.decode('ascii') if PY3 else s
+        elif obj_type == 0xD0: #   dict     1101 nnnn   [int]   keyref* objref* // nnnn is count, unless '1111', then int count follows
+            obj_count, objref = self.__resolveIntSize(obj_info, offset)
+            refs = self._unpackUInts(self.object_ref_size, objref, 2*obj_count)
+            return dict(zip(refs[:obj_count], refs[obj_count:]))
+        elif obj_type == 0x10: #     int    0001 nnnn   ...     // # of bytes is 2^nnnn, big-endian bytes
+            return self.__unpackIntMeta(offset)[1]
+        elif obj_type == 0xA0 or obj_type == 0xC0: # array / set  1010 nnnn   [int]   objref* // nnnn is count, unless '1111', then int count follows
+            obj_count, objref = self.__resolveIntSize(obj_info, offset)
+            return list(self._unpackUInts(self.object_ref_size, objref, obj_count))
+        elif obj_type == 0x00:
             if   obj_info == 0x00: # null   0000 0000
                 return None
             elif obj_info == 0x08: # bool   0000 1000           // false
@@ -136,104 +303,62 @@ class BPlistReader(object):
                 raise Exception("0x0F Not Implemented") # this is really pad byte, FIXME
             else:
                 raise Exception('unpack item type '+str(obj_header)+' at '+str(offset)+ 'failed')
-        elif obj_type == 0x10: #     int    0001 nnnn   ...     // # of bytes is 2^nnnn, big-endian bytes
-            return self.__unpackInt(offset)
-        elif obj_type == 0x20: #    real    0010 nnnn   ...     // # of bytes is 2^nnnn, big-endian bytes
-            return self.__unpackFloat(offset)
-        elif obj_type == 0x30: #    date    0011 0011   ...     // 8 byte float follows, big-endian bytes
-            return self.__unpackDate(offset)
         elif obj_type == 0x40: #    data    0100 nnnn   [int]   ... // nnnn is number of bytes unless 1111 then int count follows, followed by bytes
             obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            return plistlib.Data(self.data[objref:objref+obj_count]) # XXX: we return data as str
-        elif obj_type == 0x50: #    string  0101 nnnn   [int]   ... // ASCII string, nnnn is # of chars, else 1111 then int count, then bytes
-            obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            return self.data[objref:objref+obj_count]
+            return Data(bytes(self.data[objref:objref+obj_count]))
         elif obj_type == 0x60: #    string  0110 nnnn   [int]   ... // Unicode string, nnnn is # of chars, else 1111 then int count, then big-endian 2-byte uint16_t
             obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            return self.data[objref:objref+obj_count*2].decode('utf-16be')
+            return bytes(self.data[objref:objref+obj_count*2]).decode('utf-16be')
+        elif obj_type == 0x20: #    real    0010 nnnn   ...     // # of bytes is 2^nnnn, big-endian bytes
+            if obj_info == 2:
+                return struct.unpack_from('>f', self.data, offset+1)[0]
+            elif obj_info == 3:
+                return struct.unpack_from('>d', self.data, offset+1)[0]
+            raise Exception('float unpack size '+str(1 << obj_info)+' unsupported')
+        elif obj_type == 0x30: #    date    0011 0011   ...     // 8 byte float follows, big-endian bytes
+            return APPLE_EPOCH + timedelta(seconds=struct.unpack_from('>d', self.data, offset+1)[0])
         elif obj_type == 0x80: #    uid     1000 nnnn   ...     // nnnn+1 is # of bytes
-            # FIXME: Accept as a string for now
-            obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            return plistlib.Data(self.data[objref:objref+obj_count])
-        elif obj_type == 0xA0: #    array   1010 nnnn   [int]   objref* // nnnn is count, unless '1111', then int count follows
-            obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            arr = []
-            for i in range(obj_count):
-                arr.append(self.__unpackIntStruct(self.object_ref_size, self.data[objref+i*self.object_ref_size:objref+i*self.object_ref_size+self.object_ref_size]))
-            return arr
-        elif obj_type == 0xC0: #   set      1100 nnnn   [int]   objref* // nnnn is count, unless '1111', then int count follows
-            # XXX: not serializable via apple implementation
-            raise Exception("0xC0 Not Implemented") # FIXME: implement
-        elif obj_type == 0xD0: #   dict     1101 nnnn   [int]   keyref* objref* // nnnn is count, unless '1111', then int count follows
-            obj_count, objref = self.__resolveIntSize(obj_info, offset)
-            keys = []
-            for i in range(obj_count):
-                keys.append(self.__unpackIntStruct(self.object_ref_size, self.data[objref+i*self.object_ref_size:objref+i*self.object_ref_size+self.object_ref_size]))
-            values = []
-            objref += obj_count*self.object_ref_size
-            for i in range(obj_count):
-                values.append(self.__unpackIntStruct(self.object_ref_size, self.data[objref+i*self.object_ref_size:objref+i*self.object_ref_size+self.object_ref_size]))
-            dic = {}
-            for i in range(obj_count):
-                dic[keys[i]] = values[i]
-            return dic
+            if PY3:
+                return UID(self._unpackUInts(obj_info+1, offset+1, 1)[0])
+            return UID(self.data[offset+1:offset+2+obj_info])
         else:
             raise Exception('don\'t know how to unpack obj type '+hex(obj_type)+' at '+str(offset))
 
     def __resolveObject(self, idx):
-        try:
-            return self.resolved[idx]
-        except KeyError:
-            obj = self.objects[idx]
-            if type(obj) == list:
-                newArr = []
-                for i in obj:
-                    newArr.append(self.__resolveObject(i))
-                self.resolved[idx] = newArr
-                return newArr
-            if type(obj) == dict:
-                newDic = {}
-                for k,v in obj.iteritems():
-                    rk = self.__resolveObject(k)
-                    rv = self.__resolveObject(v)
-                    newDic[rk] = rv
-                self.resolved[idx] = newDic
-                return newDic
-            else:
-                self.resolved[idx] = obj
-                return obj
-
-    def parse(self):
+        obj = self.resolved.get(idx, self)
+        if obj is not self:
+            return obj
+        obj = self._unpackItem(self.offsets[idx])
+        if type(obj) == list:
+            newArr = []
+            self.resolved[idx] = newArr
+            for i in obj:
+                newArr.append(self.__resolveObject(i))
+            return newArr
+        if type(obj) == dict:
+            newDic = {}
+            self.resolved[idx] = newDic
+            for k,v in obj.items():
+                newDic[self.__resolveObject(k)] = self.__resolveObject(v)
+            return newDic
+        self.resolved[idx] = obj
+        return obj
+
+    def _readTrailer(self):
         # read header
-        if self.data[:8] != 'bplist00':
+        if self.data[:8] != b'bplist00':
             raise Exception('Bad magic')
 
         # read trailer
-        self.offset_size, self.object_ref_size, self.number_of_objects, self.top_object, self.table_offset = struct.unpack('!6xBB4xI4xI4xI', self.data[-32:])
-        #print "** plist offset_size:",self.offset_size,"objref_size:",self.object_ref_size,"num_objs:",self.number_of_objects,"top:",self.top_object,"table_ofs:",self.table_offset
+        self.offset_size, self.object_ref_size, self.number_of_objects, self.top_object, self.table_offset = \
+            struct.unpack_from('>6xBB4xL4xL4xL', self.data, len(self.data) - 32)
 
         # read offset table
-        self.offset_table = self.data[self.table_offset:-32]
-        self.offsets = []
-        ot = self.offset_table
-        for i in xrange(self.number_of_objects):
-            offset_entry = ot[:self.offset_size]
-            ot = ot[self.offset_size:]
-            self.offsets.append(self.__unpackIntStruct(self.offset_size, offset_entry))
-        #print "** plist offsets:",self.offsets
-
-        # read object table
-        self.objects = []
-        k = 0
-        for i in self.offsets:
-            obj = self.__unpackItem(i)
-            #print "** plist unpacked",k,type(obj),obj,"at",i
-            k += 1
-            self.objects.append(obj)
+        self.offsets = self._unpackUInts(self.offset_size, self.table_offset, self.number_of_objects)
 
-        # rebuild object tree
-        #for i in range(len(self.objects)):
-        #    self.__resolveObject(i)
+    def parse(self):
+        self._readTrailer()
+        self.resolved = {}
 
         # return root object
         return self.__resolveObject(self.top_object)
@@ -248,4 +373,128 @@ class BPlistReader(object):
         file = open(f,"rb")
         parser = cls(file.read())
         file.close()
-        return parser.parse()
\ No newline at end of file
+        return parser.parse()
+
+
+class LazyBPlist(BPlistReader):
+    """
+    Random access binary plist reader.
+
+    Only the trailer and the offset table are read up front. Containers are
+    returned as read-only BPlistDict/BPlistArray views which decode their
+    entries when they are accessed, and the last cache_size decoded objects
+    are kept in an LRU cache. Files are mapped in memory rather than read.
+    """
+    def __init__(self, s, cache_size=1024):
+        super(LazyBPlist, self).__init__(s)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.mm = None
+        self._readTrailer()
+
+    @classmethod
+    def open(cls, filename, cache_size=1024):
+        with open(filename, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = cls(mm, cache_size)
+        reader.mm = mm
+        return reader
+
+    def close(self):
+        self.cache.clear()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def root(self):
+        return self.object(self.top_object)
+
+    def object(self, idx):
+        '''object(idx)
+
+        Returns the object idx, containers as lazy views
+        '''
+        cache = self.cache
+        obj = cache.pop(idx, self)
+        if obj is self:
+            obj = self._unpackItem(self.offsets[idx])
+            if type(obj) == list:
+                obj = BPlistArray(self, obj)
+            elif type(obj) == dict:
+                obj = BPlistDict(self, obj)
+            if cache and len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[idx] = obj
+        return obj
+
+    def parse(self):
+        return materialize(self.root)
+
+
+class BPlistDict(Mapping):
+    """
+    Read-only view of a dict of a LazyBPlist: keys are decoded on the first
+    lookup, values when they are accessed.
+    """
+    def __init__(self, reader, refs):
+        self.reader = reader
+        self.refs = refs
+        self.index = None
+
+    def _index(self):
+        if self.index is None:
+            obj = self.reader.object
+            self.index = OrderedDict((obj(k), v) for k, v in self.refs.items())
+        return self.index
+
+    def __getitem__(self, key):
+        return self.reader.object(self._index()[key])
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __repr__(self):
+        return "<BPlistDict with %d keys>" % len(self)
+
+
+class BPlistArray(Sequence):
+    """
+    Read-only view of an array of a LazyBPlist, items are decoded when they
+    are accessed.
+    """
+    def __init__(self, reader, refs):
+        self.reader = reader
+        self.refs = refs
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.reader.object(ref) for ref in self.refs[i]]
+        return self.reader.object(self.refs[i])
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __repr__(self):
+        return "<BPlistArray with %d items>" % len(self)
+
+
+def materialize(obj):
+    '''materialize(obj)
+
+    Converts lazy views to plain dicts and lists
+    '''
+    if isinstance(obj, BPlistDict):
+        return dict((k, materialize(v)) for k, v in obj.items())
+    if isinstance(obj, BPlistArray):
+        return [materialize(v) for v in obj]
+    return obj
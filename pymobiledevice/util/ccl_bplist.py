@@ -26,7 +26,6 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import sys
-import os
 import struct
 import datetime
 
@@ -47,51 +46,39 @@ class BplistUID:
     def __str__(self):
         return self.__repr__()
 
-def __decode_multibyte_int(b, signed=True):
-    if len(b) == 1:
-        fmt = ">B" # Always unsigned?
-    elif len(b) == 2:
-        fmt = ">h"
-    elif len(b) == 3:
-        if signed:
-            return ((b[0] << 16) | struct.unpack(">H", b[1:])[0]) - ((b[0] >> 7) * 2 * 0x800000)
-        else:
-            return (b[0] << 16) | struct.unpack(">H", b[1:])[0]
-    elif len(b) == 4:
-        fmt = ">i"
-    elif len(b) == 8:
-        fmt = ">q"
-    else:
-        raise BplistError("Cannot decode multibyte int of length {0}".format(len(b)))
-    
-    if signed and len(b) > 1:
-        return struct.unpack(fmt.lower(), b)[0]
-    else:
-        return struct.unpack(fmt.upper(), b)[0]
+_UINT_FORMATS = {1: "B", 2: "H", 4: "L", 8: "Q"}
 
-def __decode_float(b, signed=True):
-    if len(b) == 4:
-        fmt = ">f"
-    elif len(b) == 8:
-        fmt = ">d"
-    else:
-        raise BplistError("Cannot decode float of length {0}".format(len(b)))
+def __decode_uints(data, offset, size, count):
+    """Decodes count big-endian unsigned ints of the given size in one pass"""
+    fmt = _UINT_FORMATS.get(size)
+    if fmt:
+        return struct.unpack_from(">{0}{1}".format(count, fmt), data, offset)
+    if size <= 0 or offset + size * count > len(data):
+        raise BplistError("Cannot decode {0} ints of length {1} at offset {2}".format(count, size, offset))
+    b = bytearray(data[offset:offset + size * count])
+    result = []
+    for i in range(0, len(b), size):
+        v = 0
+        for c in b[i:i + size]:
+            v = (v << 8) | c
+        result.append(v)
+    return result
 
-    if signed: 
-        return struct.unpack(fmt.lower(), b)[0]
-    else:
-        return struct.unpack(fmt.upper(), b)[0]
+def __decode_length(data, type_byte, offset, name):
+    """Returns the length of a variable length object and the offset of its content"""
+    if type_byte & 0x0F != 0x0F:
+        # length in 4 lsb
+        return type_byte & 0x0F, offset + 1
+    int_type_byte = data[offset + 1]
+    if int_type_byte & 0xF0 != 0x10:
+        raise BplistError("Long {0} field definition not followed by int type at offset {1}".format(name, offset + 1))
+    int_length = 1 << (int_type_byte & 0x0F)
+    return __decode_uints(data, offset + 2, int_length, 1)[0], offset + 2 + int_length
 
-def __decode_object(f, offset, collection_offset_size, offset_table):
-    # Move to offset and read type
-    #print("Decoding object at offset {0}".format(offset))
-    f.seek(offset)
-    # A little hack to keep the script portable between py2.x and py3k
-    if sys.version_info[0] < 3:
-        type_byte = ord(f.read(1)[0])
-    else:
-        type_byte = f.read(1)[0]
-    #print("Type byte: {0}".format(hex(type_byte)))
+def __decode_object(data, offset, collection_offset_size):
+    """Decodes the object at offset. Collections are returned as a
+       (container, child references) tuple to be filled in by the caller"""
+    type_byte = data[offset]
     if type_byte == 0x00: # Null      0000 0000
         return None
     elif type_byte == 0x08: # False   0000 1000
@@ -99,177 +86,183 @@ def __decode_object(f, offset, collection_offset_size, offset_table):
     elif type_byte == 0x09: # True    0000 1001
         return True
     elif type_byte == 0x0F: # Fill    0000 1111
-        raise BplistError("Fill type not currently supported at offset {0}".format(f.tell())) # Not sure what to return really...
-    elif type_byte & 0xF0 == 0x10: # Int    0001 xxxx
-        int_length = 2 ** (type_byte & 0x0F)
-        int_bytes = f.read(int_length)
-        return __decode_multibyte_int(int_bytes)
-    elif type_byte & 0xF0 == 0x20: # Float   0010 nnnn
-        float_length = 2 ** (type_byte & 0x0F)
-        float_bytes = f.read(float_length)
-        return __decode_float(float_bytes)
-    elif type_byte & 0xFF == 0x33: # Date   0011 0011
-        date_bytes = f.read(8)
-        date_value = __decode_float(date_bytes)
+        raise BplistError("Fill type not currently supported at offset {0}".format(offset)) # Not sure what to return really...
+    kind = type_byte & 0xF0
+    if kind == 0x10: # Int    0001 xxxx
+        int_length = 1 << (type_byte & 0x0F)
+        if int_length == 8:
+            return struct.unpack_from(">q", data, offset + 1)[0]
+        if int_length == 16:
+            hi, lo = struct.unpack_from(">qQ", data, offset + 1)
+            return (hi << 64) | lo
+        # 1, 2 and 4 byte ints are unsigned
+        return __decode_uints(data, offset + 1, int_length, 1)[0]
+    elif kind == 0x20: # Float   0010 nnnn
+        float_length = 1 << (type_byte & 0x0F)
+        if float_length == 4:
+            return struct.unpack_from(">f", data, offset + 1)[0]
+        if float_length == 8:
+            return struct.unpack_from(">d", data, offset + 1)[0]
+        raise BplistError("Cannot decode float of length {0}".format(float_length))
+    elif type_byte == 0x33: # Date   0011 0011
+        date_value = struct.unpack_from(">d", data, offset + 1)[0]
         return datetime.datetime(2001,1,1) + datetime.timedelta(seconds = date_value)
-    elif type_byte & 0xF0 == 0x40: # Data   0100 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            data_length = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Data field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            data_length = __decode_multibyte_int(int_bytes, False)
-        return f.read(data_length)
-    elif type_byte & 0xF0 == 0x50: # ASCII  0101 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            ascii_length = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long ASCII field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            ascii_length = __decode_multibyte_int(int_bytes, False)
-        return f.read(ascii_length).decode("ascii")
-    elif type_byte & 0xF0 == 0x60: # UTF-16  0110 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            utf16_length = (type_byte & 0x0F) * 2 # Length is characters - 16bit width
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long UTF-16 field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            utf16_length = __decode_multibyte_int(int_bytes, False) * 2
-        return f.read(utf16_length).decode("utf_16_be")
-    elif type_byte & 0xF0 == 0x80: # UID    1000 nnnn
+    elif kind == 0x40: # Data   0100 nnnn
+        data_length, start = __decode_length(data, type_byte, offset, "Data")
+        return bytes(data[start:start + data_length])
+    elif kind == 0x50: # ASCII  0101 nnnn
+        ascii_length, start = __decode_length(data, type_byte, offset, "ASCII")
+        return bytes(data[start:start + ascii_length]).decode("ascii")
+    elif kind == 0x60: # UTF-16  0110 nnnn
+        utf16_length, start = __decode_length(data, type_byte, offset, "UTF-16")
+        return bytes(data[start:start + utf16_length * 2]).decode("utf_16_be")
+    elif kind == 0x80: # UID    1000 nnnn
         uid_length = (type_byte & 0x0F) + 1
-        uid_bytes = f.read(uid_length)
-        return BplistUID(__decode_multibyte_int(uid_bytes, signed=False))
-    elif type_byte & 0xF0 == 0xA0: # Array  1010 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            array_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Array field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            array_count = __decode_multibyte_int(int_bytes, signed=False)
-        array_refs = []
-        for i in range(array_count):
-            array_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        return [__decode_object(f, offset_table[obj_ref], collection_offset_size, offset_table) for obj_ref in array_refs]
-    elif type_byte & 0xF0 == 0xC0: # Set  1010 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            set_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Set field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            set_count = __decode_multibyte_int(int_bytes, signed=False)
-        set_refs = []
-        for i in range(set_count):
-            set_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        return [__decode_object(f, offset_table[obj_ref], collection_offset_size, offset_table) for obj_ref in set_refs]
-    elif type_byte & 0xF0 == 0xD0: # Dict  1011 nnnn
-        if type_byte & 0x0F != 0x0F:
-            # length in 4 lsb
-            dict_count = type_byte & 0x0F
-        else:
-            # A little hack to keep the script portable between py2.x and py3k
-            if sys.version_info[0] < 3:
-                int_type_byte = ord(f.read(1)[0])
-            else:
-                int_type_byte = f.read(1)[0]
-            #print("Dictionary length int byte: {0}".format(hex(int_type_byte)))
-            if int_type_byte & 0xF0 != 0x10:
-                raise BplistError("Long Dict field definition not followed by int type at offset {0}".format(f.tell()))
-            int_length = 2 ** (int_type_byte & 0x0F)
-            int_bytes = f.read(int_length)
-            dict_count = __decode_multibyte_int(int_bytes, signed=False)
-        key_refs = []
-        #print("Dictionary count: {0}".format(dict_count))
-        for i in range(dict_count):
-            key_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        value_refs = []
-        for i in range(dict_count):
-            value_refs.append(__decode_multibyte_int(f.read(collection_offset_size), False))
-        
-        dict_result = {}
-        for i in range(dict_count):
-            #print("Key ref: {0}\tVal ref: {1}".format(key_refs[i], value_refs[i]))
-            key = __decode_object(f, offset_table[key_refs[i]], collection_offset_size, offset_table)
-            val = __decode_object(f, offset_table[value_refs[i]], collection_offset_size, offset_table)
-            dict_result[key] = val
-        return dict_result
+        return BplistUID(__decode_uints(data, offset + 1, uid_length, 1)[0])
+    elif kind == 0xA0 or kind == 0xC0: # Array  1010 nnnn / Set  1100 nnnn
+        count, start = __decode_length(data, type_byte, offset, "Array" if kind == 0xA0 else "Set")
+        return [], __decode_uints(data, start, collection_offset_size, count)
+    elif kind == 0xD0: # Dict  1101 nnnn
+        count, start = __decode_length(data, type_byte, offset, "Dict")
+        return {}, __decode_uints(data, start, collection_offset_size, count * 2)
+    raise BplistError("Unknown object type {0} at offset {1}".format(hex(type_byte), offset))
 
 
-def load(f):
+def loads(data):
     """
-    Reads and converts a file-like object containing a binary property list.
-    Takes a file-like object (must support reading and seeking) as an argument
+    Converts a binary property list held in a bytes-like object.
     Returns a data structure representing the data in the property list
     """
-    # Check magic number
-    if f.read(8) != b"bplist00":
+    if sys.version_info[0] < 3:
+        data = bytearray(data)
+    if data[:8] != b"bplist00":
         raise BplistError("Bad file header")
 
     # Read trailer
-    f.seek(-32, os.SEEK_END)
-    trailer = f.read(32)
-    offset_int_size, collection_offset_size, object_count, top_level_object_index, offest_table_offset = struct.unpack(">6xbbQQQ", trailer)
+    offset_int_size, collection_offset_size, object_count, top_level_object_index, offest_table_offset = \
+        struct.unpack_from(">6xBBQQQ", data, len(data) - 32)
 
     # Read offset table
-    f.seek(offest_table_offset)
-    offset_table = []
-    for i in range(object_count):
-        offset_table.append(__decode_multibyte_int(f.read(offset_int_size), False))
-    
-    return __decode_object(f, offset_table[top_level_object_index], collection_offset_size, offset_table)
+    offset_table = __decode_uints(data, offest_table_offset, offset_int_size, object_count)
+
+    # Every object is decoded once, collections are filled in from a work
+    # list rather than by recursion so that deep plists do not hit the
+    # recursion limit and shared (or cyclic) references resolve to one object
+    decoded = {}
+    pending = []
+
+    def resolve(index):
+        try:
+            return decoded[index]
+        except KeyError:
+            pass
+        obj = __decode_object(data, offset_table[index], collection_offset_size)
+        if type(obj) is tuple:
+            pending.append(obj)
+            obj = obj[0]
+        decoded[index] = obj
+        return obj
+
+    root = resolve(top_level_object_index)
+    while pending:
+        container, refs = pending.pop()
+        if type(container) is list:
+            container.extend([resolve(ref) for ref in refs])
+        else:
+            count = len(refs) // 2
+            for i in range(count):
+                container[resolve(refs[i])] = resolve(refs[count + i])
+    return root
+
+
+def load(f):
+    """
+    Reads and converts a file-like object containing a binary property list.
+    Takes a file-like object (must support reading and seeking) as an argument
+    Returns a data structure representing the data in the property list
+    """
+    f.seek(0)
+    return loads(f.read())
 
 
 def NSKeyedArchiver_convert(o, object_table):
-    if isinstance(o, list):
+    if isinstance(o, (NsKeyedArchiverDictionary, NsKeyedArchiverList)):
+        return o
+    elif isinstance(o, list):
         return NsKeyedArchiverList(o, object_table)
     elif isinstance(o, dict):
         return NsKeyedArchiverDictionary(o, object_table)
     elif isinstance(o, BplistUID):
+        if isinstance(object_table, NsKeyedArchiverObjectTable):
+            return object_table.resolve(o.value)
         return NSKeyedArchiver_convert(object_table[o.value], object_table)
     else:
         return o
 
 
+def NSKeyedArchiver_plain(o, object_table, memo=None):
+    """Converts o into plain python structures, replacing every UID by the
+       object it references. Each $objects entry is converted once (memo maps
+       indexes to converted objects) so shared and cyclic references resolve
+       to the same object. The "$null" entry becomes None."""
+    if memo is None:
+        memo = {}
+    pending = []
+
+    def convert(o):
+        if isinstance(o, BplistUID):
+            try:
+                return memo[o.value]
+            except KeyError:
+                pass
+            raw = list.__getitem__(object_table, o.value)
+            result = None if raw == "$null" else convert(raw)
+            memo[o.value] = result
+            return result
+        elif isinstance(o, list):
+            result = []
+            pending.append((o, result))
+            return result
+        elif isinstance(o, dict):
+            result = {}
+            pending.append((o, result))
+            return result
+        return o
+
+    root = convert(o)
+    while pending:
+        raw, result = pending.pop()
+        if isinstance(result, list):
+            result.extend([convert(v) for v in list.__iter__(raw)])
+        else:
+            for k, v in dict.items(raw):
+                result[convert(k)] = convert(v)
+    return root
+
+
+class NsKeyedArchiverObjectTable(list):
+    """The $objects list of an archive. Entries are only converted when they
+       are first referenced and then cached, both as lazy wrappers and as
+       plain structures."""
+    def __init__(self, objects):
+        super(NsKeyedArchiverObjectTable, self).__init__(objects)
+        self.converted = {}
+        self.plain = {}
+
+    def resolve(self, index):
+        """Returns the entry at index wrapped in NsKeyedArchiverDictionary/List"""
+        try:
+            return self.converted[index]
+        except KeyError:
+            o = NSKeyedArchiver_convert(super(NsKeyedArchiverObjectTable, self).__getitem__(index), self)
+            self.converted[index] = o
+            return o
+
+    def resolve_plain(self, index):
+        """Returns the entry at index as plain python structures"""
+        return NSKeyedArchiver_plain(BplistUID(index), self, self.plain)
+
+
 class NsKeyedArchiverDictionary(dict):
     def __init__(self, original_dict, object_table):
         super(NsKeyedArchiverDictionary, self).__init__(original_dict)
@@ -277,7 +270,11 @@ class NsKeyedArchiverDictionary(dict):
 
     def __getitem__(self, index):
         o = super(NsKeyedArchiverDictionary, self).__getitem__(index)
-        return NSKeyedArchiver_convert(o, self.object_table)
+        converted = NSKeyedArchiver_convert(o, self.object_table)
+        if converted is not o:
+            # keep the converted value so that it is only converted once
+            super(NsKeyedArchiverDictionary, self).__setitem__(index, converted)
+        return converted
 
 class NsKeyedArchiverList(list):
     def __init__(self, original_iterable, object_table):
@@ -286,18 +283,20 @@ class NsKeyedArchiverList(list):
 
     def __getitem__(self, index):
         o = super(NsKeyedArchiverList, self).__getitem__(index)
-        return NSKeyedArchiver_convert(o, self.object_table)
+        converted = NSKeyedArchiver_convert(o, self.object_table)
+        if converted is not o and not isinstance(index, slice):
+            super(NsKeyedArchiverList, self).__setitem__(index, converted)
+        return converted
 
     def __iter__(self):
-        for o in super(NsKeyedArchiverList, self).__iter__():
-            yield NSKeyedArchiver_convert(o, self.object_table)
-        
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _NsKeyedArchiver_table(obj):
+    """Checks obj is an archive we understand and returns its object table.
+       The table is stored back in obj so that later calls share its cache."""
 
-def deserialise_NsKeyedArchiver(obj):
-    """Deserialises an NSKeyedArchiver bplist rebuilding the structure.
-       obj should usually be the top-level object returned by the load()
-       function."""
-    
     # Check that this is an archiver and version we understand
     if not isinstance(obj, dict):
         raise TypeError("obj must be a dict")
@@ -307,11 +306,52 @@ def deserialise_NsKeyedArchiver(obj):
         raise ValueError("obj does not contain a '$version' key or the '$version' is unrecognised")
 
     object_table = obj["$objects"]
-    if "root" in obj["$top"]:
-        return NSKeyedArchiver_convert(obj["$top"]["root"], object_table)
+    if not isinstance(object_table, NsKeyedArchiverObjectTable):
+        object_table = obj["$objects"] = NsKeyedArchiverObjectTable(object_table)
+    return object_table
+
+
+def deserialise_NsKeyedArchiver(obj, plain=False):
+    """Deserialises an NSKeyedArchiver bplist rebuilding the structure.
+       obj should usually be the top-level object returned by the load()
+       function. If plain is True the whole structure is converted at once
+       into dicts and lists instead of lazy NsKeyedArchiver wrappers."""
+    object_table = _NsKeyedArchiver_table(obj)
+    top = obj["$top"]
+    if "root" in top:
+        top = top["root"]
+    if plain:
+        return NSKeyedArchiver_plain(top, object_table, object_table.plain)
+    return NSKeyedArchiver_convert(top, object_table)
+
+
+def iter_NsKeyedArchiver(obj, plain=False):
+    """Yields the content of the root object of an archive one element at a
+       time: the items of an NSArray or NSSet, the (key, value) pairs of an
+       NSDictionary. Elements are only resolved when they are reached."""
+    object_table = _NsKeyedArchiver_table(obj)
+    if plain:
+        resolve = lambda o: NSKeyedArchiver_plain(o, object_table, object_table.plain)
     else:
-        return NSKeyedArchiver_convert(obj["$top"], object_table)
-    
+        resolve = lambda o: NSKeyedArchiver_convert(o, object_table)
+    top = obj["$top"]
+    root = dict.get(top, "root", top)
+    if isinstance(root, BplistUID):
+        root = list.__getitem__(object_table, root.value)
+    if isinstance(root, dict) and "NS.objects" in root:
+        objects = root["NS.objects"]
+        if "NS.keys" in root:
+            for k, v in zip(root["NS.keys"], objects):
+                yield resolve(k), resolve(v)
+        else:
+            for o in objects:
+                yield resolve(o)
+    elif isinstance(root, list):
+        for o in root:
+            yield resolve(o)
+    else:
+        yield resolve(root)
+
 # NSMutableDictionary convenience functions
 def is_nsmutabledictionary(obj):
     if not isinstance(obj, dict):
@@ -23,9 +23,13 @@
 #
 
 from pprint import pprint
-import sys
 from struct import unpack, pack
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from optparse import OptionParser
 import os
+import threading
 
 #Values for mode, OR'd together:
 
@@ -46,28 +50,145 @@ NEW_MAGIC = 0o070701 #New ASCII magic
 CRC_MAGIC = 0o070702 #New CRC magic
 OLD_MAGIC = 0o070707 #Old ASCII magic
 
+BUFSIZE = 1024 * 1024
+
+ODC_HEADER_SIZE = 76     # magic + 10 octal fields
+NEWC_HEADER_SIZE = 110   # magic + 13 hexadecimal fields
+
 def version():
-    return '0.1'
+    return '0.2'
+
+
+class CpioError(Exception):
+    pass
+
+
+class CpioMember(object):
+    """
+    Header of an archive member. The member data is only read from the
+    archive when read(), readlink() or copyto() is called; it stays
+    available until the next member is read unless the archive file is
+    seekable.
+    """
+
+    def __init__(self, archive, magic, fields, name, offset, data_offset):
+        self.archive = archive
+        self.magic = magic
+        self.name = name
+        self.dev = fields["dev"]
+        self.ino = fields["ino"]
+        self.mode = fields["mode"]
+        self.uid = fields["uid"]
+        self.gid = fields["gid"]
+        self.nlink = fields["nlink"]
+        self.rdev = fields["rdev"]
+        self.mtime = fields["mtime"]
+        self.filesize = fields["filesize"]
+        self.chksum = fields.get("check", 0)
+        self.offset = offset            # offset of the header in the archive
+        self.data_offset = data_offset  # offset of the member data
+        self.end = data_offset + filesize_padding(magic, data_offset, self.filesize)
+        self.consumed = 0
+        self.sum = 0
+        self.sum_pos = 0
+
+    def __repr__(self):
+        return "<CpioMember %s %o %d bytes>" % (self.name, self.mode, self.filesize)
+
+    def isdir(self):
+        return self.mode & IFMT == ISDIR
+
+    def isreg(self):
+        return self.mode & IFMT in (ISREG, ISCTG)
+
+    def issym(self):
+        return self.mode & IFMT == ISLNK
+
+    def isfifo(self):
+        return self.mode & IFMT == ISFIFO
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the member data (all remaining if size < 0).
+        """
+        remaining = self.filesize - self.consumed
+        if size < 0 or size > remaining:
+            size = remaining
+        if size == 0:
+            return b""
+        offset = self.consumed
+        data = self.archive.read_member_data(self, size)
+        if self.magic == CRC_MAGIC and offset == self.sum_pos:
+            self.sum = (self.sum + sum(bytearray(data))) & 0xFFFFFFFF
+            self.sum_pos += len(data)
+            if self.sum_pos == self.filesize and self.sum != self.chksum:
+                raise CpioError("CRC mismatch for %s" % self.name)
+        return data
+
+    def readlink(self):
+        return self.read().decode("utf-8", "surrogateescape")
+
+    def copyto(self, fd, bufsize=BUFSIZE):
+        while True:
+            data = self.read(bufsize)
+            if not data:
+                break
+            fd.write(data)
+
+
+def filesize_padding(magic, data_offset, filesize):
+    if magic == OLD_MAGIC:
+        return filesize
+    return (data_offset + filesize + 3 & ~3) - data_offset
 
 
 class CpioArchive(object):
+    """
+    Sequential reader for odc (070707), newc (070701) and crc (070702)
+    cpio archives:
+
+        for member in CpioArchive("archive.cpio"):
+            if member.isreg():
+                data = member.read()
+
+    Member data is read lazily; data left unread is skipped with seek()
+    when the archive file is seekable.
+    """
 
     def __init__(self, cpiofile=None, fileobj=None, mode="rb"):
         if fileobj:
             self.ifile = fileobj
         else:
             self.ifile = open(cpiofile,mode)
+        try:
+            self.seekable = self.ifile.seekable()
+        except AttributeError:
+            self.seekable = False
+        self.base = self.ifile.tell() if self.seekable else 0
+        self.pos = 0
+        self.member = None
+        self.done = False
+        self.index = None
 
-    def is_cpiofile(self,cpiofile=None,fileobj=None):
-        if fileobj:
-            magic = int(fileobj.read(6),8)    
-        else:
-            magic = int(open(cpiofile,'r').read(6),8)
+    def rewind(self):
+        if not self.seekable:
+            raise CpioError("cpio archive is not seekable")
+        self.skip_to(0)
+        self.member = None
+        self.done = False
 
-        if magic in [NEW_MAGIC, CRC_MAGIC, OLD_MAGIC]:
-            return True
+    def is_cpiofile(self,cpiofile=None,fileobj=None):
+        try:
+            if fileobj:
+                magic = int(fileobj.read(6),8)
+            else:
+                with open(cpiofile,'rb') as f:
+                    magic = int(f.read(6),8)
+        except ValueError:
+            return False
+        return magic in [NEW_MAGIC, CRC_MAGIC, OLD_MAGIC]
 
-    def read_old_ascii_cpio_record(self):
+    def read_old_ascii_cpio_header(self):
         f = {}
         try:
             f["dev"]	   = int(self.ifile.read(6),8)  #device where file resides
@@ -80,69 +201,318 @@ class CpioArchive(object):
             f["mtime"]	   = int(self.ifile.read(11),8) #modify time of file
             f["namesize"]  = int(self.ifile.read(6),8)  #length of file name
             f["filesize"]  = int(self.ifile.read(11),8) #length of file to follow
-            f["name"] = self.ifile.read(f.get("namesize"))[:-1] # Removing \x00
-            f["data"] = self.ifile.read(f.get("filesize"))
+            f["name"] = self.ifile.read(f.get("namesize"))[:-1].decode("utf-8", "surrogateescape") # Removing \x00
         except:
             print('ERROR: cpio record trunked (incomplete archive)')
             return None
         return f
 
-    def extract_files(self,files=None,outpath="."):
-        print("Extracting files from CPIO archive" )
-        while 1:
-            try:
-                hdr = int(self.ifile.read(6),8)
-            except:
-                print('ERROR: cpio record trunked (incomplete archive)')
-                break
+    def read_old_ascii_cpio_record(self):
+        f = self.read_old_ascii_cpio_header()
+        if f:
+            f["data"] = self.ifile.read(f.get("filesize"))
+        return f
+
+    def read(self, size):
+        data = self.ifile.read(size)
+        self.pos += len(data)
+        if len(data) != size:
+            raise EOFError("cpio record trunked (incomplete archive)")
+        return data
+
+    def skip_to(self, offset):
+        if self.pos == offset:
+            return
+        if self.seekable:
+            self.ifile.seek(self.base + offset)
+            self.pos = offset
+        elif offset < self.pos:
+            raise CpioError("cpio archive is not seekable")
+        else:
+            while self.pos < offset:
+                self.read(min(offset - self.pos, BUFSIZE))
+
+    def read_member_data(self, member, size):
+        offset = member.data_offset + member.consumed
+        if member is not self.member and not self.seekable:
+            raise CpioError("Data of %s is no longer available" % member.name)
+        self.skip_to(offset)
+        data = self.read(size)
+        member.consumed += size
+        return data
+
+    def read_header(self):
+        offset = self.pos
+        magic = self.read(6)
+        try:
+            magic = int(magic, 8)
+        except ValueError:
+            raise CpioError("Invalid cpio magic %r at offset %d" % (magic, offset))
+        if magic == OLD_MAGIC:
+            hdr = self.read(ODC_HEADER_SIZE - 6)
+            f = {"dev": int(hdr[0:6], 8),
+                 "ino": int(hdr[6:12], 8),
+                 "mode": int(hdr[12:18], 8),
+                 "uid": int(hdr[18:24], 8),
+                 "gid": int(hdr[24:30], 8),
+                 "nlink": int(hdr[30:36], 8),
+                 "rdev": int(hdr[36:42], 8),
+                 "mtime": int(hdr[42:53], 8),
+                 "namesize": int(hdr[53:59], 8),
+                 "filesize": int(hdr[59:70], 8)}
+            name = self.read(f["namesize"])
+        elif magic in (NEW_MAGIC, CRC_MAGIC):
+            hdr = self.read(NEWC_HEADER_SIZE - 6)
+            v = [int(hdr[i:i+8], 16) for i in range(0, 104, 8)]
+            f = {"ino": v[0],
+                 "mode": v[1],
+                 "uid": v[2],
+                 "gid": v[3],
+                 "nlink": v[4],
+                 "mtime": v[5],
+                 "filesize": v[6],
+                 "dev": os.makedev(v[7], v[8]) if hasattr(os, "makedev") else v[7] << 8 | v[8],
+                 "rdev": os.makedev(v[9], v[10]) if hasattr(os, "makedev") else v[9] << 8 | v[10],
+                 "namesize": v[11],
+                 "check": v[12]}
+            # name is padded so that header + name is a multiple of 4
+            name = self.read(f["namesize"] + (-(NEWC_HEADER_SIZE + f["namesize"]) % 4))
+        else:
+            raise CpioError("Unsupported cpio format %o at offset %d" % (magic, offset))
+        name = name[:f["namesize"] - 1].decode("utf-8", "surrogateescape") # Removing \x00
+        return CpioMember(self, magic, f, name, offset, self.pos)
+
+    def next(self):
+        """
+        Return the next member header, or None at the end of the archive.
+        """
+        if self.done:
+            return None
+        if self.member:
+            self.skip_to(self.member.end)
+        try:
+            self.member = self.read_header()
+        except EOFError:
+            print('ERROR: cpio record trunked (incomplete archive)')
+            self.member = None
+        if not self.member or self.member.name == TRAILER:
+            self.member = None
+            self.done = True
+        return self.member
+
+    __next__ = next
 
-            if hdr != OLD_MAGIC:
-                raise NotImplementedError #FIXME Should implement new & Binary CPIO record
-            
-            f = self.read_old_ascii_cpio_record()            
-            if f and f.get("name") == TRAILER:
+    def __iter__(self):
+        while True:
+            member = self.next()
+            if member is None:
                 break
-            
-            if files:
-                if not f.get("name") in files:
-                    print("Skipped %s" % f.get("name"))
-                    continue
-            
-            fullOutPath = os.path.join(outpath,f.get("name").strip("../")) 
+            yield member
+
+    def getmembers(self):
+        return list(self)
+
+    def getnames(self):
+        return [m.name for m in self]
+
+    def list(self, verbose=False):
+        """
+        Print the archive content like cpio -t without extracting it.
+        """
+        for m in self:
+            if verbose:
+                name = m.name
+                if m.issym():
+                    name += " -> " + m.readlink()
+                print("%06o %5d %5d %12d %s" % (m.mode, m.uid, m.gid, m.filesize, name))
+            else:
+                print(m.name)
+
+    def output_path(self, member, outpath="."):
+        """
+        Return where member is extracted in outpath. Raise CpioError if the
+        name, or a symbolic link extracted before it, leads outside outpath.
+        """
+        path = os.path.join(outpath, member.name.lstrip("/"))
+        root = os.path.realpath(outpath)
+        # a symbolic link member is checked without following itself
+        parent, name = os.path.split(os.path.normpath(path))
+        real = os.path.join(os.path.realpath(parent), name) if member.issym() else os.path.realpath(path)
+        if real != root and not real.startswith(root.rstrip(os.sep) + os.sep):
+            raise CpioError("Refusing to extract %s outside of %s" % (member.name, outpath))
+        return path
+
+    def extract(self, member, outpath=".", verbose=True):
+        fullOutPath = self.output_path(member, outpath)
+        if verbose:
             print("x %s" % fullOutPath)
+        dirname = os.path.dirname(fullOutPath)
+        ftype = member.mode & IFMT
 
-            if (f.get("mode") & IFMT == ISFIFO):#FIFO
-                if not os.path.isdir(os.path.dirname(fullOutPath)):
-                    os.makedirs(os.path.dirname(fullOutPath),0o0755)
-                os.mkfifo(fullOutPath, f.get("mode") & MODEMASK)
-                os.chmod(fullOutPath, f.get("mode") & MODEMASK)
-
-            if (f.get("mode") & IFMT == ISDIR): #Directory
-                if not os.path.isdir(fullOutPath):
-                    os.makedirs(fullOutPath, f.get("mode") & MODEMASK)
-   
-            if (f.get("mode") & IFMT == ISBLK): #Block special file
-                raise NotImplementedError
-            
-            if (f.get("mode") & IFMT == ISCHR): #Character special file
-                raise NotImplementedError
-            
-            if (f.get("mode") & IFMT == ISLNK): #Reserved for symbolic links
-                raise NotImplementedError
-
-            if (f.get("mode") & IFMT == ISOCK): #Reserved for sockets
-                raise NotImplementedError
-            
-            if (f.get("mode") & IFMT == ISCTG) or (f.get("mode") & IFMT == ISREG): #Contiguous or Regular file
-                if not os.path.isdir(os.path.dirname(fullOutPath)):
-                    os.makedirs(os.path.dirname(fullOutPath),0o0755)
-                fd = open(fullOutPath,"wb")
-                fd.write(f.get("data"))
-
-            os.chmod(fullOutPath, f.get("mode") & MODEMASK)
-        
-            
-if __name__ == "__main__":
-    a = CpioArchive(sys.argv[1],mode="rb",)
-    a.extract_files()
+        if ftype == ISDIR: #Directory
+            if not os.path.isdir(fullOutPath):
+                os.makedirs(fullOutPath, member.mode & MODEMASK)
+        elif dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o0755)
+
+        if ftype == ISFIFO: #FIFO
+            os.mkfifo(fullOutPath, member.mode & MODEMASK)
+
+        elif ftype == ISLNK: #Symbolic link, the link target is stored as member data
+            if os.path.isdir(fullOutPath) and not os.path.islink(fullOutPath):
+                raise CpioError("Cannot replace directory %s with a symbolic link" % fullOutPath)
+            if os.path.lexists(fullOutPath):
+                os.unlink(fullOutPath)
+            os.symlink(member.readlink(), fullOutPath)
+            return
+
+        elif ftype in (ISBLK, ISCHR, ISOCK): #Block/Character special file, socket
+            raise CpioError("Skipping special file %s" % member.name)
+
+        elif ftype in (ISCTG, ISREG): #Contiguous or Regular file
+            if os.path.islink(fullOutPath):
+                os.unlink(fullOutPath)
+            with open(fullOutPath,"wb") as fd:
+                member.copyto(fd)
+
+        os.chmod(fullOutPath, member.mode & MODEMASK)
+
+    def extract_files(self,files=None,outpath=".",patterns=None,threads=0):
+        """
+        Extract the members named in files, or matching one of the glob
+        patterns, to outpath. With threads > 0 the archive is indexed first
+        and file writes are dispatched to a pool of threads.
+        """
+        if threads:
+            return self.extract_parallel(outpath, patterns, threads, files=files)
+        print("Extracting files from CPIO archive" )
+        for member in self:
+            if not self.match(member, files, patterns):
+                print("Skipped %s" % member.name)
+                continue
+            try:
+                self.extract(member, outpath)
+            except CpioError as e:
+                print("ERROR: %s" % e)
+
+    def match(self, member, files=None, patterns=None):
+        if files and member.name in files:
+            return True
+        if patterns:
+            return any(fnmatch(member.name, p) for p in patterns)
+        return not files
+
+    def build_index(self):
+        """
+        Map member names to their headers (offset, size, mode...) in a single
+        pass over the archive, skipping member data.
+        """
+        if self.index is None:
+            if self.pos:
+                self.rewind()
+            self.index = OrderedDict((m.name, m) for m in self)
+        return self.index
+
+    def extract_parallel(self, outpath=".", patterns=None, threads=8, verbose=False, files=None):
+        if not self.seekable:
+            raise CpioError("Parallel extraction requires a seekable archive")
+        members, paths = [], []
+        for m in self.build_index().values():
+            if not self.match(m, files, patterns):
+                continue
+            try:
+                paths.append(self.output_path(m, outpath))
+                members.append(m)
+            except CpioError as e:
+                print("ERROR: %s" % e)
+
+        # create every directory once, before dispatching the writes
+        dirs = set(p for m, p in zip(members, paths) if m.isdir())
+        dirs.update(os.path.dirname(p) for m, p in zip(members, paths) if not m.isdir())
+        for d in sorted(dirs):
+            if d and not os.path.isdir(d):
+                os.makedirs(d, 0o0755)
+
+        try:
+            fd = self.ifile.fileno() if hasattr(os, "pread") else None
+        except (AttributeError, IOError, ValueError):
+            fd = None
+        pending = threading.BoundedSemaphore(threads * 2)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            jobs = []
+            for m, path in zip(members, paths):
+                if verbose:
+                    print("x %s" % path)
+                if m.isreg():
+                    pending.acquire()
+                    data = None if fd is not None else self.read_member_data(m, m.filesize)
+                    jobs.append(pool.submit(self.write_member, m, path, fd, data, pending))
+                elif not m.isdir() and not m.issym():
+                    try:
+                        self.extract(m, outpath, verbose=False)
+                    except CpioError as e:
+                        print("ERROR: %s" % e)
+            for job in jobs:
+                job.result()
 
+        # paths were checked before any symbolic link existed, create them
+        # once nothing else is written
+        for m in members:
+            if m.issym():
+                try:
+                    self.extract(m, outpath, verbose=False)
+                except CpioError as e:
+                    print("ERROR: %s" % e)
+
+        # restore directory modes last, they may not be writable
+        for m, path in zip(members, paths):
+            if m.isdir():
+                os.chmod(path, m.mode & MODEMASK)
+        return len(members)
+
+    def write_member(self, member, path, fd=None, data=None, pending=None):
+        try:
+            out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0) |
+                          getattr(os, "O_NOFOLLOW", 0), 0o0600)
+            try:
+                offset, size = member.data_offset, member.filesize
+                while size > 0:
+                    if data is None:
+                        chunk = os.pread(fd, min(size, BUFSIZE), self.base + offset)
+                        if not chunk:
+                            raise EOFError("cpio record trunked (incomplete archive)")
+                    else:
+                        chunk = memoryview(data)[member.filesize - size:]
+                    n = os.write(out, chunk)
+                    offset += n
+                    size -= n
+            finally:
+                os.close(out)
+            os.chmod(path, member.mode & MODEMASK)
+        finally:
+            if pending:
+                pending.release()
+
+
+def main():
+    parser = OptionParser(usage="%prog [-t] [-j THREADS] [-o OUTPUT] archive [pattern ...]")
+    parser.add_option("-t", "--list", dest="list", action="store_true", default=False,
+                      help="List the archive content")
+    parser.add_option("-j", "--threads", dest="threads", default=0, type="int",
+                      help="Extract files with THREADS writer threads")
+    parser.add_option("-o", "--output", dest="output", default=".",
+                      help="Extract to OUTPUT directory", type="string")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("Missing archive")
+
+    a = CpioArchive(args[0],mode="rb")
+    if options.list:
+        a.list(verbose=True)
+    else:
+        a.extract_files(outpath=options.output, patterns=args[1:], threads=options.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# $Id$
+#
+# Copyright (c) 2012-2023 "dark[-at-]gotohack.org"
+#
+# This file is part of pymobiledevice
+#
+# pymobiledevice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import logging
+import threading
+
+from six.moves import queue
+
+
+class DiskWriterPool(object):
+    """
+    Run blocking disk operations on a pool of threads so that the caller
+    can keep reading from the device.
+
+    Operations submitted with the same key (e.g. a file name) run in
+    submission order on the same thread. Every thread has a bounded queue:
+    submit() blocks when storage falls behind, which bounds the memory held
+    by pending writes. barrier() waits for every pending operation and
+    returns the failures in submission order.
+    """
+
+    def __init__(self, workers=4, queue_size=64, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.seq = 0
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = []
+        for q in self.queues:
+            t = threading.Thread(target=self.worker, args=(q,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def worker(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    break
+                seq, key, func, args = item
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.logger.error("Disk operation on %s failed: %s", key, e)
+                    with self.lock:
+                        self.errors.append((seq, key, e))
+            finally:
+                q.task_done()
+
+    def submit(self, key, func, *args):
+        self.seq += 1
+        self.queues[hash(key) % len(self.queues)].put((self.seq, key, func, args))
+
+    def barrier(self):
+        """
+        Wait for all submitted operations, returns [(key, exception), ...]
+        """
+        for q in self.queues:
+            q.join()
+        with self.lock:
+            errors, self.errors = sorted(self.errors, key=lambda e: e[0]), []
+        return [(key, e) for _, key, e in errors]
+
+    def close(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
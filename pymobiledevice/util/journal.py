@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# $Id$
+#
+# Copyright (c) 2012-2023 "dark[-at-]gotohack.org"
+#
+# This file is part of pymobiledevice
+#
+# pymobiledevice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import json
+import logging
+import threading
+
+from time import time
+
+
+class BackupJournal(object):
+    """
+    Append-only record of the files completed during a backup session.
+
+    Every line of the journal is a JSON object: the first one describes the
+    session, the next ones give the path, size and digest of each file
+    received. Lines are flushed as they are written so that the journal
+    survives the process; a line truncated by a crash is ignored on load.
+    """
+
+    def __init__(self, path, algorithm="sha1", logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.session = None
+        self.entries = {}
+        self.f = None
+
+    def load(self):
+        """
+        Read an existing journal, returns False if there is none.
+        """
+        self.session = None
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.warning("Ignoring truncated journal line in %s", self.path)
+                    continue
+                if "session" in entry:
+                    self.session = entry
+                else:
+                    self.entries[entry["path"]] = (entry["size"], entry["digest"])
+        return self.session is not None
+
+    def start(self, **session):
+        """
+        Open the journal for writing, starting a new session unless a
+        session was loaded.
+        """
+        if self.session is None:
+            self.entries = {}
+            self.session = dict(session, session=time(), algorithm=self.algorithm)
+        # rewrite the journal, dropping duplicate and truncated lines
+        tmp = self.path + ".tmp"
+        self.f = open(tmp, "w")
+        self.write(self.session)
+        for path, (size, digest) in self.entries.items():
+            self.write({"path": path, "size": size, "digest": digest})
+        os.replace(tmp, self.path)
+
+    def write(self, entry):
+        self.f.write(json.dumps(entry) + "\n")
+        self.f.flush()
+
+    def add(self, path, size, digest):
+        with self.lock:
+            self.entries[path] = (size, digest)
+            if self.f:
+                self.write({"path": path, "size": size, "digest": digest})
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.session = None
+        self.entries = {}
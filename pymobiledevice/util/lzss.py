@@ -18,62 +18,387 @@
  *  DRI: Josh de Cesare
  */
 """
-from array import array
 import struct
+import zlib
 
 N = 4096
 F = 18
 THRESHOLD = 2
 NIL = N
 
-def decompress_lzss(str):
-    if str[:8] !="complzss":
+COMPLZSS_MAGIC = b"complzss"
+# magic, adler32 of the uncompressed data, uncompressed size, compressed size
+COMPLZSS_HEADER = struct.Struct(">8sLLL")
+COMPLZSS_HEADER_SIZE = 0x180
+# one flag byte followed by 8 two bytes references
+MAX_GROUP_SIZE = 1 + 8 * 2
+# output bytes per input byte can not exceed 16 matches of F bytes per 17 bytes
+MAX_EXPANSION = 9
+
+
+def _lzss_decode(src, pos, end, buf, v, limit, final, base=0):
+    """
+    Decodes src[pos:end] into buf, a preallocated bytearray whose first N
+    bytes are the ring buffer contents and where index v is ring position
+    (v + base - F) % N. Decoding stops at limit in buf and, unless final,
+    before an incomplete flag group. Returns the new (pos, v).
+    """
+    while v < limit:
+        if end - pos < MAX_GROUP_SIZE and (not final or pos >= end):
+            break
+        flags = src[pos]
+        pos += 1
+        if flags == 0xFF and end - pos >= 8 and limit - v >= 8:
+            # eight literals in a row
+            buf[v:v + 8] = src[pos:pos + 8]
+            pos += 8
+            v += 8
+            continue
+        for bit in (1, 2, 4, 8, 16, 32, 64, 128):
+            if flags & bit:
+                if pos >= end or v >= limit:
+                    break
+                buf[v] = src[pos]
+                pos += 1
+                v += 1
+            else:
+                if pos + 2 > end or v >= limit:
+                    break
+                i = src[pos]
+                j = src[pos + 1]
+                pos += 2
+                i |= (j & 0xF0) << 4
+                n = (j & 0x0F) + THRESHOLD + 1
+                # distance back to the last write of ring position i
+                d = ((v + base - F - i) & (N - 1)) or N
+                s = v - d
+                if n > limit - v:
+                    n = limit - v
+                if d >= n:
+                    buf[v:v + n] = buf[s:s + n]
+                else:
+                    # the match overlaps its own output: repeat the pattern
+                    buf[v:v + n] = (buf[s:v] * (n // d + 1))[:n]
+                v += n
+    return pos, v
+
+
+def _as_bytes(data):
+    if isinstance(data, memoryview) and data.format != "B":
+        return data.cast("B")
+    return data
+
+
+def decompress(data, size=None):
+    """
+    Decompresses a raw lzss stream (without complzss header).
+    size bounds the output, it defaults to the largest possible size.
+    """
+    data = _as_bytes(data)
+    if size is None:
+        size = len(data) * MAX_EXPANSION
+    buf = bytearray(b" " * N) + bytearray(size)
+    pos, v = _lzss_decode(data, 0, len(data), buf, N, N + size, True)
+    return bytes(memoryview(buf)[N:v])
+
+
+def read_header(data):
+    """
+    Returns (adler32, uncompressed size, compressed size) from a complzss
+    header, or None if the magic is missing.
+    """
+    if len(data) < COMPLZSS_HEADER.size:
+        return
+    magic, adler32, decompsize, compsize = COMPLZSS_HEADER.unpack_from(data)
+    if magic != COMPLZSS_MAGIC:
+        return
+    return adler32, decompsize, compsize
+
+
+def decompress_lzss(data):
+    header = read_header(data)
+    if not header:
         print("decompress_lzss: complzss magic missing")
         return
-    decompsize = struct.unpack(">L", str[12:16])[0]
-    text_buf = array("B", " "*(N + F - 1))
-    src = array("B", str[0x180:])
-    srclen = len(src)
-    dst = array("B", " "*decompsize)
-    r = N - F
-    srcidx, dstidx, flags, c = 0, 0, 0, 0
+    adler32, decompsize, compsize = header
+    src = memoryview(_as_bytes(data))[COMPLZSS_HEADER_SIZE:]
+    if compsize and compsize < len(src):
+        src = src[:compsize]
+    return decompress(src, decompsize)
 
-    while True:
-        flags >>= 1
-        if ((flags & 0x100) == 0):
-            if (srcidx >= srclen):
-                break
-            c = src[srcidx]
-            srcidx += 1
-            flags = c | 0xFF00
-
-        if (flags & 1):
-            if (srcidx >= srclen):
-                break
-            c = src[srcidx]
-            srcidx += 1
-            dst[dstidx] = c
-            dstidx += 1
-            text_buf[r] = c
-            r += 1
-            r &= (N - 1)
-        else:
-            if (srcidx >= srclen):
-                break
-            i = src[srcidx]
-            srcidx += 1
-            if (srcidx >= srclen):
-                break
-            j = src[srcidx]
-            srcidx += 1
-            i |= ((j & 0xF0) << 4)
-            j  =  (j & 0x0F) + THRESHOLD
-            for k in range(j + 1):
-                c = text_buf[(i + k) & (N - 1)]
-                dst[dstidx] = c
-                dstidx += 1
-                text_buf[r] = c
-                r += 1
-                r &= (N - 1)
-    return dst.tostring()
 
+class LZSSDecompressor(object):
+    """
+    Incremental lzss decompressor. Feed the raw stream (without complzss
+    header) through decompress(), which returns the output available so far,
+    then call flush() to decode a trailing incomplete flag group.
+    Only the last N output bytes are kept between calls.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.total = 0
+        self.window = bytearray(b" " * N)
+        self.pending = b""
+
+    @property
+    def eof(self):
+        return self.size is not None and self.total >= self.size
+
+    def _decode(self, data, final):
+        src = self.pending + bytes(data) if self.pending else _as_bytes(data)
+        room = len(src) * MAX_EXPANSION
+        if self.size is not None:
+            room = min(room, self.size - self.total)
+        buf = self.window + bytearray(room)
+        pos, v = _lzss_decode(src, 0, len(src), buf, N, N + room, final, self.total)
+        self.total += v - N
+        self.pending = b"" if self.eof else bytes(src[pos:])
+        self.window = buf[v - N:v]
+        return bytes(memoryview(buf)[N:v])
+
+    def decompress(self, data):
+        if self.eof:
+            return b""
+        return self._decode(data, False)
+
+    def flush(self):
+        if self.eof or not self.pending:
+            self.pending = b""
+            return b""
+        return self._decode(b"", True)
+
+
+def decompress_lzss_stream(fin, fout, chunk_size=1 << 20):
+    """
+    Decompresses the complzss file object fin into fout chunk by chunk.
+    Returns the number of bytes written, or None if the magic is missing.
+    """
+    header = read_header(fin.read(COMPLZSS_HEADER_SIZE))
+    if not header:
+        print("decompress_lzss: complzss magic missing")
+        return
+    adler32, decompsize, compsize = header
+    decompressor = LZSSDecompressor(decompsize)
+    remaining = compsize or None
+    while not decompressor.eof:
+        chunk = fin.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        fout.write(decompressor.decompress(chunk))
+        if remaining == 0:
+            break
+    fout.write(decompressor.flush())
+    return decompressor.total
+
+
+HASH_BITS = 15
+HASH_MASK = (1 << HASH_BITS) - 1
+# level: (longest hash chain walked, lazy matching, index positions inside matches)
+LEVELS = {
+    1: (4, False, False),
+    2: (8, False, True),
+    3: (16, False, True),
+    4: (16, True, True),
+    5: (32, True, True),
+    6: (64, True, True),
+    7: (128, True, True),
+    8: (512, True, True),
+    9: (N, True, True),
+}
+DEFAULT_LEVEL = 6
+
+
+class LZSSCompressor(object):
+    """
+    Incremental lzss compressor producing streams for the N=4096/F=18
+    decoder. Matches are found through hash chains over 3 byte prefixes,
+    level trades speed for ratio as in zlib. Memory is bounded: only the
+    last N input bytes, a 2**HASH_BITS head table and an N entries chain
+    are kept between calls to compress().
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL):
+        if level not in LEVELS:
+            raise ValueError("lzss: invalid compression level %r" % level)
+        self.max_chain, self.lazy, self.insert_all = LEVELS[level]
+        self.head = [-1] * (HASH_MASK + 1)
+        self.prev = [-1] * N
+        self.buf = b""
+        # input offset of buf[0], and next position to encode in buf
+        self.base = 0
+        self.pos = 0
+        self.out = bytearray()
+        # offset in out of the current flag byte and its next bit
+        self.flag_pos = 0
+        self.flag_bit = 0x100
+        self.total_in = 0
+
+    def _encode(self, final):
+        buf = self.buf
+        n = len(buf)
+        end = n if final else n - F
+        base = self.base
+        head, prev = self.head, self.prev
+        max_chain, insert_all = self.max_chain, self.insert_all
+        out = self.out
+        flag_pos, flag_bit = self.flag_pos, self.flag_bit
+        mask = N - 1
+
+        def find(p):
+            """Returns the longest match at p as (length, source offset)
+               and indexes p"""
+            if p + 2 >= n:
+                return 0, 0
+            h = ((buf[p] << 10) ^ (buf[p + 1] << 5) ^ buf[p + 2]) & HASH_MASK
+            a = p + base
+            c = head[h]
+            prev[a & mask] = c
+            head[h] = a
+            low = a - N
+            if low < 0:
+                low = 0
+            maxlen = n - p if n - p < F else F
+            best_len, best = THRESHOLD, 0
+            chain = max_chain
+            while c >= low and chain:
+                i = c - base
+                if buf[i + best_len] == buf[p + best_len]:
+                    if buf[i:i + maxlen] == buf[p:p + maxlen]:
+                        best_len, best = maxlen, c
+                        break
+                    l = 0
+                    while buf[i + l] == buf[p + l]:
+                        l += 1
+                    if l > best_len:
+                        best_len, best = l, c
+                nc = prev[c & mask]
+                if nc >= c:
+                    break
+                c = nc
+                chain -= 1
+            if best_len > THRESHOLD:
+                return best_len, best
+            return 0, 0
+
+        p = self.pos
+        while p < end:
+            length, src = find(p)
+            indexed = p + 1
+            if self.lazy:
+                while length and length < F and p + 1 < end:
+                    next_length, next_src = find(p + 1)
+                    indexed = p + 2
+                    if next_length <= length:
+                        break
+                    if flag_bit == 0x100:
+                        flag_pos = len(out)
+                        out.append(0)
+                        flag_bit = 1
+                    out[flag_pos] |= flag_bit
+                    out.append(buf[p])
+                    flag_bit <<= 1
+                    p += 1
+                    length, src = next_length, next_src
+            if flag_bit == 0x100:
+                flag_pos = len(out)
+                out.append(0)
+                flag_bit = 1
+            if length:
+                r = (src + N - F) & mask
+                out.append(r & 0xFF)
+                out.append(((r >> 4) & 0xF0) | (length - THRESHOLD - 1))
+                flag_bit <<= 1
+                if insert_all:
+                    q = indexed
+                    stop = p + length
+                    if stop > n - 2:
+                        stop = n - 2
+                    while q < stop:
+                        h = ((buf[q] << 10) ^ (buf[q + 1] << 5) ^ buf[q + 2]) & HASH_MASK
+                        a = q + base
+                        prev[a & mask] = head[h]
+                        head[h] = a
+                        q += 1
+                p += length
+            else:
+                out[flag_pos] |= flag_bit
+                out.append(buf[p])
+                flag_bit <<= 1
+                p += 1
+
+        self.pos = p
+        self.flag_pos, self.flag_bit = flag_pos, flag_bit
+        # flag bytes are only complete once their 8 tokens are written
+        ready = len(out) if final or flag_bit == 0x100 else flag_pos
+        result = bytes(out[:ready])
+        del out[:ready]
+        self.flag_pos -= ready
+        return result
+
+    def _trim(self):
+        drop = self.pos - N
+        if drop > 0:
+            self.buf = self.buf[drop:]
+            self.base += drop
+            self.pos -= drop
+
+    def compress(self, data):
+        self.total_in += len(data)
+        self.buf = self.buf + bytes(data)
+        result = self._encode(False)
+        self._trim()
+        return result
+
+    def flush(self):
+        result = self._encode(True)
+        self._trim()
+        self.flag_bit = 0x100
+        return result
+
+
+def compress(data, level=DEFAULT_LEVEL):
+    """Compresses data into a raw lzss stream (without complzss header)"""
+    compressor = LZSSCompressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def make_header(adler32, size, compsize):
+    return COMPLZSS_HEADER.pack(COMPLZSS_MAGIC, adler32, size, compsize).ljust(COMPLZSS_HEADER_SIZE, b"\x00")
+
+
+def compress_lzss(data, level=DEFAULT_LEVEL):
+    """Compresses data into a complzss container"""
+    stream = compress(data, level)
+    return make_header(zlib.adler32(data) & 0xFFFFFFFF, len(data), len(stream)) + stream
+
+
+def compress_lzss_stream(fin, fout, level=DEFAULT_LEVEL, chunk_size=1 << 20):
+    """
+    Compresses file object fin into a complzss container written to fout,
+    which must be seekable as the header is filled in last.
+    Returns the compressed stream size.
+    """
+    start = fout.tell()
+    fout.write(make_header(0, 0, 0))
+    compressor = LZSSCompressor(level)
+    adler32 = zlib.adler32(b"")
+    compsize = 0
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            break
+        adler32 = zlib.adler32(chunk, adler32)
+        out = compressor.compress(chunk)
+        fout.write(out)
+        compsize += len(out)
+    out = compressor.flush()
+    fout.write(out)
+    compsize += len(out)
+    end = fout.tell()
+    fout.seek(start)
+    fout.write(make_header(adler32 & 0xFFFFFFFF, compressor.total_in, compsize))
+    fout.seek(end)
+    return compsize
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+#
+# $Id$
+#
+# Copyright (c) 2012-2023 "dark[-at-]gotohack.org"
+#
+# This file is part of pymobiledevice
+#
+# pymobiledevice is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import json
+import logging
+
+from time import time
+
+# index of the overall progress (0-100) in the device link messages that carry it
+PROGRESS_INDEX = {
+    "DLMessageDownloadFiles": 3,
+    "DLMessageUploadFiles": 2,
+    "DLMessageMoveFiles": 3,
+    "DLMessageMoveItems": 3,
+    "DLMessageRemoveFiles": 3,
+    "DLMessageRemoveItems": 3,
+    "DLMessageCopyItem": 3,
+    "DLMessageCreateDirectory": 2,
+    "DLContentsOfDirectory": 2,
+}
+
+
+class BackupProgress(object):
+    """
+    Track the progress of a MobileBackup2 session.
+
+    Counts the files and bytes received, the time spent waiting for the
+    device (network) and for storage (disk), and the overall progress
+    announced by the device in its messages. Progress events are plain
+    dicts passed to callback and/or written as JSON lines to stream, at
+    most once every interval seconds.
+    """
+
+    def __init__(self, callback=None, stream=None, interval=1.0, clock=time, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.callback = callback
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.start()
+
+    def start(self):
+        self.started = self.clock()
+        self.files = 0
+        self.bytes = 0
+        self.network_time = 0.0
+        self.disk_time = 0.0
+        self.progress = None
+        self.free_space = None
+        self.message = None
+        self.last_time = self.started
+        self.last_bytes = 0
+
+    def device_message(self, msg):
+        """
+        Record the name of a device link message and its progress hint.
+        """
+        self.message = msg[0]
+        index = PROGRESS_INDEX.get(msg[0])
+        if index is not None and len(msg) > index and isinstance(msg[index], (int, float)) \
+                and not isinstance(msg[index], bool) and msg[index] > 0:
+            self.progress = float(msg[index])
+        self.update()
+
+    def set_free_space(self, free_space):
+        self.free_space = free_space
+
+    def add_network(self, seconds, size=0):
+        self.network_time += seconds
+        self.bytes += size
+
+    def add_disk(self, seconds):
+        self.disk_time += seconds
+
+    def file_received(self):
+        self.files += 1
+        self.update()
+
+    def eta(self, now):
+        """
+        Seconds left according to the device progress, None while unknown.
+        """
+        if not self.progress or self.progress >= 100:
+            return None
+        return (now - self.started) * (100 - self.progress) / self.progress
+
+    def expected_bytes(self):
+        if not self.progress or not self.bytes:
+            return None
+        return int(self.bytes * 100 / self.progress)
+
+    def event(self, now, kind="progress"):
+        elapsed = now - self.started
+        dt = now - self.last_time
+        expected = self.expected_bytes()
+        return {
+            "event": kind,
+            "time": now,
+            "elapsed": elapsed,
+            "message": self.message,
+            "files": self.files,
+            "bytes": self.bytes,
+            "rate": (self.bytes - self.last_bytes) / dt if dt > 0 else 0.0,
+            "average_rate": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "progress": self.progress,
+            "eta": self.eta(now),
+            "network_time": self.network_time,
+            "disk_time": self.disk_time,
+            "free_space": self.free_space,
+            "expected_bytes": expected,
+            "space_ok": None if expected is None or self.free_space is None
+                        else expected - self.bytes <= self.free_space,
+        }
+
+    def update(self, force=False, kind="progress"):
+        now = self.clock()
+        if not force and now - self.last_time < self.interval:
+            return
+        self.emit(self.event(now, kind))
+        self.last_time = now
+        self.last_bytes = self.bytes
+
+    def finish(self):
+        self.update(force=True, kind="done")
+
+    def emit(self, event):
+        if self.callback:
+            try:
+                self.callback(event)
+            except Exception:
+                self.logger.exception("Progress callback failed")
+        if self.stream:
+            self.stream.write(json.dumps(event) + "\n")
+            self.stream.flush()
@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+'''backup index test case
+'''
+
+import hashlib
+import os
+import plistlib
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+
+from pymobiledevice.backup_index import BackupIndex, BackupIndexError, FLAG_FILE, FLAG_DIRECTORY
+
+FILES = [
+    ("HomeDomain", "Library/SMS/sms.db", b"sms"),
+    ("HomeDomain", "Library/Notes/notes.sqlite", b"notes"),
+    ("CameraRollDomain", "Media/DCIM/100APPLE/IMG_0001.JPG", b"\xff\xd8jpeg"),
+]
+
+
+def file_blob(size, mtime, mode):
+    return plistlib.dumps({
+        "$version": 100000,
+        "$archiver": "NSKeyedArchiver",
+        "$top": {"root": plistlib.UID(1)},
+        "$objects": ["$null", {"Size": size, "LastModified": mtime, "Mode": mode,
+                               "$class": plistlib.UID(2)},
+                     {"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]}],
+    }, fmt=plistlib.FMT_BINARY)
+
+
+def mbdb_string(s):
+    if s is None:
+        return b"\xff\xff"
+    return struct.pack(">H", len(s)) + s
+
+
+def file_id(domain, path):
+    return hashlib.sha1((domain + "-" + path).encode()).hexdigest()
+
+
+class BackupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "udid")
+        os.makedirs(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_manifest_db(self):
+        db = sqlite3.connect(os.path.join(self.path, "Manifest.db"))
+        db.execute("CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, "
+                   "flags INTEGER, file BLOB)")
+        db.execute("INSERT INTO Files VALUES (?, ?, ?, ?, ?)", (file_id("HomeDomain", "Library"),
+                   "HomeDomain", "Library", FLAG_DIRECTORY, file_blob(0, 1000, 0o40755)))
+        for domain, path, data in FILES:
+            fid = file_id(domain, path)
+            db.execute("INSERT INTO Files VALUES (?, ?, ?, ?, ?)",
+                       (fid, domain, path, FLAG_FILE, file_blob(len(data), 1500000000, 0o100644)))
+            os.makedirs(os.path.join(self.path, fid[:2]), exist_ok=True)
+            with open(os.path.join(self.path, fid[:2], fid), "wb") as f:
+                f.write(data)
+        db.commit()
+        db.close()
+
+    def make_mbdb(self):
+        data = b"mbdb\x05\x00"
+        for domain, path, content in FILES:
+            data += mbdb_string(domain.encode()) + mbdb_string(path.encode())
+            data += mbdb_string(None) + mbdb_string(b"\x00" * 20) + mbdb_string(None)
+            data += struct.pack(">HQLLLLLQBB", 0o100644, 1, 501, 501, 1400000000, 0, 0, len(content), 4, 1)
+            data += mbdb_string(b"com.apple.backup.x") + mbdb_string(b"y")
+            with open(os.path.join(self.path, file_id(domain, path)), "wb") as f:
+                f.write(content)
+        with open(os.path.join(self.path, "Manifest.mbdb"), "wb") as f:
+            f.write(data)
+
+    def check_index(self, index):
+        self.assertEqual(len(index.glob()), 3)
+        entry = index.lookup("HomeDomain", "Library/SMS/sms.db")
+        self.assertEqual(entry.file_id, file_id("HomeDomain", "Library/SMS/sms.db"))
+        self.assertEqual(entry.size, 3)
+        self.assertEqual(index.domains(), ["CameraRollDomain", "HomeDomain"])
+        self.assertEqual([e.path for e in index.glob("Library/*", "Home*")],
+                         ["Library/Notes/notes.sqlite", "Library/SMS/sms.db"])
+        self.assertEqual(index.glob("*.JPG")[0].domain, "CameraRollDomain")
+        outpath = os.path.join(self.tmpdir, "out")
+        extracted = list(index.extract(index.glob("*.JPG"), outpath))
+        self.assertEqual(len(extracted), 1)
+        with open(os.path.join(outpath, "CameraRollDomain", "Media/DCIM/100APPLE/IMG_0001.JPG"), "rb") as f:
+            self.assertEqual(f.read(), b"\xff\xd8jpeg")
+
+    def test_manifest_db(self):
+        self.make_manifest_db()
+        index = BackupIndex(self.path)
+        self.check_index(index)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup("HomeDomain", "Library").flags, FLAG_DIRECTORY)
+        self.assertEqual(index.lookup("HomeDomain", "Library/SMS/sms.db").mtime, 1500000000)
+
+    def test_mbdb(self):
+        self.make_mbdb()
+        index = BackupIndex(self.path)
+        self.check_index(index)
+        self.assertEqual(index.lookup("HomeDomain", "Library/SMS/sms.db").mtime, 1400000000)
+
+    def test_cache(self):
+        self.make_manifest_db()
+        BackupIndex(self.path)
+        self.assertTrue(os.path.exists(self.path + ".index"))
+        read_manifest_db = BackupIndex.read_manifest_db
+        try:
+            BackupIndex.read_manifest_db = None
+            self.assertEqual(len(BackupIndex(self.path)), 4)
+        finally:
+            BackupIndex.read_manifest_db = read_manifest_db
+        os.unlink(os.path.join(self.path, "Manifest.db"))
+        self.make_mbdb()
+        # the manifest changed, the cache is not used
+        index = BackupIndex(self.path)
+        self.assertTrue(index.flat)
+        with open(os.path.join(self.path, "Manifest.mbdb"), "wb") as f:
+            f.write(b"mbdb\x05\x00")
+        os.utime(os.path.join(self.path, "Manifest.mbdb"), (0, 0))
+        self.assertEqual(len(BackupIndex(self.path)), 0)
+
+    def test_no_manifest(self):
+        self.assertRaises(BackupIndexError, BackupIndex, self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+'''blobstore test case
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from pymobiledevice.util.blobstore import BlobStore
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.tmpdir, "store"), inline_size=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_deduplication(self):
+        a = os.path.join(self.tmpdir, "a")
+        b = os.path.join(self.tmpdir, "b")
+        for path in (a, b):
+            for size in (10, 5000):
+                w = self.store.open(path + ".partial")
+                w.write(b"x" * size)
+                w.write(b"y")
+                w.commit(path + str(size))
+        self.assertEqual(self.read(a + "10"), b"x" * 10 + b"y")
+        self.assertEqual(self.read(b + "5000"), b"x" * 5000 + b"y")
+        self.assertTrue(os.path.samefile(a + "10", b + "10"))
+        self.assertTrue(os.path.samefile(a + "5000", b + "5000"))
+        self.assertFalse(os.path.exists(a + ".partial"))
+
+    def test_replace_and_gc(self):
+        path = os.path.join(self.tmpdir, "Info.plist")
+        self.store.write(path, b"first")
+        self.store.write(path, b"second")
+        self.assertEqual(self.read(path), b"second")
+        self.assertEqual(self.store.gc(), 1)
+        os.unlink(path)
+        self.assertEqual(self.store.gc(), 1)
+
+    def test_discard(self):
+        w = self.store.open(os.path.join(self.tmpdir, "big.partial"))
+        w.write(b"z" * 4096)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "big.partial")))
+        w.close()
+        self.assertEqual(os.listdir(self.tmpdir), ["store"])
+
+    def test_concurrent_add(self):
+        # writer pool threads committing identical files at the same time
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def commit(i, data):
+            path = os.path.join(self.tmpdir, "f%d" % i)
+            try:
+                w = self.store.open(path + ".partial")
+                w.write(data)
+                barrier.wait()
+                w.commit(path)
+            except Exception as e:
+                errors.append(e)
+
+        # each trial commits a new content so that its blob does not exist yet
+        for trial, data in enumerate([b""] + [b"%d" % i for i in range(100)] + [b"big%d" % i * 1000 for i in range(100)]):
+            threads = [threading.Thread(target=commit, args=(trial * 8 + i, data)) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.read(os.path.join(self.tmpdir, "f0")), b"")
+        self.assertEqual(self.read(os.path.join(self.tmpdir, "f1607")), b"big99" * 1000)
+        self.assertEqual([f for root, dirs, files in os.walk(self.store.root) for f in files if f.endswith(".tmp")], [])
+        self.assertEqual(self.store.gc(), 0)
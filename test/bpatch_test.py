@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+'''bpatch test case
+'''
+
+import bz2
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pymobiledevice.util import bpatch
+
+
+def offtout(x):
+    return struct.pack("<Q", -x | (1 << 63) if x < 0 else x)
+
+
+def make_patch(controls, diff, extra, new_len):
+    control = b"".join(offtout(x) + offtout(y) + offtout(z) for x, y, z in controls)
+    blocks = [bz2.compress(control), bz2.compress(diff), bz2.compress(extra)]
+    return b"BSDIFF40" + offtout(len(blocks[0])) + offtout(len(blocks[1])) + offtout(new_len) + b"".join(blocks)
+
+
+def reference_patch(old, controls, diff, extra):
+    new = bytearray()
+    old_pos, diff_pos, extra_pos = 0, 0, 0
+    for x, y, z in controls:
+        for i in range(x):
+            c = diff[diff_pos + i]
+            if 0 <= old_pos + i < len(old):
+                c = (c + old[old_pos + i]) & 0xFF
+            new.append(c)
+        diff_pos += x
+        old_pos += x
+        new += extra[extra_pos:extra_pos + y]
+        extra_pos += y
+        old_pos += z
+    return bytes(new)
+
+
+class BpatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.rnd = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_files(self, old, patch):
+        paths = [os.path.join(self.tmp, name) for name in ("old", "new", "patch")]
+        with open(paths[0], "wb") as f:
+            f.write(old)
+        with open(paths[2], "wb") as f:
+            f.write(patch)
+        return paths
+
+    def run_patch(self, old, controls, diff, extra, chunk_size=bpatch.CHUNK_SIZE):
+        expected = reference_patch(old, controls, diff, extra)
+        paths = self.write_files(old, make_patch(controls, diff, extra, len(expected)))
+        bpatch.patch(paths[0], paths[1], paths[2], chunk_size)
+        with open(paths[1], "rb") as f:
+            self.assertEqual(f.read(), expected)
+
+    def random_bytes(self, n):
+        return bytes(self.rnd.randrange(256) for i in range(n))
+
+    def test_patch(self):
+        old = self.random_bytes(50000)
+        controls = [(10000, 500, 2000), (20000, 0, -15000), (3000, 1000, 40000), (5000, 10, -60000), (100, 0, 0)]
+        diff = self.random_bytes(sum(c[0] for c in controls))
+        extra = self.random_bytes(sum(c[1] for c in controls))
+        self.run_patch(old, controls, diff, extra)
+        self.run_patch(old, controls, diff, extra, chunk_size=777)
+
+    def test_empty_old(self):
+        self.run_patch(b"", [(100, 50, 0)], self.random_bytes(100), self.random_bytes(50))
+
+    def test_add_bytes(self):
+        a, b = self.random_bytes(1000), self.random_bytes(1000)
+        self.assertEqual(bpatch.add_bytes(a, b), bytes((x + y) & 0xFF for x, y in zip(a, b)))
+        self.assertEqual(bpatch.add_bytes(b"\xff\x80\x7f", b"\x01\x80\x01"), b"\x00\x00\x80")
+
+    def test_offtin(self):
+        for x in (0, 1, 2 ** 40, -5, -2 ** 62):
+            self.assertEqual(bpatch.offtin(offtout(x)), x)
+
+    def test_corrupt(self):
+        # diff block shorter than the control block says
+        paths = self.write_files(b"abc", make_patch([(100, 0, 0)], b"x" * 50, b"", 100))
+        self.assertRaises(ValueError, bpatch.patch, *paths)
+        # control block writing past the new file size
+        paths = self.write_files(b"abc", make_patch([(10, 0, 0)], b"x" * 10, b"", 5))
+        self.assertRaises(ValueError, bpatch.patch, *paths)
+        paths = self.write_files(b"abc", b"BSDIFF39" + b"\x00" * 24)
+        self.assertRaises(ValueError, bpatch.patch, *paths)
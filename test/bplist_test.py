@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+'''bplist test case
+'''
+
+import datetime
+import io
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from pymobiledevice.util.bplist import BPListWriter, BPlistReader, LazyBPlist, BPlistDict, BPlistArray
+
+SAMPLE = {
+    "ints": [0, 1, 255, 256, 65535, 65536, 2**32, 2**63 - 1, 2**64 - 1, -1, -2**63],
+    "floats": [0.0, -1.5, 1e300],
+    "bools": [True, False, 1, 0, 1.0],
+    "data": [b"", b"\x00" * 14, b"x" * 15, os.urandom(300)],
+    "strings": ["", "ascii", "x" * 100, u"unicodé", u"\U0001F600 emoji"],
+    "date": datetime.datetime(2021, 6, 1, 10, 20, 30),
+    "uid": plistlib.UID(70000),
+    "nested": {"a": {"b": [{"c": []}, {}]}},
+}
+
+
+class BPListWriterTest(unittest.TestCase):
+
+    def check(self, obj):
+        data = BPListWriter(obj).binary()
+        self.assertEqual(plistlib.loads(data), obj)
+        self.assertEqual(BPlistReader(data).parse(), obj)
+        return data
+
+    def test_roundtrip(self):
+        self.check(SAMPLE)
+        for v in [0, "top", b"data", [], {}]:
+            self.check(v)
+
+    def test_stdlib_messages(self):
+        for msg in [{"Request": "GetValue", "Label": "pyMobileDevice"},
+                    ["DLMessageProcessMessage", {"MessageName": "Backup", "Options": {"ForceFullBackup": True}}],
+                    {"Command": "Browse", "ClientOptions": {"ReturnAttributes": ["CFBundleIdentifier"] * 3}}]:
+            data = self.check(msg)
+            self.assertLessEqual(len(data), len(plistlib.dumps(msg, fmt=plistlib.FMT_BINARY)))
+
+    def test_uniquing(self):
+        shared = ["x"] * 10
+        data = self.check({"a": shared, "b": shared, "c": "x" * 40, "d": "x" * 40})
+        # 1 dict, 4 keys, 1 list, "x", "x" * 40
+        self.assertEqual(int.from_bytes(data[-24:-16], "big"), 8)
+
+    def test_sizes(self):
+        data = BPListWriter(list(range(300))).binary()
+        # 301 objects: 2 byte references, offsets still fit in 2 bytes
+        self.assertEqual(data[-26:-24], b"\x02\x02")
+        self.assertEqual(plistlib.loads(data), list(range(300)))
+
+    def test_deep_nesting(self):
+        obj = top = []
+        for i in range(20000):
+            child = []
+            obj.append(child)
+            obj = child
+        data = BPListWriter(top).binary()
+        self.assertEqual(int.from_bytes(data[-24:-16], "big"), 20001)
+
+    def test_write(self):
+        buf = io.BytesIO()
+        BPListWriter(SAMPLE).write(buf)
+        self.assertEqual(plistlib.loads(buf.getvalue()), SAMPLE)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.plist")
+            BPListWriter(SAMPLE).write(path)
+            with open(path, "rb") as f:
+                self.assertEqual(plistlib.load(f), SAMPLE)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_subclasses(self):
+        class Items(list):
+            pass
+        obj = OrderedDict([("b", Items([1, 2])), ("a", OrderedDict([("x", bytearray(b"raw"))]))])
+        data = BPListWriter(obj).binary()
+        self.assertEqual(plistlib.loads(data), {"a": {"x": b"raw"}, "b": [1, 2]})
+        self.assertEqual(BPlistReader(data).parse(), {"a": {"x": b"raw"}, "b": [1, 2]})
+
+    def test_bytearray(self):
+        self.check({"a": bytearray(b"xy"), "b": bytearray(b"xy"), "c": [bytearray()]})
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, BPListWriter({"a": object()}).binary)
+
+
+class LazyBPlistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = {"Applications": dict(("com.example.app%d" % i, {"Path": "/app%d" % i, "Size": i})
+                                              for i in range(1000)),
+                         "Files": [{"Domain": "HomeDomain", "Path": "file%d" % i} for i in range(1000)],
+                         "Version": "9.1"}
+        self.data = BPListWriter(self.manifest).binary()
+
+    def test_views(self):
+        reader = LazyBPlist(self.data)
+        root = reader.root
+        self.assertIsInstance(root, BPlistDict)
+        self.assertEqual(root["Version"], "9.1")
+        self.assertEqual(root["Applications"]["com.example.app42"]["Size"], 42)
+        files = root["Files"]
+        self.assertIsInstance(files, BPlistArray)
+        self.assertEqual(len(files), 1000)
+        self.assertEqual(files[-1]["Path"], "file999")
+        self.assertEqual([f["Path"] for f in files[10:12]], ["file10", "file11"])
+        self.assertNotIn("Missing", root)
+        self.assertRaises(KeyError, root.__getitem__, "Missing")
+        self.assertEqual(reader.parse(), self.manifest)
+
+    def test_lazy_decoding(self):
+        reader = LazyBPlist(self.data, cache_size=16)
+        decoded = []
+        unpack = reader._unpackItem
+
+        def count(offset):
+            decoded.append(offset)
+            return unpack(offset)
+
+        reader._unpackItem = count
+        self.assertEqual(reader.root["Files"][500]["Domain"], "HomeDomain")
+        # root, its 3 keys, the Files array, one entry, its 2 keys and the value: 9 objects out of ~5000
+        self.assertEqual(len(decoded), 9)
+        for i in range(100):
+            reader.root["Files"][i]["Path"]
+        self.assertLessEqual(len(reader.cache), 16)
+
+    def test_mmap(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "Manifest.plist")
+            with open(path, "wb") as f:
+                f.write(self.data)
+            with LazyBPlist.open(path) as reader:
+                self.assertEqual(reader.root["Applications"]["com.example.app7"]["Path"], "/app7")
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,92 @@
+# -*- coding:utf-8 -*-
+'''ccl_bplist benchmark
+
+Decodes synthetic NSKeyedArchiver archives shaped like the ones found in
+backups (arrays of dictionaries of strings, numbers, dates and data), then
+unarchives them and walks the result twice:
+
+    python test/ccl_bplist_bench.py [-n ROUNDS] [-r RECORDS]
+'''
+
+import os
+import plistlib
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymobiledevice.util import ccl_bplist
+
+
+def make_archive(records, shared_strings=True):
+    """NSKeyedArchiver bplist of an NSArray of `records` NSDictionary"""
+    objects = ["$null"]
+
+    def add(obj):
+        objects.append(obj)
+        return plistlib.UID(len(objects) - 1)
+
+    dict_class = add({"$classname": "NSDictionary", "$classes": ["NSDictionary", "NSObject"]})
+    array_class = add({"$classname": "NSArray", "$classes": ["NSArray", "NSObject"]})
+    date_class = add({"$classname": "NSDate", "$classes": ["NSDate", "NSObject"]})
+    keys = [add(k) for k in ("identifier", "title", "count", "created", "payload", "tags")]
+    items = []
+    for i in range(records):
+        values = [add("id-%08d" % i), add(u"Note n°%d" % i), add(i * 37),
+                  add({"NS.time": 600000000.0 + i, "$class": date_class}),
+                  add(os.urandom(32)),
+                  add({"NS.objects": [add("tag%d" % (i % 10)), add("tag%d" % (i % 7))], "$class": array_class})]
+        items.append(add({"NS.keys": keys, "NS.objects": values, "$class": dict_class}))
+    root = add({"NS.objects": items, "$class": array_class})
+    return plistlib.dumps({"$version": 100000, "$archiver": "NSKeyedArchiver", "$top": {"root": root},
+                           "$objects": objects}, fmt=plistlib.FMT_BINARY)
+
+
+def walk(o):
+    """Touches every element of a deserialised archive"""
+    count = 0
+    for item in o["NS.objects"]:
+        count += len(item["NS.keys"]) + len(item["NS.objects"][5]["NS.objects"])
+    return count
+
+
+def unarchive_lazy(data):
+    root = ccl_bplist.deserialise_NsKeyedArchiver(ccl_bplist.loads(data))
+    walk(root)
+    walk(root)
+
+
+def unarchive_plain(data):
+    root = ccl_bplist.deserialise_NsKeyedArchiver(ccl_bplist.loads(data), plain=True)
+    walk(root)
+    walk(root)
+
+
+def bench(func, arg, rounds):
+    start = time.time()
+    for i in range(rounds):
+        func(arg)
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = OptionParser(usage="%prog")
+    parser.add_option("-n", "--rounds", dest="rounds", default=5, type="int",
+                      help="Number of decodings per measure")
+    parser.add_option("-r", "--records", dest="records", default=20000, type="int",
+                      help="Number of records of the largest archive")
+    (options, args) = parser.parse_args()
+
+    print("%-10s %10s %10s %14s %14s %14s %14s" % ("records", "objects", "size", "ccl_bplist", "plistlib",
+                                                 "lazy x2", "plain x2"))
+    for records in (options.records // 100, options.records // 10, options.records):
+        data = make_archive(records)
+        count = len(plistlib.loads(data)["$objects"])
+        times = [bench(ccl_bplist.loads, data, options.rounds), bench(plistlib.loads, data, options.rounds),
+                 bench(unarchive_lazy, data, options.rounds), bench(unarchive_plain, data, options.rounds)]
+        print("%-10d %10d %10d %s" % (records, count, len(data), " ".join("%12.1fms" % (t * 1000) for t in times)))
+
+
+if __name__ == '__main__':
+    main()
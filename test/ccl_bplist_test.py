@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+'''ccl_bplist test case
+'''
+
+import datetime
+import io
+import plistlib
+import unittest
+
+from pymobiledevice.util import ccl_bplist
+from pymobiledevice.util.bplist import BPListWriter
+
+
+class CclBplistTest(unittest.TestCase):
+
+    def test_load(self):
+        obj = {"ints": [0, 255, 40000, 2**31 + 1, 2**40, -1, -2**63],
+               "float": 1.5, "bools": [True, False], "data": b"\x00" * 20,
+               "strings": ["ascii" * 10, u"unicodé"], "date": datetime.datetime(2020, 5, 4, 3, 2, 1),
+               "nested": {"a": [{"b": []}, {}]}}
+        data = plistlib.dumps(obj, fmt=plistlib.FMT_BINARY)
+        self.assertEqual(ccl_bplist.load(io.BytesIO(data)), obj)
+        self.assertEqual(ccl_bplist.loads(data), obj)
+
+    def test_uid(self):
+        data = plistlib.dumps({"root": plistlib.UID(3)}, fmt=plistlib.FMT_BINARY)
+        self.assertEqual(ccl_bplist.loads(data)["root"].value, 3)
+
+    def test_deep(self):
+        obj = top = []
+        for i in range(20000):
+            obj.append([])
+            obj = obj[0]
+        res = ccl_bplist.loads(BPListWriter(top).binary())
+        depth = 0
+        while res:
+            res = res[0]
+            depth += 1
+        self.assertEqual(depth, 20000)
+
+    def test_shared_objects(self):
+        shared = {"x": 1}
+        res = ccl_bplist.loads(BPListWriter([shared, shared]).binary())
+        self.assertIs(res[0], res[1])
+
+    def test_bad_header(self):
+        self.assertRaises(ccl_bplist.BplistError, ccl_bplist.loads, b"xxxxxxxx" + b"\x00" * 32)
+
+
+def make_archive(root, objects):
+    archive = {"$version": 100000, "$archiver": "NSKeyedArchiver",
+               "$top": {"root": plistlib.UID(root)}, "$objects": ["$null"] + objects}
+    return ccl_bplist.loads(plistlib.dumps(archive, fmt=plistlib.FMT_BINARY))
+
+
+class NsKeyedArchiverTest(unittest.TestCase):
+
+    def setUp(self):
+        # root NSArray holding the same NSDictionary twice and a $null
+        self.archive = make_archive(1, [
+            {"NS.objects": [plistlib.UID(3), plistlib.UID(3), plistlib.UID(0)], "$class": plistlib.UID(2)},
+            {"$classname": "NSArray", "$classes": ["NSArray", "NSObject"]},
+            {"NS.keys": [plistlib.UID(4)], "NS.objects": [plistlib.UID(5)], "$class": plistlib.UID(6)},
+            "name", "value",
+            {"$classname": "NSMutableDictionary", "$classes": ["NSMutableDictionary", "NSObject"]}])
+
+    def test_lazy(self):
+        root = ccl_bplist.deserialise_NsKeyedArchiver(self.archive)
+        items = root["NS.objects"]
+        self.assertIs(items[0], items[1])
+        self.assertIs(root["NS.objects"], items)
+        self.assertEqual(items[0]["NS.keys"][0], "name")
+        self.assertEqual(items[2], "$null")
+        self.assertEqual(ccl_bplist.convert_NSMutableDictionary(items[0]), {"name": "value"})
+        self.assertIs(ccl_bplist.deserialise_NsKeyedArchiver(self.archive), root)
+
+    def test_plain(self):
+        root = ccl_bplist.deserialise_NsKeyedArchiver(self.archive, plain=True)
+        self.assertEqual(type(root), dict)
+        items = root["NS.objects"]
+        self.assertIs(items[0], items[1])
+        self.assertIsNone(items[2])
+        self.assertEqual(items[0]["NS.objects"], ["value"])
+        self.assertEqual(root["$class"]["$classname"], "NSArray")
+
+    def test_cycle(self):
+        archive = make_archive(1, [{"NS.objects": [plistlib.UID(1)]}])
+        root = ccl_bplist.deserialise_NsKeyedArchiver(archive)
+        self.assertIs(root["NS.objects"][0], root)
+        root = ccl_bplist.deserialise_NsKeyedArchiver(archive, plain=True)
+        self.assertIs(root["NS.objects"][0], root)
+
+    def test_iter(self):
+        items = list(ccl_bplist.iter_NsKeyedArchiver(self.archive, plain=True))
+        self.assertEqual(len(items), 3)
+        self.assertIs(items[0], items[1])
+        pairs = list(ccl_bplist.iter_NsKeyedArchiver(make_archive(1, [
+            {"NS.keys": [plistlib.UID(2)], "NS.objects": [plistlib.UID(3)]}, "k", "v"])))
+        self.assertEqual(pairs, [("k", "v")])
+
+    def test_not_archive(self):
+        self.assertRaises(ValueError, ccl_bplist.deserialise_NsKeyedArchiver, {"$objects": []})
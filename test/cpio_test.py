@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+'''cpio test case
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymobiledevice.util.cpio import CpioArchive, CpioError, OLD_MAGIC, NEW_MAGIC, CRC_MAGIC
+
+
+def odc_member(name, mode, data=b""):
+    name = name.encode("utf-8") + b"\x00"
+    hdr = b"070707" + b"".join(b"%06o" % v for v in (0, 0, mode, 0, 0, 1, 0))
+    hdr += b"%011o%06o%011o" % (0, len(name), len(data))
+    return hdr + name + data
+
+
+def newc_member(name, mode, data=b"", crc=False, offset=0):
+    name = name.encode("utf-8") + b"\x00"
+    check = sum(bytearray(data)) & 0xFFFFFFFF if crc else 0
+    hdr = b"070702" if crc else b"070701"
+    hdr += b"".join(b"%08x" % v for v in (1, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name), check))
+    hdr += name
+    hdr += b"\x00" * (-(offset + len(hdr)) % 4)
+    return hdr + data + b"\x00" * (-(offset + len(hdr) + len(data)) % 4)
+
+
+def make_archive(members, fmt=OLD_MAGIC):
+    archive = b""
+    for name, mode, data in members + [("TRAILER!!!", 0, b"")]:
+        if fmt == OLD_MAGIC:
+            archive += odc_member(name, mode, data)
+        else:
+            archive += newc_member(name, mode, data, fmt == CRC_MAGIC, len(archive))
+    return archive
+
+
+MEMBERS = [("./Library", 0o40755, b""),
+           ("./Library/a.db", 0o100644, b"A" * 5),
+           ("./Library/big", 0o100600, os.urandom(100000)),
+           ("./Library/link", 0o120777, b"a.db"),
+           ("./Library/empty", 0o100644, b"")]
+
+
+class NonSeekable(io.RawIOBase):
+
+    def __init__(self, data):
+        self.f = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class CpioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_list(self):
+        for fmt in (OLD_MAGIC, NEW_MAGIC, CRC_MAGIC):
+            archive = CpioArchive(fileobj=io.BytesIO(make_archive(MEMBERS, fmt)))
+            self.assertEqual(archive.getnames(), [m[0] for m in MEMBERS])
+
+    def test_lazy_read(self):
+        for fmt in (OLD_MAGIC, NEW_MAGIC, CRC_MAGIC):
+            for fileobj in (io.BytesIO, NonSeekable):
+                archive = CpioArchive(fileobj=fileobj(make_archive(MEMBERS, fmt)))
+                members = {}
+                for member in archive:
+                    members[member.name] = member
+                    if member.name == "./Library/a.db":
+                        self.assertEqual(member.read(2), b"AA")
+                        self.assertEqual(member.read(), b"AAA")
+                    if member.issym():
+                        self.assertEqual(member.readlink(), "a.db")
+                self.assertEqual(members["./Library/big"].filesize, 100000)
+                if fileobj is io.BytesIO:
+                    self.assertEqual(members["./Library/big"].read(), MEMBERS[2][2])
+                else:
+                    self.assertRaises(CpioError, members["./Library/big"].read)
+
+    def test_crc_mismatch(self):
+        archive = bytearray(make_archive(MEMBERS, CRC_MAGIC))
+        archive[archive.index(b"AAAAA")] = ord("B")
+        member = [m for m in CpioArchive(fileobj=io.BytesIO(bytes(archive)))][1]
+        self.assertRaises(CpioError, member.read)
+
+    def test_extract_files(self):
+        for fmt in (OLD_MAGIC, NEW_MAGIC):
+            outpath = os.path.join(self.tmpdir, str(fmt))
+            CpioArchive(fileobj=NonSeekable(make_archive(MEMBERS, fmt))).extract_files(outpath=outpath)
+            with open(os.path.join(outpath, "Library", "big"), "rb") as f:
+                self.assertEqual(f.read(), MEMBERS[2][2])
+            self.assertEqual(os.readlink(os.path.join(outpath, "Library", "link")), "a.db")
+            self.assertEqual(os.path.getsize(os.path.join(outpath, "Library", "empty")), 0)
+
+    def test_build_index(self):
+        data = make_archive(MEMBERS, NEW_MAGIC)
+        index = CpioArchive(fileobj=io.BytesIO(data)).build_index()
+        self.assertEqual(list(index), [m[0] for m in MEMBERS])
+        big = index["./Library/big"]
+        self.assertEqual(data[big.data_offset:big.data_offset + big.filesize], MEMBERS[2][2])
+
+    def test_extract_parallel(self):
+        path = os.path.join(self.tmpdir, "archive.cpio")
+        with open(path, "wb") as f:
+            f.write(make_archive(MEMBERS, NEW_MAGIC))
+        for fileobj in (open(path, "rb"), io.BytesIO(make_archive(MEMBERS))):
+            outpath = os.path.join(self.tmpdir, "out%d" % isinstance(fileobj, io.BytesIO))
+            archive = CpioArchive(fileobj=fileobj)
+            archive.extract_files(outpath=outpath, patterns=["*/big", "*/link"], threads=4)
+            fileobj.close()
+            with open(os.path.join(outpath, "Library", "big"), "rb") as f:
+                self.assertEqual(f.read(), MEMBERS[2][2])
+            self.assertEqual(sorted(os.listdir(os.path.join(outpath, "Library"))), ["big", "link"])
+            self.assertEqual(os.stat(os.path.join(outpath, "Library", "big")).st_mode & 0o777, 0o600)
+
+    def test_truncated_archive(self):
+        archive = CpioArchive(fileobj=io.BytesIO(make_archive(MEMBERS)[:200]))
+        self.assertEqual(archive.getnames(), ["./Library", "./Library/a.db"])
+
+    def test_hostile_archive(self):
+        target = os.path.join(self.tmpdir, "target")
+        os.mkdir(target)
+        hostile = make_archive([("d", 0o40755, b""),
+                                ("d/l", 0o120777, target.encode("utf-8")),
+                                ("d/l/pwned", 0o100644, b"x"),
+                                ("../escaped", 0o100644, b"x"),
+                                ("d/ok", 0o100644, b"ok")], NEW_MAGIC)
+        for threads in (0, 4):
+            outpath = os.path.join(self.tmpdir, "out%d" % threads)
+            CpioArchive(fileobj=io.BytesIO(hostile)).extract_files(outpath=outpath, threads=threads)
+            self.assertEqual(os.listdir(target), [])
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "escaped")))
+            # links are created last by the parallel extraction, d/l is a directory there
+            self.assertEqual(os.path.islink(os.path.join(outpath, "d", "l")), threads == 0)
+            with open(os.path.join(outpath, "d", "ok"), "rb") as f:
+                self.assertEqual(f.read(), b"ok")
+
+    def test_special_files(self):
+        members = [("./dev", 0o40755, b""),
+                   ("./dev/null", 0o20666, b""),
+                   ("./dev/after", 0o100644, b"after")]
+        for threads in (0, 4):
+            outpath = os.path.join(self.tmpdir, "out%d" % threads)
+            CpioArchive(fileobj=io.BytesIO(make_archive(members, NEW_MAGIC))).extract_files(outpath=outpath, threads=threads)
+            self.assertFalse(os.path.exists(os.path.join(outpath, "dev", "null")))
+            with open(os.path.join(outpath, "dev", "after"), "rb") as f:
+                self.assertEqual(f.read(), b"after")
+
+    def test_unsupported_format(self):
+        archive = CpioArchive(fileobj=io.BytesIO(b"070727" + b"0" * 100))
+        self.assertRaises(CpioError, archive.read_header)
@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+'''diskwriter test case
+'''
+
+import time
+import unittest
+
+from pymobiledevice.util.diskwriter import DiskWriterPool
+
+
+class DiskWriterTest(unittest.TestCase):
+
+    def test_ordering_per_key(self):
+        pool = DiskWriterPool(workers=4, queue_size=2)
+        results = {}
+
+        def append(key, value):
+            time.sleep(0.001 * (value % 3))
+            results.setdefault(key, []).append(value)
+
+        for i in range(50):
+            for key in ("a", "b", "c"):
+                pool.submit(key, append, key, i)
+        self.assertEqual(pool.barrier(), [])
+        for key in ("a", "b", "c"):
+            self.assertEqual(results[key], list(range(50)))
+        pool.close()
+
+    def test_errors_in_submission_order(self):
+        pool = DiskWriterPool(workers=3)
+
+        def fail(message, delay=0):
+            time.sleep(delay)
+            raise IOError(message)
+
+        pool.submit("x", fail, "first", 0.05)
+        pool.submit("y", fail, "second")
+        pool.submit("z", time.sleep, 0)
+        errors = pool.barrier()
+        self.assertEqual([(k, str(e)) for k, e in errors], [("x", "first"), ("y", "second")])
+        self.assertEqual(pool.barrier(), [])
+        pool.close()
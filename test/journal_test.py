@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+'''journal test case
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymobiledevice.util.journal import BackupJournal
+
+
+class BackupJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "udid.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        j = BackupJournal(self.path)
+        self.assertFalse(j.load())
+        j.start(full=True)
+        j.add("udid/ab/abcdef", 5, "digest1")
+        j.add("udid/cd/cdef", 0, "digest2")
+        j.close()
+        with open(self.path, "a") as f:
+            f.write('{"path": "udid/ef/trunc')
+
+        j = BackupJournal(self.path)
+        self.assertTrue(j.load())
+        self.assertTrue(j.session["full"])
+        self.assertEqual(len(j), 2)
+        self.assertEqual(j.get("udid/ab/abcdef"), (5, "digest1"))
+        self.assertIsNone(j.get("udid/ef/trunc"))
+        # a loaded session is continued
+        j.start(full=True)
+        j.add("udid/ab/abcdef", 6, "digest3")
+        j.close()
+        j = BackupJournal(self.path)
+        j.load()
+        self.assertEqual(j.get("udid/ab/abcdef"), (6, "digest3"))
+
+    def test_remove(self):
+        j = BackupJournal(self.path)
+        j.start()
+        j.add("a", 1, "x")
+        j.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(len(j), 0)
@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+'''lzss benchmark
+
+Decompresses synthetic kernelcache sized lzss streams one shot, streamed in
+1MB chunks, and with the original byte by byte decoder, then compresses a
+synthetic kernelcache-like image at every level:
+
+    python test/lzss_bench.py [-s MEGABYTES] [-n ROUNDS] [-l LEVELS]
+'''
+
+import os
+import random
+import struct
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymobiledevice.util import lzss
+from test.lzss_test import make_stream, reference_decompress
+
+
+def make_image(size, seed=0):
+    """Mach-O like image: code made of recurring instruction blocks, zero filled
+       padding, symbol strings and incompressible blobs"""
+    rnd = random.Random(seed)
+    words = [struct.pack("<L", rnd.getrandbits(32)) for i in range(512)]
+    blocks = [b"".join(rnd.choice(words) for j in range(rnd.randrange(2, 12))) for i in range(1024)]
+    symbols = [b"_%s_%s_%d\x00" % (rnd.choice([b"IOService", b"OSObject", b"vm_map", b"kalloc", b"mac_policy"]),
+                                    rnd.choice([b"init", b"free", b"start", b"copyout", b"lookup"]), i)
+               for i in range(4096)]
+    out = bytearray()
+    while len(out) < size:
+        kind = rnd.random()
+        if kind < 0.5:
+            out += b"".join(rnd.choice(blocks) if rnd.random() < 0.7 else rnd.choice(words) for i in range(256))
+        elif kind < 0.65:
+            out += bytes(rnd.randrange(1, 4) * 1024)
+        elif kind < 0.9:
+            out += b"".join(rnd.choice(symbols) for i in range(128))
+        else:
+            out += os.urandom(2048)
+    return bytes(out[:size])
+
+
+def streamed(stream):
+    decompressor = lzss.LZSSDecompressor()
+    size = 0
+    for i in range(0, len(stream), 1 << 20):
+        size += len(decompressor.decompress(stream[i:i + (1 << 20)]))
+    return size + len(decompressor.flush())
+
+
+def bench(func, rounds, *args):
+    start = time.time()
+    for i in range(rounds):
+        func(*args)
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = OptionParser(usage="%prog")
+    parser.add_option("-s", "--size", dest="size", default=16, type="int",
+                      help="Uncompressed size in MB")
+    parser.add_option("-n", "--rounds", dest="rounds", default=3, type="int",
+                      help="Number of decompressions per measure")
+    parser.add_option("--no-reference", dest="reference", default=True, action="store_false",
+                      help="Skip the original decoder")
+    parser.add_option("-l", "--levels", dest="levels", default="1,3,6,9",
+                      help="Comma separated compression levels")
+    (options, args) = parser.parse_args()
+
+    size = options.size << 20
+    print("%-14s %10s %14s %14s %14s" % ("matches", "ratio", "one shot", "streamed", "reference"))
+    for match_ratio in (0.3, 0.6, 0.9):
+        stream = make_stream(size, match_ratio=match_ratio)
+        times = [bench(lzss.decompress, options.rounds, stream, size), bench(streamed, options.rounds, stream)]
+        if options.reference:
+            times.append(bench(reference_decompress, 1, stream, size))
+        print("%-14s %10.2f %s" % ("%d%%" % (match_ratio * 100), size / float(len(stream)),
+                                   " ".join("%9.1f MB/s" % (options.size / t) for t in times)))
+
+    image = make_image(size)
+    print("")
+    print("%-14s %10s %14s %14s" % ("level", "ratio", "compress", "decompress"))
+    for level in [int(l) for l in options.levels.split(",")]:
+        start = time.time()
+        stream = lzss.compress(image, level)
+        elapsed = time.time() - start
+        assert lzss.decompress(stream, size) == image
+        print("%-14d %10.2f %9.1f MB/s %9.1f MB/s" % (level, size / float(len(stream)), options.size / elapsed,
+                                                      options.size / bench(lzss.decompress, 1, stream, size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+'''lzss test case
+'''
+
+import io
+import random
+import struct
+import unittest
+import zlib
+
+from pymobiledevice.util import lzss
+
+
+def reference_decompress(src, size):
+    """The original byte by byte decoder"""
+    N, F = lzss.N, lzss.F
+    text_buf = bytearray(b" " * (N + F - 1))
+    dst = bytearray()
+    r = N - F
+    srcidx, flags = 0, 0
+    while len(dst) < size:
+        flags >>= 1
+        if (flags & 0x100) == 0:
+            if srcidx >= len(src):
+                break
+            flags = src[srcidx] | 0xFF00
+            srcidx += 1
+        if flags & 1:
+            if srcidx >= len(src):
+                break
+            c = src[srcidx]
+            srcidx += 1
+            dst.append(c)
+            text_buf[r] = c
+            r = (r + 1) & (N - 1)
+        else:
+            if srcidx + 1 >= len(src):
+                break
+            i = src[srcidx] | ((src[srcidx + 1] & 0xF0) << 4)
+            j = (src[srcidx + 1] & 0x0F) + lzss.THRESHOLD
+            srcidx += 2
+            for k in range(j + 1):
+                c = text_buf[(i + k) & (N - 1)]
+                dst.append(c)
+                text_buf[r] = c
+                r = (r + 1) & (N - 1)
+    return bytes(dst[:size])
+
+
+def make_stream(size, seed=0, match_ratio=0.6):
+    """Random lzss token stream decoding to about size bytes"""
+    rnd = random.Random(seed)
+    out = bytearray()
+    total = 0
+    while total < size:
+        flags = 0
+        tokens = bytearray()
+        for bit in range(8):
+            if rnd.random() < match_ratio:
+                pos = rnd.randrange(lzss.N)
+                length = rnd.randrange(16)
+                tokens += struct.pack("BB", pos & 0xFF, ((pos >> 4) & 0xF0) | length)
+                total += length + lzss.THRESHOLD + 1
+            else:
+                flags |= 1 << bit
+                tokens.append(rnd.randrange(256))
+                total += 1
+        out.append(flags)
+        out += tokens
+    return bytes(out)
+
+
+def make_complzss(stream, data):
+    return lzss.make_header(zlib.adler32(data) & 0xFFFFFFFF, len(data), len(stream)) + stream
+
+
+class LzssTest(unittest.TestCase):
+
+    def test_reference(self):
+        for seed in range(5):
+            stream = make_stream(50000, seed, match_ratio=seed * 0.2)
+            expected = reference_decompress(stream, 1 << 30)
+            self.assertEqual(lzss.decompress(stream), expected)
+            self.assertEqual(lzss.decompress(memoryview(stream)), expected)
+            self.assertEqual(lzss.decompress(stream, 1000), expected[:1000])
+
+    def test_overlap(self):
+        # 'ab' then a match of 18 bytes starting at the 'a', and one into the initial spaces
+        stream = bytes([0x03]) + b"ab" + bytes([0xEE, 0xFF, 0x00, 0x80])
+        self.assertEqual(lzss.decompress(stream), b"ab" * 10 + b"   ")
+
+    def test_complzss(self):
+        stream = make_stream(100000, 7)
+        data = reference_decompress(stream, 1 << 30)
+        blob = make_complzss(stream, data) + b"trailing data"
+        self.assertEqual(lzss.decompress_lzss(blob), data)
+        self.assertEqual(lzss.read_header(blob)[1:], (len(data), len(stream)))
+        self.assertIsNone(lzss.decompress_lzss(b"x" * 0x200))
+
+    def test_stream(self):
+        stream = make_stream(200000, 3)
+        data = reference_decompress(stream, 1 << 30)
+        for chunk_size in (1, 7, 17, 4096, 1 << 20):
+            decompressor = lzss.LZSSDecompressor()
+            out = [decompressor.decompress(stream[i:i + chunk_size]) for i in range(0, len(stream), chunk_size)]
+            out.append(decompressor.flush())
+            self.assertEqual(b"".join(out), data)
+        fout = io.BytesIO()
+        self.assertEqual(lzss.decompress_lzss_stream(io.BytesIO(make_complzss(stream, data)), fout, 1000), len(data))
+        self.assertEqual(fout.getvalue(), data)
+
+    def test_stream_size(self):
+        stream = make_stream(10000, 4)
+        data = reference_decompress(stream, 1 << 30)
+        decompressor = lzss.LZSSDecompressor(5000)
+        out = decompressor.decompress(stream) + decompressor.decompress(stream) + decompressor.flush()
+        self.assertEqual(out, data[:5000])
+        self.assertTrue(decompressor.eof)
+
+    def test_round_trip(self):
+        samples = [b"", b"a", b"ab" * 5000, b" " * 3000, bytes(range(256)) * 40,
+                   make_stream(30000, 5), reference_decompress(make_stream(30000, 6), 1 << 30),
+                   random.Random(1).getrandbits(8 * 20000).to_bytes(20000, "little")]
+        for level in sorted(lzss.LEVELS):
+            for data in samples:
+                stream = lzss.compress(data, level)
+                self.assertEqual(reference_decompress(stream, len(data)), data)
+                self.assertEqual(lzss.decompress(stream, len(data)), data)
+        self.assertLess(len(lzss.compress(b"ab" * 5000)), 1200)
+        self.assertRaises(ValueError, lzss.LZSSCompressor, 0)
+
+    def test_compress_stream(self):
+        data = reference_decompress(make_stream(100000, 8), 1 << 30)
+        compressor = lzss.LZSSCompressor()
+        stream = b"".join(compressor.compress(data[i:i + 777]) for i in range(0, len(data), 777)) + compressor.flush()
+        self.assertEqual(lzss.decompress(stream, len(data)), data)
+        self.assertLessEqual(len(compressor.buf), lzss.N + lzss.F + 777)
+        fout = io.BytesIO()
+        compsize = lzss.compress_lzss_stream(io.BytesIO(data), fout, chunk_size=5000)
+        blob = fout.getvalue()
+        self.assertEqual(lzss.read_header(blob), (zlib.adler32(data) & 0xFFFFFFFF, len(data), compsize))
+        self.assertEqual(blob, lzss.compress_lzss(data))
+        self.assertEqual(lzss.decompress_lzss(blob), data)
@@ -0,0 +1,348 @@
+# -*- coding:utf-8 -*-
+'''mobilebackup2 test case
+'''
+
+import logging
+import os
+import plistlib
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+from unittest import mock
+
+from pymobiledevice.mobilebackup2 import MobileBackup2, CODE_FILE_DATA, CODE_SUCCESS, CODE_ERROR_REMOTE, \
+    PARTIAL_SUFFIX
+from pymobiledevice.util.diskwriter import DiskWriterPool
+from pymobiledevice.util.blobstore import BlobStore
+from pymobiledevice.util.progress import BackupProgress
+
+UDID = "0123456789abcdef0123456789abcdef01234567"
+
+
+class FakeService(object):
+
+    def __init__(self, frames=()):
+        self.frames = list(frames)
+        self.sent = []
+        self.plists = []
+
+    def recv_raw(self):
+        if self.frames:
+            return self.frames.pop(0)
+        return b""
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+        return 0
+
+    def send_raw(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self.send(struct.pack(">L", len(data)) + bytes(data))
+
+    def sendfile(self, f, offset=0, count=None):
+        f.seek(offset)
+        data = f.read(count)
+        self.sent.append(data)
+        return len(data)
+
+    def sendPlist(self, d):
+        self.plists.append(d)
+        return 0
+
+
+class FakeClient(object):
+
+    clients = []
+
+    def __init__(self, lockdown=None):
+        self.service = mock.Mock()
+        self.requests = []
+        self.clients.append(self)
+
+    def get_icon_pngdata(self, bid):
+        self.requests.append((bid, threading.current_thread().name))
+        return b"png " + bid.encode()
+
+    def get_file_contents(self, filename):
+        self.requests.append((filename, threading.current_thread().name))
+        if filename.endswith("iTunesPrefs"):
+            return b"prefs"
+
+
+class MobileBackup2Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, UDID, "ab"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_backup(self, frames=(), writer_threads=0, store=None, io_threads=0):
+        mb = MobileBackup2.__new__(MobileBackup2)
+        mb.logger = logging.getLogger(__name__)
+        mb.backupPath = self.tmpdir
+        mb.udid = UDID
+        mb.lockdown = None
+        mb.service = FakeService(frames)
+        mb.partials = {}
+        mb.partial_hashes = {}
+        mb.dir_cache = {}
+        if writer_threads:
+            mb.writer = DiskWriterPool(writer_threads)
+        mb.store = store
+        mb.io_threads = io_threads
+        return mb
+
+    def test_receive_multi_chunk_file(self):
+        chunks = [os.urandom(1000), os.urandom(10), os.urandom(4000)]
+        frames = [b"Media/a.jpg", UDID.encode() + b"/ab/abcdef"]
+        frames += [bytearray([CODE_FILE_DATA]) + c for c in chunks]
+        frames += [bytearray([CODE_SUCCESS]),
+                   b"Media/b.jpg", UDID.encode() + b"/ab/ab0000",
+                   bytearray([CODE_FILE_DATA]) + b"xx", bytearray([CODE_ERROR_REMOTE]) + b"denied"]
+        for writer_threads in (0, 2):
+            mb = self.make_backup(frames, writer_threads)
+            mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+            with open(os.path.join(self.tmpdir, UDID, "ab", "abcdef"), "rb") as f:
+                self.assertEqual(f.read(), b"".join(chunks))
+            self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, UDID, "ab"))), ["abcdef"])
+            self.assertEqual(mb.service.plists[-1][:2], ["DLMessageStatusResponse", 0])
+            os.unlink(os.path.join(self.tmpdir, UDID, "ab", "abcdef"))
+
+    def test_receive_into_store(self):
+        store = BlobStore(os.path.join(self.tmpdir, "store"), inline_size=100)
+        frames = []
+        for name in (b"/ab/small1", b"/ab/small2", b"/ab/big1", b"/ab/big2"):
+            frames += [b"Media/x", UDID.encode() + name,
+                       bytearray([CODE_FILE_DATA]) + (b"s" if b"small" in name else b"b" * 1000),
+                       bytearray([CODE_SUCCESS])]
+        mb = self.make_backup(frames, 2, store)
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+        d = os.path.join(self.tmpdir, UDID, "ab")
+        self.assertEqual(sorted(os.listdir(d)), ["big1", "big2", "small1", "small2"])
+        self.assertTrue(os.path.samefile(os.path.join(d, "small1"), os.path.join(d, "small2")))
+        self.assertTrue(os.path.samefile(os.path.join(d, "big1"), os.path.join(d, "big2")))
+        self.assertEqual(mb.read_file(UDID + "/ab/big2"), b"b" * 1000)
+
+    def test_receive_write_error(self):
+        frames = [b"Media/a.jpg", UDID.encode() + b"/missing/abcdef",
+                  bytearray([CODE_FILE_DATA]) + b"xx", bytearray([CODE_SUCCESS])]
+        for writer_threads in (0, 2):
+            mb = self.make_backup(frames, writer_threads)
+            self.assertRaises(IOError, mb.mb2_handle_receive_files, ["DLMessageUploadFiles", {}])
+            self.assertEqual(mb.service.plists, [])
+
+    def test_send_file_in_chunks(self):
+        data = os.urandom(70000)
+        with open(os.path.join(self.tmpdir, UDID, "ab", "abcdef"), "wb") as f:
+            f.write(data)
+        mb = self.make_backup()
+        mb.mb2_handle_send_files(["DLMessageDownloadFiles", ["ab/abcdef", "ab/missing"]])
+        stream = b"".join(mb.service.sent)
+        frames = []
+        while stream:
+            length = struct.unpack(">L", stream[:4])[0]
+            frames.append(stream[4:4 + length])
+            stream = stream[4 + length:]
+        self.assertEqual(frames[0], b"ab/abcdef")
+        self.assertTrue(all(f[0] == CODE_FILE_DATA for f in frames[1:4]))
+        self.assertEqual(b"".join(f[1:] for f in frames[1:4]), data)
+        self.assertEqual(frames[4:], [bytes([CODE_SUCCESS]), b"ab/missing", b"\x06", b""])
+        self.assertEqual(mb.service.plists[-1][1], -13)
+
+    def test_list_directory(self):
+        os.makedirs(os.path.join(self.tmpdir, UDID, "ab", "sub"))
+        with open(os.path.join(self.tmpdir, UDID, "ab", "sub", "deep"), "wb") as f:
+            f.write(b"x")
+        frames = [b"Media/a", UDID.encode() + b"/ab/abcdef",
+                  bytearray([CODE_FILE_DATA]) + b"12345", bytearray([CODE_SUCCESS])]
+        mb = self.make_backup(frames)
+        mb.mb2_handle_list_directory(["DLContentsOfDirectory", UDID + "/ab"])
+        self.assertEqual(list(mb.service.plists[-1][3]), ["sub"])
+        self.assertEqual(mb.service.plists[-1][3]["sub"]["DLFileType"], "DLFileTypeDirectory")
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+        mb.mb2_handle_list_directory(["DLContentsOfDirectory", UDID + "/ab"])
+        self.assertEqual(sorted(mb.service.plists[-1][3]), ["abcdef", "sub"])
+        self.assertEqual(mb.service.plists[-1][3]["abcdef"]["DLFileSize"], 5)
+        mb.mb2_handle_remove_files(["DLMessageRemoveFiles", [UDID + "/ab/abcdef"]])
+        mb.mb2_handle_list_directory(["DLContentsOfDirectory", UDID + "/ab"])
+        self.assertEqual(sorted(mb.service.plists[-1][3]), ["sub"])
+        # a dangling link does not abort the listing
+        os.symlink("missing", os.path.join(self.tmpdir, UDID, "ab", "dangling"))
+        mb.dir_cache.clear()
+        mb.mb2_handle_list_directory(["DLContentsOfDirectory", UDID + "/ab"])
+        self.assertEqual(sorted(mb.service.plists[-1][3]), ["dangling", "sub"])
+        self.assertEqual(mb.service.plists[-1][3]["dangling"]["DLFileType"], "DLFileTypeUnknown")
+
+    def test_move_remove_files(self):
+        base = os.path.join(self.tmpdir, UDID, "ab")
+        names = ["f%04d" % i for i in range(600)]
+        for name in names:
+            with open(os.path.join(base, name), "wb") as f:
+                f.write(name.encode())
+        mb = self.make_backup(io_threads=4)
+        moves = dict((UDID + "/ab/" + n, UDID + "/ab/m" + n) for n in names)
+        mb.mb2_handle_move_files(["DLMessageMoveFiles", moves])
+        self.assertEqual(len(os.listdir(base)), len(names))
+        with open(os.path.join(base, "mf0123"), "rb") as f:
+            self.assertEqual(f.read(), b"f0123")
+        # chained moves run in order: mf0000 -> mf0001 -> x
+        mb.mb2_handle_move_files(["DLMessageMoveFiles", {UDID + "/ab/mf0001": UDID + "/ab/x",
+                                                        UDID + "/ab/mf0000": UDID + "/ab/mf0001"}])
+        with open(os.path.join(base, "x"), "rb") as f:
+            self.assertEqual(f.read(), b"f0001")
+        os.makedirs(os.path.join(base, "dir", "sub"))
+        removed = [UDID + "/ab/m" + n for n in names[2:]] + [UDID + "/ab/dir", UDID + "/ab/missing"]
+        mb.mb2_handle_remove_files(["DLMessageRemoveFiles", removed])
+        self.assertEqual(sorted(os.listdir(base)), ["mf0001", "x"])
+        self.assertEqual(mb.service.plists[-1][1], 0)
+        mb.io_pool.shutdown()
+
+    def test_move_nested(self):
+        base = os.path.join(self.tmpdir, UDID, "ab")
+        os.makedirs(os.path.join(base, "X"))
+        with open(os.path.join(base, "X", "f"), "wb") as f:
+            f.write(b"f")
+        mb = self.make_backup(io_threads=4)
+        self.assertTrue(mb.has_nested_paths([base + "/X/f", base + "/g", base + "/X", base + "/Y"]))
+        self.assertFalse(mb.has_nested_paths([base + "/X", base + "/X2/f", base + "/Y"]))
+        # a directory move and the move of a file it contains run in order
+        mb.mb2_handle_move_files(["DLMessageMoveFiles", OrderedDict([(UDID + "/ab/X/f", UDID + "/ab/g"),
+                                                                     (UDID + "/ab/X", UDID + "/ab/Y")])])
+        self.assertEqual(sorted(os.listdir(base)), ["Y", "g"])
+        self.assertEqual(os.listdir(os.path.join(base, "Y")), [])
+        self.assertIsNone(mb.io_pool)
+
+    def test_copy_item(self):
+        base = os.path.join(self.tmpdir, UDID, "ab")
+        os.makedirs(os.path.join(base, "src", "sub"))
+        with open(os.path.join(base, "src", "sub", "a"), "wb") as f:
+            f.write(b"data")
+        mb = self.make_backup()
+        mb.mb2_handle_copy_item(["DLMessageCopyItem", UDID + "/ab/src", UDID + "/ab/dst"])
+        mb.mb2_handle_copy_item(["DLMessageCopyItem", UDID + "/ab/src/sub/a", UDID + "/ab/b"])
+        for path in (os.path.join(base, "dst", "sub", "a"), os.path.join(base, "b")):
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"data")
+        # copying into an existing directory merges the trees
+        with open(os.path.join(base, "dst", "other"), "wb") as f:
+            f.write(b"other")
+        mb.mb2_handle_copy_item(["DLMessageCopyItem", UDID + "/ab/src", UDID + "/ab/dst"])
+        self.assertEqual(sorted(os.listdir(os.path.join(base, "dst"))), ["other", "sub"])
+
+    def test_receive_progress(self):
+        frames = [b"Media/a", UDID.encode() + b"/ab/abcdef",
+                  bytearray([CODE_FILE_DATA]) + b"12345", bytearray([CODE_SUCCESS])]
+        events = []
+        mb = self.make_backup(frames)
+        mb.progress = BackupProgress(events.append, interval=0)
+        mb.progress.device_message(["DLMessageUploadFiles", {}, 50.0])
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}, 50.0])
+        self.assertEqual(events[-1]["files"], 1)
+        self.assertEqual(events[-1]["bytes"], len(b"Media/a") + len(UDID) + 10 + 7)
+        self.assertEqual(events[-1]["progress"], 50.0)
+
+    def test_resume(self):
+        frames = [b"Media/a", UDID.encode() + b"/ab/abcdef",
+                  bytearray([CODE_FILE_DATA]) + b"12345", bytearray([CODE_SUCCESS])]
+        mb = self.make_backup(frames)
+        self.assertTrue(mb.open_journal(True, resume=True))
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+        mb.journal.close()
+        filename = os.path.join(self.tmpdir, UDID, "ab", "abcdef")
+        inode = os.stat(filename).st_ino
+        with open(filename + PARTIAL_SUFFIX, "wb") as f:
+            f.write(b"123")
+        with open(os.path.join(self.tmpdir, UDID, "Status.plist"), "wb") as f:
+            f.write(plistlib.dumps({"BackupState": "new", "SnapshotState": "uploading"}))
+
+        changed = [b"Media/b", UDID.encode() + b"/ab/bcdef",
+                   bytearray([CODE_FILE_DATA]) + b"67", bytearray([CODE_SUCCESS])]
+        mb = self.make_backup(frames + changed)
+        self.assertFalse(mb.open_journal(True, resume=True))
+        self.assertFalse(os.path.exists(filename + PARTIAL_SUFFIX))
+        self.assertTrue(mb.resume)
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+        # the identical file is not rewritten
+        self.assertEqual(os.stat(filename).st_ino, inode)
+        self.assertEqual(len(mb.journal), 2)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, UDID, "ab")).count("abcdef"), 1)
+        mb.journal.remove()
+
+    def test_no_journal(self):
+        frames = [b"Media/a", UDID.encode() + b"/ab/abcdef",
+                  bytearray([CODE_FILE_DATA]) + b"12345", bytearray([CODE_SUCCESS])]
+        mb = self.make_backup(frames)
+        # journaling is opt-in, received files are not hashed by default
+        self.assertIsNone(mb.journal)
+        mb.partial_open(os.path.join(self.tmpdir, "x" + PARTIAL_SUFFIX))
+        self.assertEqual(mb.partial_hashes, {})
+        mb.partial_discard(os.path.join(self.tmpdir, "x" + PARTIAL_SUFFIX))
+        mb.mb2_handle_receive_files(["DLMessageUploadFiles", {}])
+        with open(os.path.join(self.tmpdir, UDID, "ab", "abcdef"), "rb") as f:
+            self.assertEqual(f.read(), b"12345")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, UDID + ".journal")))
+        # nor is the backup tree walked for leftover partial files
+        with mock.patch.object(mb, "create_info_plist"), \
+                mock.patch.object(mb, "mobilebackup2_send_request"), \
+                mock.patch.object(mb, "work_loop"), \
+                mock.patch("os.walk") as walk:
+            mb.willEncrypt = False
+            mb.session_complete = True
+            mb.backup(fullBackup=False)
+            self.assertFalse(walk.called)
+
+    def test_get_icons(self):
+        mb = self.make_backup()
+        mb.info_threads = 3
+        apps = [("com.example.app%d" % i, "1.%d" % i) for i in range(10)]
+        FakeClient.clients = []
+        with mock.patch.dict(os.environ, {"HOME": self.tmpdir}), \
+                mock.patch("pymobiledevice.mobilebackup2.SBServiceClient", FakeClient):
+            icons = mb.get_icons(apps)
+            self.assertEqual(len(FakeClient.clients), 3)
+            self.assertEqual(icons["com.example.app4"], b"png com.example.app4")
+            self.assertEqual([len(c.requests) for c in FakeClient.clients], [4, 3, 3])
+            # only updated applications are fetched on the next backup
+            FakeClient.clients = []
+            apps[4] = ("com.example.app4", "2.0")
+            icons = mb.get_icons(apps[:5])
+            self.assertEqual(len(icons), 5)
+            self.assertEqual([c.requests[0][0] for c in FakeClient.clients], ["com.example.app4"])
+
+    def test_get_icons_failed(self):
+        mb = self.make_backup()
+        mb.info_threads = 1
+        apps = [("com.example.app0", "1.0"), ("com.example.app1", "1.0")]
+        FakeClient.clients = []
+        with mock.patch.dict(os.environ, {"HOME": self.tmpdir}), \
+                mock.patch("pymobiledevice.mobilebackup2.SBServiceClient", FakeClient), \
+                mock.patch.object(FakeClient, "get_icon_pngdata",
+                                  lambda sbs, bid: None if bid.endswith("1") else b"png"):
+            icons = mb.get_icons(apps)
+            self.assertEqual(icons, {"com.example.app0": b"png"})
+        # the failed icon is fetched again on the next backup
+        FakeClient.clients = []
+        with mock.patch.dict(os.environ, {"HOME": self.tmpdir}), \
+                mock.patch("pymobiledevice.mobilebackup2.SBServiceClient", FakeClient):
+            icons = mb.get_icons(apps)
+            self.assertEqual(icons["com.example.app1"], b"png com.example.app1")
+            self.assertEqual([c.requests for c in FakeClient.clients], [[("com.example.app1", "MainThread")]])
+
+    def test_get_files(self):
+        mb = self.make_backup()
+        mb.info_threads = 4
+        mb.afc = FakeClient()
+        FakeClient.clients = []
+        with mock.patch("pymobiledevice.mobilebackup2.AFCClient", FakeClient):
+            files = mb.get_files(["/iTunes_Control/iTunes/" + i for i in ("iTunesPrefs", "VoiceMemos.plist")])
+        self.assertEqual(files, {"/iTunes_Control/iTunes/iTunesPrefs": b"prefs",
+                                 "/iTunes_Control/iTunes/VoiceMemos.plist": None})
+        self.assertEqual(len(FakeClient.clients), 1)
+        FakeClient.clients[0].service.close.assert_called_once_with()
@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+'''mobilebackup test case
+'''
+
+import logging
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from pymobiledevice.mobilebackup import MobileBackup, DEVICE_LINK_FILE_STATUS_HUNK, \
+    DEVICE_LINK_FILE_STATUS_LAST_HUNK, SMALL_FILE_SIZE
+from pymobiledevice.util.diskwriter import DiskWriterPool
+from pymobiledevice.plist_service import decode_plist
+
+UDID = "0123456789abcdef0123456789abcdef01234567"
+
+
+def send_file(dest, hunks):
+    msgs = []
+    for i, hunk in enumerate(hunks):
+        last = i == len(hunks) - 1
+        info = {"DLFileDest": dest,
+                "DLFileAttributesKey": {"Filename": dest},
+                "DLFileStatusKey": DEVICE_LINK_FILE_STATUS_LAST_HUNK if last else DEVICE_LINK_FILE_STATUS_HUNK}
+        if last:
+            info["BackupFileInfo"] = {"Domain": "HomeDomain", "Path": dest}
+        msgs.append(plistlib.dumps(["DLSendFile", hunk, info], fmt=plistlib.FMT_BINARY))
+    return msgs
+
+
+class FakeService(object):
+
+    def __init__(self, payloads):
+        self.payloads = list(payloads)
+        self.plists = []
+
+    def recv_raw(self):
+        if self.payloads:
+            return self.payloads.pop(0)
+
+    def recvPlist(self):
+        payload = self.recv_raw()
+        if payload:
+            return decode_plist(payload)
+
+    def sendPlist(self, d):
+        self.plists.append(d)
+        return 0
+
+
+class MobileBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_backup(self, payloads, writer_threads=2):
+        mb = MobileBackup.__new__(MobileBackup)
+        mb.logger = logging.getLogger(__name__)
+        mb.backupPath = self.tmpdir
+        mb.udid = UDID
+        mb.service = FakeService(payloads)
+        mb.create_info_plist = lambda: None
+        if writer_threads:
+            mb.writer = DiskWriterPool(writer_threads)
+        return mb
+
+    def run_backup(self, writer_threads):
+        big = os.urandom(SMALL_FILE_SIZE // 2)
+        payloads = [plistlib.dumps(["DLMessageProcessMessage", {"BackupMessageTypeKey": "BackupMessageBackupReplyOK"}])]
+        small_files = ["file%03d" % i for i in range(300)]
+        for name in small_files:
+            payloads += send_file(name, [name.encode()])
+        payloads += send_file("big", [big] * 5)
+        payloads.append(plistlib.dumps(["DLMessageProcessMessage",
+                                        {"BackupMessageTypeKey": "BackupMessageBackupFinished",
+                                         "BackupManifestKey": {"Data": b"manifest"}}]))
+        mb = self.make_backup(payloads, writer_threads)
+        mb.request_backup()
+        path = os.path.join(self.tmpdir, UDID)
+        acks = [p for p in mb.service.plists
+                if p[0] == "DLMessageProcessMessage"
+                and p[1].get("BackupMessageTypeKey") == "kBackupMessageBackupFileReceived"]
+        self.assertEqual(len(acks), 301)
+        for name in small_files:
+            with open(os.path.join(path, name + ".mddata"), "rb") as f:
+                self.assertEqual(f.read(), name.encode())
+        with open(os.path.join(path, "file042.mdinfo"), "rb") as f:
+            self.assertEqual(plistlib.load(f)["Path"], "file042")
+        with open(os.path.join(path, "big.mddata"), "rb") as f:
+            self.assertEqual(f.read(), big * 5)
+        self.assertTrue(os.path.exists(os.path.join(path, "big.mdinfo")))
+        with open(os.path.join(path, "Manifest.plist"), "rb") as f:
+            self.assertEqual(plistlib.load(f)["Data"], b"manifest")
+        writer = mb.writer
+        mb.close()
+        self.assertIsNone(mb.writer)
+        if writer:
+            self.assertEqual(writer.threads, [])
+
+    def test_request_backup(self):
+        self.run_backup(writer_threads=2)
+
+    def test_request_backup_synchronous(self):
+        self.run_backup(writer_threads=0)
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+'''pcapd parsing benchmark
+
+Measures the throughput of pcapd.parse_packet on synthetic records:
+
+    python test/pcapd_bench.py [-n PACKETS]
+'''
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymobiledevice.pcapd import parse_packet, PCAPD_HEADER
+
+
+def make_record(size, interface=b"pdp_ip0", offset_to_ip_data=0):
+    name = interface.ljust(16, b"\x00")
+    hdr = PCAPD_HEADER.pack(PCAPD_HEADER.size + len(name), 2, size, 0, 0, offset_to_ip_data, 0)
+    return hdr + name + os.urandom(size)
+
+
+def bench(records, count):
+    total = 0
+    start = time.time()
+    for i in range(count):
+        packet = parse_packet(records[i % len(records)])
+        total += len(packet.frame())
+    elapsed = time.time() - start
+    return elapsed, total
+
+
+def main():
+    parser = OptionParser(usage="%prog")
+    parser.add_option("-n", "--packets", dest="packets", default=200000, type="int",
+                      help="Number of packets to parse")
+    (options, args) = parser.parse_args()
+
+    for label, sizes in [("small (64B)", [64]),
+                         ("mixed (64B-1500B)", [64, 128, 576, 1500]),
+                         ("large (1500B)", [1500])]:
+        records = [make_record(s, offset_to_ip_data=i % 2 * 14) for i, s in enumerate(sizes * 16)]
+        elapsed, total = bench(records, options.packets)
+        print("%-20s %10.0f packets/s %8.1f MB/s" % (label, options.packets / elapsed,
+                                                      total / elapsed / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
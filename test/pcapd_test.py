@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+'''pcapd test case
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymobiledevice.pcapd import PcapdClient, PcapRingBuffer, parse_packet, PCAPD_HEADER, FAKE_ETHERNET_HEADER
+
+
+def make_record(payload, interface=b"pdp_ip0", offset_to_ip_data=0):
+    name = interface.ljust(16, b"\x00")
+    hdr = PCAPD_HEADER.pack(PCAPD_HEADER.size + len(name), 2, len(payload), 0, 0, offset_to_ip_data, 0)
+    return hdr + name + payload
+
+
+class FakeService(object):
+
+    def __init__(self, records):
+        self.records = list(records)
+
+    def recvPlist(self):
+        if self.records:
+            return self.records.pop(0)
+
+
+class ListOut(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def writePacket(self, packet):
+        self.frames.append(bytes(packet))
+        return True
+
+
+class PcapdTest(unittest.TestCase):
+
+    def test_parse_packet(self):
+        packet = parse_packet(make_record(b"\x45" * 20), timestamp=1.0)
+        self.assertEqual(packet.interface, "pdp_ip0")
+        self.assertEqual(packet.timestamp, 1.0)
+        self.assertIsInstance(packet.payload, memoryview)
+        self.assertEqual(packet.frame(), FAKE_ETHERNET_HEADER + b"\x45" * 20)
+
+        packet = parse_packet(make_record(b"\x00" * 34, b"en0", offset_to_ip_data=14))
+        self.assertEqual(bytes(packet.frame()), b"\x00" * 34)
+
+    def test_parse_truncated_packet(self):
+        self.assertRaises(ValueError, parse_packet, make_record(b"\x45" * 20)[:-1])
+
+    def test_capture(self):
+        records = [make_record(b"\x45" * i) for i in range(1, 6)]
+        sink = ListOut()
+        client = PcapdClient(lockdown=object(), service=FakeService(records))
+        self.assertEqual(client.capture([sink], count=3), 3)
+        self.assertEqual(sink.frames[2], FAKE_ETHERNET_HEADER + b"\x45" * 3)
+        self.assertEqual(len(list(client)), 2)
+
+    def test_ring_freeze(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        ring = PcapRingBuffer(os.path.join(tmpdir, "ring.pcap"), count=3, size=0)
+        packet = b"\x45" * 40000
+        for i in range(5):
+            ring.writePacket(packet)
+        outdir = ring.freeze("test")
+        frozen = dict((name, open(os.path.join(outdir, name), "rb").read()) for name in os.listdir(outdir))
+        self.assertEqual(sorted(frozen), ["000.pcap", "001.pcap", "002.pcap"])
+        # later rotations create new files and leave the snapshot alone
+        for i in range(10):
+            ring.writePacket(b"\x00" * 40000)
+        ring.close()
+        for name, data in frozen.items():
+            with open(os.path.join(outdir, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertIn(packet, data)
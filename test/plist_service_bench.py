@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+'''plist codec benchmark
+
+Measures PlistService message encoding and decoding on synthetic
+installation_proxy Browse/Lookup replies and lockdown GetValue replies:
+
+    python test/plist_service_bench.py [-n ROUNDS] [-a APPS]
+'''
+
+import datetime
+import os
+import plistlib
+import re
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymobiledevice.plist_service import encode_plist, decode_plist
+
+
+def make_app(i):
+    bid = "com.example.app%04d" % i
+    return {
+        "CFBundleIdentifier": bid,
+        "CFBundleName": "App %d" % i,
+        "CFBundleDisplayName": u"Appli\u00e9 %d" % i,
+        "CFBundleVersion": "%d.0.%d" % (i % 7, i),
+        "CFBundleShortVersionString": "1.%d" % i,
+        "CFBundleExecutable": "App%d" % i,
+        "ApplicationType": "User",
+        "Path": "/private/var/containers/Bundle/Application/%032X/App%d.app" % (i, i),
+        "Container": "/private/var/mobile/Containers/Data/Application/%032X" % i,
+        "Entitlements": {"application-identifier": "ABCDE12345." + bid,
+                         "keychain-access-groups": ["ABCDE12345." + bid],
+                         "get-task-allow": False},
+        "UIDeviceFamily": [1, 2],
+        "UIRequiredDeviceCapabilities": ["arm64"],
+        "MinimumOSVersion": "12.0",
+        "IsUpgradeable": True,
+        "StaticDiskUsage": 12345678 + i,
+        "DynamicDiskUsage": 4096 * i,
+        "ApplicationSINF": os.urandom(1024),
+        "iTunesMetadata": os.urandom(4096),
+        "SignerIdentity": "Apple iPhone OS Application Signing",
+    }
+
+
+def messages(apps):
+    browse = {"Status": "BrowsingApplications", "CurrentIndex": 0, "CurrentAmount": apps,
+              "Total": apps, "CurrentList": [make_app(i) for i in range(apps)]}
+    lookup = {"Status": "Complete",
+              "LookupResult": dict((a["CFBundleIdentifier"], a) for a in browse["CurrentList"])}
+    getvalue = {"Request": "GetValue", "Value": {
+        "BuildVersion": "17A577", "DeviceName": "iPhone", "ProductType": "iPhone10,6",
+        "ProductVersion": "13.0", "UniqueDeviceID": "0123456789abcdef" * 2 + "01234567",
+        "HardwarePlatform": "t8015", "DevicePublicKey": os.urandom(426),
+        "SupportedDeviceFamilies": [1], "TimeIntervalSince1970": 1570000000.5,
+        "ActivationState": "Activated", "PasswordProtected": True,
+        "LastBackupDate": datetime.datetime(2020, 1, 1)}}
+    return [("Browse (%d apps)" % apps, browse), ("Lookup (%d apps)" % apps, lookup),
+            ("GetValue", getvalue)]
+
+
+def legacy_decode(payload):
+    # the previous recvPlist: regex scrub of every XML payload (it also strips the ':' of dates)
+    payload = re.sub(r'[^\w<>\/ \-_0-9\"\'\\=\.\?\!\+]+', '', payload.decode('utf-8')).encode('utf-8')
+    return plistlib.loads(payload)
+
+
+def bench(func, arg, rounds):
+    start = time.time()
+    for i in range(rounds):
+        func(arg)
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = OptionParser(usage="%prog")
+    parser.add_option("-n", "--rounds", dest="rounds", default=20, type="int",
+                      help="Number of encodings/decodings per measure")
+    parser.add_option("-a", "--apps", dest="apps", default=300, type="int",
+                      help="Number of applications in the Browse/Lookup replies")
+    (options, args) = parser.parse_args()
+
+    print("%-20s %10s %12s %12s %12s %12s %12s" % ("message", "size", "xml enc", "bin enc",
+                                                    "xml+re dec", "xml dec", "bin dec"))
+    for label, msg in messages(options.apps):
+        xml = encode_plist(msg, binary=False)
+        binary = encode_plist(msg)
+        assert decode_plist(binary) == decode_plist(xml)
+        try:
+            legacy = bench(legacy_decode, xml, options.rounds)
+        except Exception:
+            legacy = None
+        times = [bench(lambda m: encode_plist(m, binary=False), msg, options.rounds),
+                 bench(encode_plist, msg, options.rounds),
+                 legacy,
+                 bench(decode_plist, xml, options.rounds),
+                 bench(decode_plist, binary, options.rounds)]
+        print("%-20s %10d %s" % (label, len(binary), " ".join("%10.2fms" % (t * 1000) if t is not None
+                                                              else "%12s" % "failed" for t in times)))
+
+
+if __name__ == '__main__':
+    main()
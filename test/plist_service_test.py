@@ -0,0 +1,32 @@
+# -*- coding:utf-8 -*-
+'''plist_service codec test case
+'''
+
+import datetime
+import plistlib
+import unittest
+
+from pymobiledevice.plist_service import encode_plist, decode_plist
+
+
+class PlistCodecTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        msg = {"Request": "GetValue", "Value": {"Name": u"iPhone de Zoé", "Key": b"\x00\x01",
+                                                "Date": datetime.datetime(2020, 1, 1, 12, 30),
+                                                "List": [1, -1, 2.5, True, {"a": "b"}]}}
+        binary = encode_plist(msg)
+        self.assertTrue(binary.startswith(b"bplist00"))
+        self.assertEqual(decode_plist(binary), msg)
+        xml = encode_plist(msg, binary=False)
+        self.assertTrue(xml.startswith(b"<?xml"))
+        self.assertEqual(decode_plist(xml), msg)
+
+    def test_xml_with_null_bytes(self):
+        xml = plistlib.dumps({"HardwarePlatform": "s5l8930x", "Date": datetime.datetime(2020, 1, 1)})
+        xml = xml.replace(b"s5l8930x", b"s5l8930x\x00\x00")
+        self.assertEqual(decode_plist(xml), {"HardwarePlatform": "s5l8930x",
+                                             "Date": datetime.datetime(2020, 1, 1)})
+
+    def test_invalid(self):
+        self.assertRaises(Exception, decode_plist, b"garbage")
@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+'''progress test case
+'''
+
+import io
+import json
+import unittest
+
+from pymobiledevice.util.progress import BackupProgress
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BackupProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.events = []
+        self.stream = io.StringIO()
+        self.progress = BackupProgress(self.events.append, self.stream, interval=1.0, clock=self.clock)
+
+    def test_events(self):
+        p = self.progress
+        p.set_free_space(10000)
+        p.device_message(["DLMessageUploadFiles", {}, 25.0])
+        self.assertEqual(self.events, [])
+        p.add_network(0.5, 1000)
+        p.add_disk(0.25)
+        self.clock.now += 10
+        p.file_received()
+        event = self.events[-1]
+        self.assertEqual(event["message"], "DLMessageUploadFiles")
+        self.assertEqual((event["files"], event["bytes"]), (1, 1000))
+        self.assertEqual(event["rate"], 100.0)
+        self.assertEqual(event["eta"], 30.0)
+        self.assertEqual(event["expected_bytes"], 4000)
+        self.assertTrue(event["space_ok"])
+        self.assertEqual((event["network_time"], event["disk_time"]), (0.5, 0.25))
+        p.finish()
+        self.assertEqual(self.events[-1]["event"], "done")
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual([json.loads(l) for l in lines], self.events)
+
+    def test_progress_hints(self):
+        p = self.progress
+        p.device_message(["DLMessageMoveFiles", {}, {}, 40.5])
+        self.assertEqual(p.progress, 40.5)
+        # no or bogus hints keep the last known progress
+        p.device_message(["DLMessageCreateDirectory", "dir"])
+        p.device_message(["DLMessageRemoveFiles", [], {}, -1.0])
+        p.device_message(["DLMessageGetFreeDiskSpace"])
+        self.assertEqual(p.progress, 40.5)
+        p.device_message(["DLMessageDownloadFiles", [], {}, 100.0])
+        self.assertIsNone(p.eta(self.clock.now))